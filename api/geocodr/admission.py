@@ -0,0 +1,213 @@
+"""
+The admission module limits the number of concurrent requests.
+"""
+
+import asyncio
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+
+class Rejected(Exception):
+  def __init__(self, retry_after):
+    Exception.__init__(self, 'request rejected, retry after {}s'.format(retry_after))
+    self.retry_after = retry_after
+
+
+class AdmissionController(object):
+  """
+  AdmissionController limits the number of requests that are processed at
+  the same time. Further requests wait in a bounded queue for up to
+  `queue_timeout` seconds. Requests are rejected immediately if the queue
+  is full.
+
+  Requests are either `interactive` or `bulk`. Bulk requests can only use
+  `bulk_share` of the in-flight limit and of the queue, and waiting
+  interactive requests are admitted first. Bulk traffic is therefore shed
+  before interactive traffic. The lane of a request is derived from its
+  API key, see `Geocodr.request_lane`.
+
+  Waiting requests are admitted in FIFO order for each lane. New requests
+  only run immediately if no request of their lane is waiting.
+
+  The in-flight limit adapts to the observed latency if `target_latency`
+  (in seconds) is set: It decreases if the average latency is above the
+  target, and it slowly increases up to `max_in_flight` otherwise.
+
+  `acquire_async` waits in the same queue without blocking a thread, for
+  the ASGI application.
+  """
+
+  def __init__(self, max_in_flight=32, max_queue=64, queue_timeout=1.0, bulk_share=0.5,
+               target_latency=None, min_in_flight=2, retry_after=1):
+    self.max_in_flight = max_in_flight
+    self.min_in_flight = min(min_in_flight, max_in_flight)
+    self.max_queue = max_queue
+    self.queue_timeout = queue_timeout
+    self.bulk_share = bulk_share
+    self.target_latency = target_latency
+    self.retry_after = retry_after
+
+    self.limit = float(max_in_flight)
+    self.avg_latency = None
+    self.in_flight = 0
+    # tickets of all waiting requests in arrival order
+    self.queues = {INTERACTIVE: deque(), BULK: deque()}
+    self.admitted = {INTERACTIVE: 0, BULK: 0}
+    self.rejected = {INTERACTIVE: 0, BULK: 0}
+    self._cond = threading.Condition()
+    # (loop, future) of all waiting acquire_async calls
+    self._async_waiters = []
+
+  def _in_flight_limit(self, lane):
+    if lane == BULK:
+      return max(int(self.limit * self.bulk_share), 1)
+    return max(int(self.limit), 1)
+
+  def _queue_limit(self, lane):
+    if lane == BULK:
+      return int(self.max_queue * self.bulk_share)
+    return self.max_queue
+
+  def _can_run(self, lane, ticket=None):
+    if self.in_flight >= self._in_flight_limit(lane):
+      return False
+    queue = self.queues[lane]
+    if queue and queue[0] is not ticket:
+      # earlier requests of this lane are waiting
+      return False
+    if lane == BULK and self.queues[INTERACTIVE]:
+      return False
+    return True
+
+  def _reject(self, lane):
+    self.rejected[lane] += 1
+    raise Rejected(self.retry_after)
+
+  def acquire(self, lane=INTERACTIVE):
+    """
+    Wait until the request can be processed. Raises `Rejected` if the queue
+    is full or after `queue_timeout`.
+    """
+    with self._cond:
+      if self._can_run(lane):
+        self.in_flight += 1
+        self.admitted[lane] += 1
+        return
+
+      if len(self.queues[lane]) >= self._queue_limit(lane):
+        self._reject(lane)
+
+      deadline = time.time() + self.queue_timeout
+      ticket = object()
+      self.queues[lane].append(ticket)
+      try:
+        while not self._can_run(lane, ticket):
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            self._reject(lane)
+          self._cond.wait(remaining)
+        self.in_flight += 1
+        self.admitted[lane] += 1
+      finally:
+        self.queues[lane].remove(ticket)
+        # wake the next request of this lane, or bulk requests that waited
+        # for this interactive request
+        self._notify_all()
+
+  async def acquire_async(self, lane=INTERACTIVE):
+    """
+    Wait until the request can be processed, like `acquire`, but without
+    blocking the event loop or a thread.
+    """
+    loop = asyncio.get_running_loop()
+    with self._cond:
+      if self._can_run(lane):
+        self.in_flight += 1
+        self.admitted[lane] += 1
+        return
+
+      if len(self.queues[lane]) >= self._queue_limit(lane):
+        self._reject(lane)
+      ticket = object()
+      self.queues[lane].append(ticket)
+
+    deadline = loop.time() + self.queue_timeout
+    try:
+      while True:
+        with self._cond:
+          if self._can_run(lane, ticket):
+            self.in_flight += 1
+            self.admitted[lane] += 1
+            return
+          remaining = deadline - loop.time()
+          if remaining <= 0:
+            self._reject(lane)
+          waiter = loop.create_future()
+          self._async_waiters.append((loop, waiter))
+        try:
+          await asyncio.wait_for(waiter, remaining)
+        except asyncio.TimeoutError:
+          pass
+    finally:
+      with self._cond:
+        self.queues[lane].remove(ticket)
+        self._notify_all()
+
+  def release(self, latency=None):
+    with self._cond:
+      self.in_flight -= 1
+      if latency is not None:
+        self._observe(latency)
+      self._notify_all()
+
+  def _notify_all(self):
+    # requires the lock of self._cond
+    self._cond.notify_all()
+    waiters, self._async_waiters = self._async_waiters, []
+    for loop, waiter in waiters:
+      if not waiter.done():
+        loop.call_soon_threadsafe(_wake, waiter)
+
+  def _observe(self, latency):
+    if not self.target_latency:
+      return
+    if self.avg_latency is None:
+      self.avg_latency = latency
+    else:
+      self.avg_latency = 0.9 * self.avg_latency + 0.1 * latency
+
+    if self.avg_latency > self.target_latency:
+      self.limit = max(self.limit * 0.95, self.min_in_flight)
+    else:
+      self.limit = min(self.limit + 1.0 / self.limit, self.max_in_flight)
+
+  @contextmanager
+  def admit(self, lane=INTERACTIVE):
+    self.acquire(lane)
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.release(time.time() - start)
+
+  def stats(self):
+    with self._cond:
+      return {
+        'limit': int(self.limit),
+        'in_flight': self.in_flight,
+        'waiting': {lane: len(queue) for lane, queue in self.queues.items()},
+        'admitted': dict(self.admitted),
+        'rejected': dict(self.rejected),
+      }
+
+
+def _wake(waiter):
+  if not waiter.done():
+    waiter.set_result(None)
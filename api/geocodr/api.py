@@ -7,21 +7,35 @@ import io
 import json
 import logging
 import os
+import time
 
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from concurrent.futures import (
+  ThreadPoolExecutor,
+  TimeoutError,
+)
 from werkzeug.middleware.shared_data import SharedDataMiddleware
+from werkzeug.http import quote_etag
 from werkzeug.routing import Map, Rule
 from werkzeug.wrappers import Response
 
 from . import solr
+from .admission import AdmissionController, Rejected, BULK, INTERACTIVE
+from .cache import DataVersions, make_etag, request_key
+from .exact import ExactIndex
 from .featurecollection import FeatureCollection
-from .keys import APIKeys
+from .keys import APIKeys, LimitExceeded
 from .mapping import load_collections
+from .parcels import load_parcel_index
 from .request import (
   DefaultRequestParams,
   GeocodrRequest,
   RequestError,
 )
+from .search import json_request
+from .session import SessionCache
+from .spell import SpellIndex
+from .suggest import SuggestIndex
 
 
 log = logging.getLogger(__name__)
@@ -34,43 +48,138 @@ MIN_COLLECTION_ROWS = 1000
 class Geocodr(object):
 
   def __init__(self, config):
-    self.solr = solr.Solr(config['solr_url'])
-    self.collections = load_collections(config['mapping'])
+    self.solr = solr.Solr(
+      config['solr_url'],
+      read_timeout=config.get('solr_timeout', 30.0),
+      hedge_percentile=config.get('solr_hedge_percentile', 95),
+      max_hedges=config.get('solr_max_hedges', 10),
+    )
+    self.collections = load_collections(
+      config['mapping'],
+      term_cache_size=config.get('term_cache_size', 10000),
+    )
     self.apikeys = None
     if config.get('api_keys_csv'):
-      self.apikeys = APIKeys(config['api_keys_csv'])
+      self.apikeys = APIKeys(config['api_keys_csv'], workers=config.get('workers', 1))
     self.enable_solr_basic_auth = config.get('enable_solr_basic_auth', False)
+    self.query_backend = config.get('query_backend', 'get')
+    self.multi_collection = config.get('multi_collection', False)
     self.data_proj = self.collections[0].src_proj
     self.default_params = DefaultRequestParams(
       data_proj=self.data_proj,
       reverse_radius=50,
+      time_budget=config.get('time_budget', 10000),
+      max_time_budget=config.get('max_time_budget', 30000),
     )
-    self.url_map = Map([
-      Rule('/query', endpoint='query'),
-    ])
+    self.admission = None
+    if config.get('max_in_flight'):
+      target_latency = config.get('target_latency')
+      self.admission = AdmissionController(
+        max_in_flight=config['max_in_flight'],
+        max_queue=config.get('max_queue', config['max_in_flight'] * 2),
+        queue_timeout=config.get('queue_timeout', 1.0),
+        bulk_share=config.get('bulk_share', 0.5),
+        target_latency=target_latency / 1000.0 if target_latency else None,
+      )
+    self.data_versions = None
+    if config.get('enable_etags'):
+      self.data_versions = DataVersions(self.solr, ttl=config.get('data_version_ttl', 60))
+    self.max_age = {
+      'search': config.get('max_age_search', 0),
+      'reverse': config.get('max_age_reverse', 0),
+    }
+    self.http_cache = bool(self.data_versions or any(self.max_age.values()))
+    self.exact_index = None
+    if config.get('exact_index'):
+      self.exact_index = ExactIndex(
+        self.solr,
+        self.collections,
+        max_docs=config.get('exact_index_max_docs', 200000),
+        ttl=config.get('data_version_ttl', 60),
+      )
+      self.exact_index.refresh()
+    self.parcel_index = None
+    if config.get('index_dir'):
+      self.parcel_index = load_parcel_index(config['index_dir'], self.collections)
+    self.sessions = None
+    if config.get('session_cache_size'):
+      self.sessions = SessionCache(
+        maxsize=config['session_cache_size'],
+        ttl=config.get('session_ttl', 30),
+      )
+    self.suggest_index = None
+    if config.get('suggest_index'):
+      self.suggest_index = SuggestIndex(
+        self.solr,
+        self.collections,
+        max_docs=config.get('suggest_index_max_docs', 1000000),
+        ttl=config.get('data_version_ttl', 60),
+      )
+      self.suggest_index.refresh()
+    self.spell_index = None
+    self.spell_min_hits = config.get('spell_min_hits', 1)
+    if config.get('spell_index'):
+      self.spell_index = SpellIndex(
+        self.solr,
+        self.collections,
+        max_words=config.get('spell_index_max_words', 100000),
+        max_docs=config.get('spell_index_max_docs', 1000000),
+        ttl=config.get('data_version_ttl', 60),
+      )
+      self.spell_index.refresh()
+    rules = [Rule('/query', endpoint='query')]
+    if config.get('enable_metrics'):
+      rules.append(Rule('/metrics', endpoint='metrics'))
+    self.url_map = Map(rules)
 
   def dispatch_request(self, request):
     adapter = self.url_map.bind_to_environ(request.environ)
     try:
       endpoint, values = adapter.match()
-      return getattr(self, 'on_' + endpoint)(request, **values)
-    except RequestError as e:
-      return self.json_error(request, 400, e.reason)
-    except ValueError as e:
-      return self.json_error(request, 400, 'Invalid parameter value: ' + str(e))
-    except Exception:
-      log.exception("Dispatching query {}".format(request))
-      return self.json_error(request, 500, 'Internal error')
-
-  def json_error(self, request, code, msg):
-    return self.json_resp(request, {'status': code, 'message': msg}, code=code)
+      handler = getattr(self, 'on_' + endpoint)
+      if self.admission is None:
+        return handler(request, **values)
+      with self.admission.admit(self.request_lane(request)):
+        return handler(request, **values)
+    except Exception as ex:
+      return self.exception_resp(request, ex)
+
+  def request_lane(self, request):
+    """
+    Admission lane of the request. The lane is configured for each API key,
+    the `priority` parameter can only lower it to bulk.
+    """
+    if request.g.priority == BULK:
+      return BULK
+    if self.apikeys is not None:
+      return self.apikeys.priority(request.args.get('key'))
+    return INTERACTIVE
+
+  def exception_resp(self, request, ex):
+    """
+    Return the error response for an exception from a request handler.
+    """
+    if isinstance(ex, Rejected):
+      return self.json_error(request, 503, 'Service overloaded, retry later.',
+                             headers={'Retry-After': str(ex.retry_after)})
+    if isinstance(ex, RequestError):
+      return self.json_error(request, 400, ex.reason)
+    if isinstance(ex, ValueError):
+      return self.json_error(request, 400, 'Invalid parameter value: ' + str(ex))
+    log.error("Dispatching query {}".format(request), exc_info=ex)
+    return self.json_error(request, 500, 'Internal error')
+
+  def json_error(self, request, code, msg, headers=None):
+    return self.json_resp(request, {'status': code, 'message': msg}, code=code,
+                          headers=headers)
 
   @staticmethod
-  def json_resp(request, data, code=200):
-    headers = {
+  def json_resp(request, data, code=200, headers=None):
+    headers = dict(headers or {})
+    headers.update({
       'Content-Type': 'application/json; charset=utf-8',
       'Access-Control-Allow-Origin': '*',
-    }
+    })
     data = json.dumps(data, sort_keys=True, indent=2)
 
     if 'callback' in request.args:
@@ -106,90 +215,557 @@ class Geocodr(object):
       else:
         return self.json_error(request, 400, "Invalid class '{}'".format(cls))
 
-  def on_query(self, request):
+  def on_metrics(self, request):
+    metrics = {}
+    term_caches = {c.name: c.term_cache.stats() for c in self.collections if c.term_cache}
+    if term_caches:
+      metrics['term_cache'] = term_caches
+    if self.admission:
+      metrics['admission'] = self.admission.stats()
+    if self.apikeys:
+      metrics['api_keys'] = self.apikeys.metrics()
+    if self.exact_index:
+      metrics['exact_index'] = self.exact_index.stats()
+    if self.suggest_index:
+      metrics['suggest_index'] = self.suggest_index.stats()
+    if self.spell_index:
+      metrics['spell_index'] = self.spell_index.stats()
+    if self.sessions:
+      metrics['sessions'] = self.sessions.stats()
+    if self.parcel_index:
+      metrics['parcel_index'] = dict((name, len(idx)) for name, idx in self.parcel_index.items())
+    return self.json_resp(request, metrics)
+
+  def check_access(self, request):
+    """
+    Check the authentication and the limits of the API key. Returns an
+    error response if the request is not permitted.
+    """
     if self.enable_solr_basic_auth and request.g.user_auth:
       # skip apikey validation if enable_solr_basic_auth is active and the user
       # provided user/password
-      pass
-    elif self.apikeys and not self.apikeys.is_permitted(request):
-      # we have API keys and key is missing or invalid
-      return self.json_error(request, 403, 'API key is invalid or not valid for this requests.')
+      return
+    if self.apikeys:
+      if not self.apikeys.is_permitted(request):
+        # we have API keys and key is missing or invalid
+        return self.json_error(request, 403,
+                               'API key is invalid or not valid for this requests.')
+      try:
+        self.apikeys.consume(request)
+      except LimitExceeded as e:
+        return self.json_error(request, 429, e.reason,
+                               headers={'Retry-After': str(e.retry_after)})
 
-    # collect all variables here so we can use them in concurrently from
-    # multiple threads in query()
-    dst_proj = request.g.dst_proj
-    spatial_filter = request.g.spatial_filter
-    distance_pt = spatial_filter.distance_pt() if spatial_filter else None
-    shape = request.g.shape
-    req_classes = request.g.classes
-
-    err = self.check_req_classes(request, req_classes)
+  def on_query(self, request):
+    err = self.check_access(request) or self.check_req_classes(request, request.g.classes)
     if err:
       return err
+    if request.g.type == 'suggest':
+      return self.on_suggest(request)
 
-    fc = FeatureCollection()
+    etag = self.etag(request)
+    if etag and request.if_none_match.contains_weak(etag):
+      return self.not_modified(request, etag)
 
-    def query(curr_collection):
-      if (
-          not request.g.is_reverse
-          and len(request.g.query.strip()) < curr_collection.min_query_length
-      ):
-        # return empty result for short queries
-        return []
-
-      if request.g.is_reverse:
-        q = '*'
-      else:
-        q = curr_collection.query(request.g.query)
-
-      kw = {}
-      if spatial_filter:
-        kw.update(
-          spatial_filter.query_params(curr_collection.geometry_field)
-        )
-
-      resp = self.solr.query(
-        collection=curr_collection.name,
-        q=q,
-        sort=curr_collection.sort,
-        fl=curr_collection.field_list,
-        rows=max(request.g.limit + request.g.offset, MIN_COLLECTION_ROWS),
-        user_auth=request.g.user_auth,
-        **kw
-      )
+    flow = self.search_flow(request, etag)
+    try:
+      search = next(flow)
+      while True:
+        search = flow.send(self.execute(request, search))
+    except StopIteration as ex:
+      return ex.value
+
+  def search(self, request, query=None):
+    return Search(request, self.collections, self.multi_collection, self.exact_index,
+                  self.sessions, self.parcel_index, query=query)
+
+  def search_flow(self, request, etag=None):
+    """
+    Generator for the searches of a query request, shared by the WSGI and
+    the ASGI application. It yields each Search that needs to be executed
+    and expects the result of `execute` (an error response or None). The
+    response is the return value of the generator.
+    """
+    search = self.search(request)
+    err = yield search
+    if err:
+      return err
 
-      return curr_collection.to_features(
-        resp['response']['docs'],
-        dst_proj=dst_proj,
-        distance_pt=distance_pt,
-        shape=shape,
-      )
+    corrected = self.corrected_query(request, search)
+    if corrected is not None:
+      retry = self.search(request, query=corrected)
+      # the retry shares the time budget of the first search
+      retry.deadline = search.deadline
+      err = yield retry
+      if err:
+        return err
+      if retry.fc.total_features > search.fc.total_features:
+        retry.corrected_query = corrected
+        search = retry
+
+    return self.search_resp(request, search, etag)
+
+  def solr_request(self, request, search, group):
+    """
+    Return the name of the Solr client method and the arguments to query
+    `group`, or None if the collections have no query for this request.
+    """
+    params = search.solr_params(group)
+    if params is None:
+      return None
+    kw = {
+      'collection': solr_collection(group),
+      'user_auth': request.g.user_auth,
+      'timeout': search.remaining(),
+    }
+    if self.query_backend == 'json' or search.needs_post(group):
+      kw['body'] = json_request(params)
+      return 'query_json', kw
+    kw.update(params)
+    return 'query', kw
+
+  def execute(self, request, search):
+    """
+    Query all groups of `search` in parallel. Returns an error response or
+    None.
+    """
+    def query(group):
+      req = self.solr_request(request, search, group)
+      if req is None:
+        return []
+      method, kw = req
+      return search.to_features(group, getattr(self.solr, method)(**kw))
 
     # query in parallel
-    with ThreadPoolExecutor(max_workers=4) as e:
-      futures = []
-      for collection in self.collections:
-        if collection.class_ not in req_classes:
-          continue
-        futures.append((collection.name, e.submit(query, collection)))
+    e = ThreadPoolExecutor(max_workers=4)
+    futures = []
+    try:
+      for group in search.groups:
+        futures.append((group, e.submit(query, group)))
 
-      for name, f in futures:
+      for group, f in futures:
         try:
-          features = f.result()
-          fc.add_features(features)
+          search.add_features(f.result(timeout=max(search.remaining(), 0)))
         except solr.SolrUnauthenticatedError:
           return self.json_error(request, 400, 'Invalid user/password')
-        except Exception:
-          log.exception("Fetching result for collection '%s'", name)
-          return self.json_error(request, 500, 'Internal error.')
-
-    fc.sort(limit=request.g.limit, offset=request.g.offset, distance=request.g.is_reverse)
-
+        except (TimeoutError, solr.SolrTimeoutError):
+          search.add_timeout(group)
+        except Exception as ex:
+          search.add_error(group, ex)
+    finally:
+      # do not wait for collections that missed the deadline
+      for _, f in futures:
+        f.cancel()
+      e.shutdown(wait=False)
+
+  def corrected_query(self, request, search):
+    """
+    Return the query of `search` with corrected spelling, if it found fewer
+    than `spell_min_hits` features. Returns None if the query should not be
+    repeated.
+    """
+    if (self.spell_index is None or search.query is None or search.components or search.ids
+        or search.fc.is_partial or search.failed
+        or search.fc.total_features >= self.spell_min_hits or search.remaining() <= 0):
+      return None
+    collections = [c for c in self.collections if c.class_ in request.g.classes]
+    return self.spell_index.correct(collections, search.query)
+
+  def on_suggest(self, request):
+    """
+    Return the titles that match the query as features without geometry.
+    Suggestions are answered from the SuggestIndex and never query Solr.
+    """
+    if self.suggest_index is None:
+      return self.json_error(request, 400, 'type=suggest is not enabled')
+    g = request.g
+    collections = [c for c in self.collections if c.class_ in g.classes]
+    fc = FeatureCollection()
+    fc.add_features(self.suggest_index.suggest(
+      collections, g.query or '', max_scan=max((g.limit + g.offset) * 10, 1000)))
+    fc.sort(limit=g.limit, offset=g.offset)
     if request.args.get('debug', '').lower() != 'true':
       fc.filter_internal_properties()
-
     return self.json_resp(request, fc.as_mapping())
 
+  def search_resp(self, request, search, etag=None):
+    if search.all_failed():
+      return self.json_error(request, 500, 'Internal error.')
+    resp = self.json_resp(request, search.result())
+    if search.fc.is_partial:
+      # partial results should be requested again
+      if self.http_cache:
+        resp.headers['Cache-Control'] = 'no-cache'
+    else:
+      resp.headers.extend(self.cache_headers(request, etag))
+    return resp
+
+  def etag(self, request):
+    """
+    Return the ETag for the request, based on all parameters and the data
+    versions of all requested collections. Returns None if the response
+    should not be cached.
+    """
+    if self.data_versions is None or request.g.user_auth:
+      return None
+    names = [c.name for c in self.collections if c.class_ in request.g.classes]
+    versions = self.data_versions.get(names)
+    if versions is None:
+      return None
+    return make_etag(request_key(request), versions)
+
+  def cache_headers(self, request, etag):
+    if not self.http_cache:
+      return {}
+    if request.g.user_auth:
+      return {'Cache-Control': 'private, no-store'}
+    headers = {}
+    max_age = self.max_age.get(request.g.type)
+    if max_age:
+      headers['Cache-Control'] = 'public, max-age={}'.format(max_age)
+    else:
+      headers['Cache-Control'] = 'no-cache'
+    if etag:
+      headers['ETag'] = quote_etag(etag)
+    return headers
+
+  def not_modified(self, request, etag):
+    headers = self.cache_headers(request, etag)
+    headers['Access-Control-Allow-Origin'] = '*'
+    headers['Vary'] = 'Accept-Encoding'
+    return Response(status=304, headers=headers)
+
+
+class Search(object):
+  """
+  Search builds the Solr queries for all requested collections and collects
+  the features. It is independent from the actual Solr client, so that it
+  can be used by the WSGI and the ASGI application.
+
+  Collections are queried in groups. Each group is queried with a single
+  Solr request. Collections with the same `source_field` are grouped if
+  `multi_collection` is enabled, otherwise each group contains a single
+  collection.
+
+  Queries that match the complete title of one or more documents are
+  answered from the `exact_index` without any Solr request. Queries that
+  extend the previous query of the same session are answered from the
+  `sessions` cache if possible.
+
+  Parcel identifications (in the query or the list of `parcels` for bulk
+  requests) are resolved to document IDs with the `parcel_index`.
+
+  `query` replaces the query of the request (e.g. for spelling corrections).
+  """
+
+  def __init__(self, request, collections, multi_collection=False, exact_index=None,
+               sessions=None, parcel_index=None, query=None):
+    self.request = request
+    g = request.g
+    # collect all variables here so we can use them in concurrently from
+    # multiple threads
+    self.reverse = g.is_reverse
+    self.query = (query or g.query) if not g.is_reverse else None
+    # set if `query` is the spelling correction of the requested query
+    self.corrected_query = None
+    self.components = g.components if not g.is_reverse else {}
+    self.parcels = g.parcels if not g.is_reverse else []
+    self.dst_proj = g.dst_proj
+    self.spatial_filter = g.spatial_filter
+    self.distance_pt = self.spatial_filter.distance_pt() if self.spatial_filter else None
+    self.shape = g.shape
+    self.rows = max(g.limit + g.offset, MIN_COLLECTION_ROWS)
+    self.collections = [c for c in collections if c.class_ in g.classes]
+
+    # True if a collection has more results than rows
+    self.truncated = False
+
+    # skip all collections that can not return results for this query
+    self.planner_skipped = {}
+    # IDs from the parcel index for each collection
+    self.ids = {}
+    self.parcel_queries = {}
+    self.parcels_not_found = []
+    if self.query is not None or self.components or self.parcels:
+      self.collections = self.plan(self.collections, parcel_index or {})
+
+    self.fc = FeatureCollection()
+    self.failed = 0
+
+    self.sessions = None
+    self.refined = False
+    if (sessions is not None and g.session and self.query is not None and not self.components
+        and not self.ids):
+      self.sessions = sessions
+      self.session_key = request_key(
+        request, ignore=('key', 'query', 'limit', 'offset', 'session', 'callback', 'debug'))
+      self.collection_names = [c.name for c in self.collections]
+      features = sessions.refine(g.session, self.session_key, self.query,
+                                 self.collection_names)
+      if features is not None:
+        self.fc.add_features(features)
+        self.refined = True
+        self.collections = []
+
+    self.exact_match = False
+    if (exact_index is not None and self.query is not None and not self.components
+        and not self.ids and not self.spatial_filter and not self.refined):
+      hits = exact_index.lookup(self.collections, self.query)
+      if hits:
+        for collection, docs in hits:
+          self.fc.add_features(collection.to_features(
+            docs, dst_proj=self.dst_proj, shape=self.shape))
+        self.exact_match = True
+        self.collections = []
+
+    if multi_collection:
+      self.groups = group_collections(self.collections)
+    else:
+      self.groups = [[c] for c in self.collections]
+
+    # all collections need to respond within the time budget
+    self.deadline = time.time() + g.time_budget / 1000.0
+
+  def remaining(self):
+    return self.deadline - time.time()
+
+  def plan(self, collections, parcel_index):
+    """
+    Return all collections that need to be queried. Parcel identifications
+    are resolved with the `parcel_index`, all other collections are skipped
+    if they can not return any result.
+    """
+    planned = []
+    found = set()
+    for c in collections:
+      index = parcel_index.get(c.name)
+      if index is not None and not self.components:
+        ids = self.lookup_parcels(c, index, found)
+        if ids:
+          self.ids[c.name] = ids
+          planned.append(c)
+          continue
+        if ids is not None:
+          self.planner_skipped[c.name] = 'no parcel for query'
+          continue
+      if self.parcels:
+        self.planner_skipped[c.name] = 'no parcel index'
+        continue
+      reason = c.skip_reason(self.query, self.components)
+      if reason:
+        self.planner_skipped[c.name] = reason
+      else:
+        planned.append(c)
+    self.parcels_not_found = [p for p in self.parcels if p not in found]
+    return planned
+
+  def lookup_parcels(self, collection, index, found):
+    """
+    Return the IDs of all parcels of `collection` for the parcels (or the
+    query) of this request. Returns None if there is no parcel
+    identification with Gemarkung number.
+    """
+    ids = []
+    resolved = False
+    for parcel in self.parcels or [self.query]:
+      key = collection.flst_key(parcel)
+      if key is None:
+        continue
+      resolved = True
+      if len(ids) >= self.rows:
+        # only check that the remaining parcels exist
+        if index.lookup(key, 1):
+          found.add(parcel)
+          self.truncated = True
+        continue
+      for id in index.lookup(key, self.rows - len(ids) + 1):
+        if len(ids) >= self.rows:
+          self.truncated = True
+          break
+        ids.append(id)
+        self.parcel_queries[(collection.name, id)] = parcel
+        found.add(parcel)
+    if not resolved:
+      return None
+    return ids
+
+  def solr_params(self, group):
+    """
+    Return all Solr query parameters for the collections of `group`, or
+    None if the collections have no query for this request. Raises
+    SolrTimeoutError if the time budget is exhausted.
+    """
+    collection = group[0]
+    if self.reverse:
+      q = '*'
+    elif len(group) == 1:
+      q = self.collection_query(collection)
+    else:
+      q = multi_collection_query(group, self.collection_query)
+      if not q:
+        return None
+
+    remaining = self.remaining()
+    if remaining <= 0:
+      raise solr.SolrTimeoutError('time budget exhausted')
+
+    params = {
+      'q': q,
+      'sort': collection.sort,
+      'fl': collection.field_list,
+      'rows': self.rows * len(group),
+      'timeAllowed': int(remaining * 1000),
+    }
+    if self.spatial_filter:
+      params.update(
+        self.spatial_filter.query_params(collection.geometry_field)
+      )
+    return params
+
+  def collection_query(self, collection):
+    """
+    Return the query for the free-text query and the structured components
+    of this request.
+    """
+    if collection.name in self.ids:
+      return '_query_:"{{!terms f=id}}{}"'.format(','.join(self.ids[collection.name]))
+    parts = []
+    if self.query is not None:
+      parts.append(collection.query(self.query))
+    if self.components:
+      parts.append(collection.query_components(self.components))
+    return ' AND '.join(p for p in parts if p)
+
+  def needs_post(self, group):
+    """
+    Return True if the query for `group` is too long for a GET request.
+    """
+    return any(c.name in self.ids for c in group)
+
+  def to_features(self, group, resp):
+    if resp.get('responseHeader', {}).get('partialResults'):
+      for collection in group:
+        self.fc.add_incomplete(collection.name)
+    if resp['response'].get('numFound', 0) > len(resp['response']['docs']):
+      self.truncated = True
+
+    features = []
+    for collection, docs in split_docs(group, resp['response']['docs']):
+      collection_features = collection.to_features(
+        docs,
+        dst_proj=self.dst_proj,
+        distance_pt=self.distance_pt,
+        shape=self.shape,
+      )
+      if self.parcels:
+        for f in collection_features:
+          f['properties']['parcel_query'] = self.parcel_queries.get(
+            (collection.name, f['properties']['_id_']))
+      features.extend(collection_features)
+    return features
+
+  def add_features(self, features):
+    self.fc.add_features(features)
+
+  def add_timeout(self, group):
+    for collection in group:
+      log.warning("Skipping collection '%s' after time budget of %dms",
+                  collection.name, self.request.g.time_budget)
+      self.fc.add_skipped(collection.name)
+
+  def add_error(self, group, ex):
+    log.error("Fetching result for collection '%s'", solr_collection(group), exc_info=ex)
+    for collection in group:
+      self.fc.add_skipped(collection.name)
+      self.failed += 1
+
+  def all_failed(self):
+    return bool(self.collections) and self.failed == len(self.collections)
+
+  def result(self):
+    g = self.request.g
+    if (self.sessions is not None and not self.refined and not self.exact_match
+        and not self.truncated and not self.fc.is_partial and not self.failed):
+      # all results are known and can be refined by the next query
+      self.sessions.set(g.session, self.session_key, self.query, self.collection_names,
+                        self.fc.features)
+    self.fc.sort(limit=g.limit, offset=g.offset, distance=g.is_reverse)
+
+    debug = self.request.args.get('debug', '').lower() == 'true'
+    if not debug:
+      self.fc.filter_internal_properties()
+
+    result = self.fc.as_mapping()
+    if debug and self.planner_skipped:
+      result['properties']['planner_skipped'] = self.planner_skipped
+    if debug and self.exact_match:
+      result['properties']['exact_match'] = True
+    if debug and self.refined:
+      result['properties']['session_refined'] = True
+    if self.corrected_query is not None:
+      result['properties']['corrected_query'] = self.corrected_query
+    if self.parcels:
+      result['properties']['parcels_not_found'] = self.parcels_not_found
+      if self.truncated:
+        # more parcels match than `limit`
+        result['properties']['parcels_truncated'] = True
+    return result
+
+
+def group_collections(collections):
+  """
+  Group all collections with the same class, `source_field`, sort and
+  fields. Collections without `source_field` are not grouped.
+  """
+  groups = OrderedDict()
+  for c in collections:
+    if c.source_field:
+      key = (c.class_, c.source_field, c.sort, c.field_list, c.geometry_field)
+    else:
+      key = id(c)
+    groups.setdefault(key, []).append(c)
+  return list(groups.values())
+
+
+def multi_collection_query(group, collection_query):
+  """
+  Return a query for all collections of `group`. The query for each
+  collection is built with `collection_query`. Each collection only matches
+  documents with its name in the `source_field`.
+  """
+  branches = []
+  for c in group:
+    q = collection_query(c)
+    if not q:
+      continue
+    branches.append('(filter({}:{}) AND ({}))'.format(c.source_field, c.name, q))
+  return ' OR '.join(branches)
+
+
+def split_docs(group, docs):
+  """
+  Return (collection, docs) for each collection of `group`. Documents are
+  assigned by the `source_field` if the group has multiple collections.
+  """
+  if len(group) == 1:
+    return [(group[0], docs)]
+
+  by_name = dict((c.name, []) for c in group)
+  for doc in docs:
+    name = doc.get(group[0].source_field)
+    if isinstance(name, list):
+      name = name[0] if name else None
+    if name in by_name:
+      by_name[name].append(doc)
+  return [(c, by_name[c.name]) for c in group]
+
+
+def solr_collection(group):
+  """
+  Return the Solr collection path for all collections of `group`.
+  """
+  return ','.join(c.name for c in group)
+
 
 def gzip_data(data):
   buf = io.BytesIO()
@@ -209,44 +785,193 @@ def create_app(config):
   return app
 
 
-def main():
-  logging.basicConfig(level=logging.INFO)
-
+def config_parser():
+  """
+  Return the argparse parser for all options of the Geocodr configuration.
+  Used by geocodr-api and for the environment variables of the ASGI
+  application.
+  """
   import argparse
 
-  parser = argparse.ArgumentParser()
-  parser.add_argument("--host", default="127.0.0.1")
-  parser.add_argument("--port", type=int, default=5000)
-  parser.add_argument("--solr-url", default="http://localhost:8983/solr")
+  parser = argparse.ArgumentParser(add_help=False)
+  parser.add_argument("--solr-url", default="http://localhost:8983/solr",
+                      help='Solr URL or comma separated list of URLs for multiple Solr nodes')
+  parser.add_argument("--solr-timeout", type=float, default=30.0,
+                      help='timeout in seconds for reading responses from Solr')
+  parser.add_argument(
+    "--solr-hedge-percentile",
+    type=float,
+    default=95,
+    help='send a duplicate request to another Solr node if a request takes longer than '
+         'this latency percentile of the node (0 to disable)'
+  )
+  parser.add_argument("--solr-max-hedges", type=int, default=10,
+                      help='maximum number of concurrent duplicate requests')
   parser.add_argument("--mapping", required=True, help='mapping file')
   parser.add_argument("--static-dir", help='optional: additional files to host at /static')
   parser.add_argument("--api-keys", help='optional: CSV file with permitted API keys and domains')
+  parser.add_argument("--enable-metrics", action='store_true',
+                      help='optional: serve request counters as JSON at /metrics')
   parser.add_argument(
     "--enable-solr-basic-auth",
     action='store_true',
     help='optional: pass user/password params to Solr as HTTP Basic-Authentication'
   )
-  parser.add_argument("--develop", action='store_true',
-                      help='start in development mode (reload on code changes)')
-
-  args = parser.parse_args()
-
-  from werkzeug.serving import run_simple
+  parser.add_argument("--time-budget", type=int, default=10000,
+                      help='default time budget for each request in ms')
+  parser.add_argument("--max-time-budget", type=int, default=30000,
+                      help='maximum time budget that clients can request in ms')
+  parser.add_argument(
+    "--query-backend",
+    choices=['get', 'json'],
+    default='get',
+    help='send queries as GET parameters or as POST requests to the Solr JSON Request API'
+  )
+  parser.add_argument(
+    "--multi-collection",
+    action='store_true',
+    help='query all collections of a class with the same source_field with a single request'
+  )
+  parser.add_argument("--term-cache-size", type=int, default=10000,
+                      help='number of query terms to cache for each collection (0 to disable)')
+  parser.add_argument("--enable-etags", action='store_true',
+                      help='optional: answer repeated requests with 304 Not Modified until the '
+                           'data of the requested collections changed')
+  parser.add_argument("--data-version-ttl", type=float, default=60,
+                      help='check the data versions for --enable-etags every n seconds')
+  parser.add_argument("--exact-index", action='store_true',
+                      help='optional: answer queries for complete titles from an in-memory index '
+                           'of all collections with exact_index = True')
+  parser.add_argument("--exact-index-max-docs", type=int, default=200000,
+                      help='do not index collections with more documents')
+  parser.add_argument("--suggest-index", action='store_true',
+                      help='optional: answer type=suggest requests from an in-memory index of '
+                           'the titles of all collections with suggest_index = True')
+  parser.add_argument("--suggest-index-max-docs", type=int, default=1000000,
+                      help='do not index collections with more documents for --suggest-index')
+  parser.add_argument("--spell-index", action='store_true',
+                      help='optional: repeat queries with few results with a spelling correction '
+                           'from an in-memory dictionary of all collections with '
+                           'spell_index = True')
+  parser.add_argument("--spell-index-max-words", type=int, default=100000,
+                      help='maximum number of words of each collection for --spell-index')
+  parser.add_argument("--spell-index-max-docs", type=int, default=1000000,
+                      help='do not index collections with more documents for --spell-index')
+  parser.add_argument("--spell-min-hits", type=int, default=1,
+                      help='correct the spelling of queries with fewer results')
+  parser.add_argument("--index-dir",
+                      help='optional: directory with parcel key indexes (<collection>.flst) '
+                           'from geocodr-flst-index')
+  parser.add_argument("--session-cache-size", type=int, default=0,
+                      help='optional: keep the results of the last search for this number of '
+                           'client sessions (session parameter)')
+  parser.add_argument("--session-ttl", type=float, default=30,
+                      help='keep the results of each session for n seconds')
+  parser.add_argument("--max-age-search", type=int, default=0,
+                      help='optional: Cache-Control max-age in seconds for search requests')
+  parser.add_argument("--max-age-reverse", type=int, default=0,
+                      help='optional: Cache-Control max-age in seconds for reverse requests')
+  parser.add_argument("--max-in-flight", type=int, default=0,
+                      help='optional: maximum number of concurrently processed requests')
+  parser.add_argument("--max-queue", type=int,
+                      help='maximum number of waiting requests (default: 2 * --max-in-flight)')
+  parser.add_argument("--queue-timeout", type=float, default=1.0,
+                      help='maximum time in seconds a request waits in the queue')
+  parser.add_argument("--bulk-share", type=float, default=0.5,
+                      help='share of --max-in-flight and --max-queue for bulk requests (keys with '
+                           'priority bulk or priority=bulk parameter)')
+  parser.add_argument("--target-latency", type=int,
+                      help='optional: reduce the number of concurrent requests if the average '
+                           'latency is above this value in ms')
+  return parser
+
+
+def config_from_args(args):
+  """
+  Return the Geocodr configuration for the parsed `config_parser` options.
+  """
   config = {
     'solr_url': args.solr_url,
+    'solr_timeout': args.solr_timeout,
+    'solr_hedge_percentile': args.solr_hedge_percentile,
+    'solr_max_hedges': args.solr_max_hedges,
     'mapping': args.mapping,
     'static_files': args.static_dir,
     'api_keys_csv': args.api_keys,
     'enable_solr_basic_auth': args.enable_solr_basic_auth,
+    'enable_metrics': args.enable_metrics,
+    'time_budget': args.time_budget,
+    'max_time_budget': args.max_time_budget,
+    'query_backend': args.query_backend,
+    'multi_collection': args.multi_collection,
+    'term_cache_size': args.term_cache_size,
+    'enable_etags': args.enable_etags,
+    'data_version_ttl': args.data_version_ttl,
+    'exact_index': args.exact_index,
+    'exact_index_max_docs': args.exact_index_max_docs,
+    'suggest_index': args.suggest_index,
+    'index_dir': args.index_dir,
+    'session_cache_size': args.session_cache_size,
+    'session_ttl': args.session_ttl,
+    'suggest_index_max_docs': args.suggest_index_max_docs,
+    'spell_index': args.spell_index,
+    'spell_index_max_words': args.spell_index_max_words,
+    'spell_index_max_docs': args.spell_index_max_docs,
+    'spell_min_hits': args.spell_min_hits,
+    'max_age_search': args.max_age_search,
+    'max_age_reverse': args.max_age_reverse,
+    'max_in_flight': args.max_in_flight,
+    'queue_timeout': args.queue_timeout,
+    'bulk_share': args.bulk_share,
+    'target_latency': args.target_latency,
   }
+  if args.max_queue is not None:
+    config['max_queue'] = args.max_queue
+  return config
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+
+  import argparse
+
+  parser = argparse.ArgumentParser(parents=[config_parser()])
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=5000)
+  parser.add_argument("--threads", type=int, default=4,
+                      help='number of threads for handling requests')
+  parser.add_argument("--workers", type=int, default=1,
+                      help='number of worker processes, each with --threads threads. '
+                           'The rate limits and quotas of the API keys are divided '
+                           'by the number of workers')
+  parser.add_argument("--develop", action='store_true',
+                      help='start in development mode (reload on code changes)')
+
+  args = parser.parse_args()
+
+  from werkzeug.serving import run_simple
+  config = config_from_args(args)
+  if args.workers > 1 and not args.develop:
+    # each worker enforces its share of the API key limits
+    config['workers'] = args.workers
   app = create_app(config)
   if args.develop:
     run_simple(args.host, args.port, app,
                extra_files=[os.path.abspath(args.mapping)],
                use_debugger=True, use_reloader=True, threaded=True)
+  elif args.workers > 1:
+    import waitress
+    from .prefork import Supervisor, bind_socket
+    sock = bind_socket(args.host, args.port)
+    log.info('serving on http://%s:%d with %d workers', args.host, args.port, args.workers)
+    Supervisor(
+      serve=lambda: waitress.serve(app, sockets=[sock], threads=args.threads),
+      workers=args.workers,
+      after_fork=app.solr.reset,
+    ).run()
   else:
     import waitress
-    waitress.serve(app, host=args.host, port=args.port)
+    waitress.serve(app, host=args.host, port=args.port, threads=args.threads)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,271 @@
+"""
+The asgi module contains the geocodr web service as ASGI application.
+
+The ASGI application uses the same request parsing, mapping and response
+building as the WSGI application in the api module, but queries Solr with
+asyncio. Waiting requests do not block a thread.
+
+Run with any ASGI server, e.g.:
+
+    GEOCODR_MAPPING=geocodr_mapping.py uvicorn --factory geocodr.asgi:app_from_env
+"""
+
+import asyncio
+import io
+import logging
+import os
+import sys
+import time
+
+from . import solr
+from .api import Geocodr, config_from_args, config_parser
+from .request import GeocodrRequest
+
+
+log = logging.getLogger(__name__)
+
+
+def asgi_environ(scope, body):
+  """
+  Build a WSGI environ for an ASGI HTTP `scope`, so that requests can be
+  parsed with GeocodrRequest.
+  """
+  server = scope.get('server') or ('localhost', 80)
+  environ = {
+    'REQUEST_METHOD': scope['method'],
+    'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+    'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+    'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+    'SERVER_NAME': server[0],
+    'SERVER_PORT': str(server[1]),
+    'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+    'CONTENT_LENGTH': str(len(body)),
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': scope.get('scheme', 'http'),
+    'wsgi.input': io.BytesIO(body),
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': False,
+    'wsgi.multiprocess': True,
+    'wsgi.run_once': False,
+  }
+  if scope.get('client'):
+    environ['REMOTE_ADDR'] = scope['client'][0]
+
+  for name, value in scope.get('headers', []):
+    name = name.decode('latin-1').upper().replace('-', '_')
+    value = value.decode('latin-1')
+    if name == 'CONTENT_TYPE':
+      environ['CONTENT_TYPE'] = value
+      continue
+    if name == 'CONTENT_LENGTH':
+      continue
+    key = 'HTTP_' + name
+    if key in environ:
+      value = environ[key] + ',' + value
+    environ[key] = value
+  return environ
+
+
+async def read_body(receive, max_length):
+  """
+  Read the request body. Returns None if the body is larger than
+  `max_length`.
+  """
+  body = []
+  length = 0
+  while True:
+    message = await receive()
+    if message['type'] == 'http.disconnect':
+      break
+    chunk = message.get('body', b'')
+    length += len(chunk)
+    if length > max_length:
+      return None
+    body.append(chunk)
+    if not message.get('more_body'):
+      break
+  return b''.join(body)
+
+
+async def send_response(send, response):
+  """
+  Send a Werkzeug `response`.
+  """
+  headers = [
+    (k.lower().encode('latin-1'), v.encode('latin-1'))
+    for k, v in response.headers.items()
+  ]
+  await send({
+    'type': 'http.response.start',
+    'status': response.status_code,
+    'headers': headers,
+  })
+  await send({
+    'type': 'http.response.body',
+    'body': response.get_data(),
+  })
+
+
+class GeocodrASGI(object):
+  """
+  GeocodrASGI serves the geocodr API of the Geocodr `app` as ASGI
+  application. Solr is queried with `solr`, an AsyncSolr instance.
+  """
+
+  def __init__(self, app, solr):
+    self.app = app
+    self.solr = solr
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      await self.lifespan(receive, send)
+      return
+    if scope['type'] != 'http':
+      return
+
+    body = await read_body(receive, GeocodrRequest.max_content_length)
+    if body is None:
+      await send({'type': 'http.response.start', 'status': 413, 'headers': []})
+      await send({'type': 'http.response.body', 'body': b''})
+      return
+
+    request = GeocodrRequest(asgi_environ(scope, body), self.app.default_params)
+    response = await self.dispatch_request(request)
+    await send_response(send, response)
+
+  async def lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        await self.solr.close()
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+  async def dispatch_request(self, request):
+    adapter = self.app.url_map.bind_to_environ(request.environ)
+    admitted = None
+    try:
+      endpoint, values = adapter.match()
+      if self.app.admission is not None:
+        await self.app.admission.acquire_async(self.app.request_lane(request))
+        admitted = time.time()
+      if endpoint == 'query':
+        return await self.on_query(request)
+      return getattr(self.app, 'on_' + endpoint)(request, **values)
+    except Exception as ex:
+      return self.app.exception_resp(request, ex)
+    finally:
+      if admitted is not None:
+        self.app.admission.release(time.time() - admitted)
+
+  async def on_query(self, request):
+    app = self.app
+    err = app.check_access(request) or app.check_req_classes(request, request.g.classes)
+    if err:
+      return err
+    if request.g.type == 'suggest':
+      return app.on_suggest(request)
+
+    etag = None
+    if app.data_versions is not None:
+      # data versions are fetched with the synchronous Solr client
+      etag = await asyncio.get_running_loop().run_in_executor(None, app.etag, request)
+    if etag and request.if_none_match.contains_weak(etag):
+      return app.not_modified(request, etag)
+
+    flow = app.search_flow(request, etag)
+    try:
+      search = next(flow)
+      while True:
+        search = flow.send(await self.execute(request, search))
+    except StopIteration as ex:
+      return ex.value
+
+  async def execute(self, request, search):
+    """
+    Query all groups of `search` concurrently. Returns an error response or
+    None.
+    """
+    app = self.app
+
+    async def query(group):
+      req = app.solr_request(request, search, group)
+      if req is None:
+        return []
+      method, kw = req
+      return search.to_features(group, await getattr(self.solr, method)(**kw))
+
+    tasks = [(g, asyncio.ensure_future(query(g))) for g in search.groups]
+    try:
+      if tasks:
+        await asyncio.wait([t for _, t in tasks], timeout=max(search.remaining(), 0))
+
+      for group, t in tasks:
+        if not t.done():
+          search.add_timeout(group)
+          continue
+        ex = t.exception()
+        if ex is None:
+          search.add_features(t.result())
+        elif isinstance(ex, solr.SolrUnauthenticatedError):
+          return app.json_error(request, 400, 'Invalid user/password')
+        elif isinstance(ex, (asyncio.TimeoutError, TimeoutError, solr.SolrTimeoutError)):
+          search.add_timeout(group)
+        else:
+          search.add_error(group, ex)
+    finally:
+      # do not wait for collections that missed the deadline
+      for _, t in tasks:
+        t.cancel()
+
+
+def create_app(config):
+  app = Geocodr(config)
+  return GeocodrASGI(app, solr.AsyncSolr(
+    config['solr_url'],
+    read_timeout=config.get('solr_timeout', 30.0),
+    hedge_percentile=config.get('solr_hedge_percentile', 95),
+    max_hedges=config.get('solr_max_hedges', 10),
+  ))
+
+
+def config_from_env(environ, prefix='GEOCODR_'):
+  """
+  Return the Geocodr configuration from the environment variables. Each
+  option of geocodr-api is read from the variable with the upper case name
+  and `prefix`, e.g. GEOCODR_SOLR_URL for --solr-url. Flags like
+  GEOCODR_EXACT_INDEX are enabled with 1.
+
+  >>> config = config_from_env({'GEOCODR_MAPPING': 'mapping.py', 'GEOCODR_EXACT_INDEX': '1',
+  ...                           'GEOCODR_TIME_BUDGET': '500', 'GEOCODR_MAX_QUEUE': '10'})
+  >>> config['mapping'], config['exact_index'], config['time_budget'], config['max_queue']
+  ('mapping.py', True, 500, 10)
+  >>> config['enable_etags'], config['solr_url']
+  (False, 'http://localhost:8983/solr')
+  """
+  parser = config_parser()
+  argv = []
+  defaults = vars(parser.parse_args(['--mapping', '']))
+  for dest, default in defaults.items():
+    value = environ.get(prefix + dest.upper())
+    if value is None:
+      continue
+    option = '--' + dest.replace('_', '-')
+    if default is False:
+      # store_true flags
+      if value == '1':
+        argv.append(option)
+    else:
+      argv.extend([option, value])
+  return config_from_args(parser.parse_args(argv))
+
+
+def app_from_env():
+  """
+  Create the ASGI application with the configuration from environment
+  variables, see config_from_env.
+  """
+  logging.basicConfig(level=logging.INFO)
+  return create_app(config_from_env(os.environ))
@@ -0,0 +1,134 @@
+"""
+The bench module sends concurrent requests to a geocodr API and reports
+throughput and latencies, e.g. to compare the WSGI and ASGI setup.
+"""
+
+import argparse
+import math
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(values, p):
+  """
+  Return the `p` percentile of `values` (nearest-rank method).
+
+  >>> percentile([0.1, 0.2, 0.3, 0.4], 50)
+  0.2
+  """
+  values = sorted(values)
+  idx = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+  return values[idx]
+
+
+def load_queries(fname):
+  queries = []
+  with open(fname, 'r') as f:
+    for line in f:
+      line = line.strip()
+      if line and not line.startswith('#'):
+        queries.append(line)
+  return queries
+
+
+class Benchmark(object):
+  """
+  Benchmark sends `requests` search requests with `concurrency` parallel
+  clients. The queries are used round-robin.
+  """
+
+  def __init__(self, url, queries, classes, requests, concurrency, params=None, timeout=60.0):
+    self.url = url.rstrip('/') + '/query'
+    self.queries = queries
+    self.classes = classes
+    self.requests = requests
+    self.concurrency = concurrency
+    self.params = params or {}
+    self.timeout = timeout
+    self._local = threading.local()
+
+  def session(self):
+    import requests
+    if not hasattr(self._local, 'session'):
+      self._local.session = requests.Session()
+    return self._local.session
+
+  def request(self, i):
+    params = {
+      'type': 'search',
+      'class': self.classes,
+      'query': self.queries[i % len(self.queries)],
+    }
+    params.update(self.params)
+    start = time.time()
+    try:
+      resp = self.session().get(self.url, params=params, timeout=self.timeout)
+      status = resp.status_code
+    except Exception:
+      status = None
+    return status, time.time() - start
+
+  def run(self):
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=self.concurrency) as e:
+      results = list(e.map(self.request, range(self.requests)))
+    duration = time.time() - start
+
+    latencies = [l for status, l in results if status == 200]
+    stats = {
+      'requests': len(results),
+      'duration': duration,
+      'throughput': len(results) / duration,
+      'ok': len(latencies),
+      'errors': {},
+    }
+    for status, _ in results:
+      if status != 200:
+        stats['errors'][status] = stats['errors'].get(status, 0) + 1
+    if latencies:
+      for p in (50, 95, 99):
+        stats['p{}'.format(p)] = percentile(latencies, p)
+    return stats
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Send concurrent search requests to a geocodr API.',
+  )
+  parser.add_argument("--url", default="http://localhost:5000",
+                      help='URL of the geocodr API')
+  parser.add_argument("--queries", required=True, help='file with one query per line')
+  parser.add_argument("--class", dest='classes', default='address',
+                      help='comma separated classes to search for')
+  parser.add_argument("--requests", type=int, default=1000, help='number of requests')
+  parser.add_argument("--concurrency", type=int, default=50,
+                      help='number of concurrent requests')
+  parser.add_argument("--key", help='optional: API key')
+
+  args = parser.parse_args()
+
+  params = {}
+  if args.key:
+    params['key'] = args.key
+
+  stats = Benchmark(
+    args.url,
+    load_queries(args.queries),
+    args.classes,
+    requests=args.requests,
+    concurrency=args.concurrency,
+    params=params,
+  ).run()
+
+  print('{requests} requests in {duration:.2f}s, {throughput:.1f} requests/s'.format(**stats))
+  if stats['ok']:
+    print('latency p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms'.format(
+      stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000))
+  for status, count in sorted(stats['errors'].items(), key=lambda x: str(x[0])):
+    print('{} requests failed with status {}'.format(count, status))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,162 @@
+"""
+The cache module provides an LRU cache, data versions of all collections
+and ETags for HTTP caching.
+"""
+
+import json
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from hashlib import sha1
+
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+  """
+  LRUCache is a thread-safe cache that keeps the `maxsize` most recently
+  used values.
+
+  >>> c = LRUCache(2)
+  >>> c.set('a', 1); c.set('b', 2); c.get('a')
+  1
+  >>> c.set('c', 3); c.get('b') is None
+  True
+  """
+
+  def __init__(self, maxsize=10000):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      try:
+        value = self._data[key]
+      except KeyError:
+        self.misses += 1
+        return None
+      self._data.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def set(self, key, value):
+    with self._lock:
+      self._data[key] = value
+      self._data.move_to_end(key)
+      if len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+
+  def __len__(self):
+    return len(self._data)
+
+  def stats(self):
+    return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+class DataVersions(object):
+  """
+  DataVersions tracks the data version of each collection. The version
+  consists of the collection that the alias points to, the number of
+  documents and the newest document version. It changes with each import
+  from geocodr-post. Versions are refreshed after `ttl` seconds.
+  """
+
+  def __init__(self, solr, ttl=60.0):
+    self.solr = solr
+    self.ttl = ttl
+    self.versions = {}
+    self._lock = threading.Lock()
+
+  def refresh(self, names):
+    try:
+      aliases = self.solr.aliases()
+    except Exception:
+      log.exception('fetching Solr aliases')
+      aliases = {}
+    now = time.monotonic()
+    for name in names:
+      try:
+        version = data_version(self.solr, name, aliases)
+      except Exception:
+        log.exception("fetching data version of collection '%s'", name)
+        version = None
+      self.versions[name] = (version, now)
+
+  def get(self, names):
+    """
+    Return the versions of all collection `names`. Returns None if a version
+    is unknown.
+    """
+    now = time.monotonic()
+    stale = [n for n in names
+             if n not in self.versions or now - self.versions[n][1] > self.ttl]
+    # only one thread refreshes, all others use the previous versions
+    if stale and self._lock.acquire(blocking=False):
+      try:
+        self.refresh(stale)
+      finally:
+        self._lock.release()
+
+    versions = []
+    for name in names:
+      version, _ = self.versions.get(name, (None, None))
+      if version is None:
+        return None
+      versions.append(version)
+    return versions
+
+
+def data_version(solr, name, aliases):
+  """
+  Return the data version of the collection `name`. `aliases` maps Solr
+  aliases to their collections.
+  """
+  resp = solr.query(
+    collection=name,
+    q='*:*',
+    rows=1,
+    sort='_version_ desc',
+    fl='_version_',
+  )
+  docs = resp['response']['docs']
+  return '{}:{}:{}'.format(
+    aliases.get(name, name),
+    resp['response']['numFound'],
+    docs[0].get('_version_') if docs else 0,
+  )
+
+
+def request_key(request, ignore=('key', )):
+  """
+  Return a key for all parameters that affect the response of the request.
+  The API key is ignored, as it does not change the response.
+  """
+  if request.json:
+    params = dict(request.json)
+  else:
+    params = dict(request.args.items())
+  if request.json and 'callback' in request.args:
+    params['callback'] = request.args['callback']
+  params['gzip'] = 'gzip' in request.accept_encodings
+  for name in ignore:
+    params.pop(name, None)
+  return json.dumps(params, sort_keys=True)
+
+
+def make_etag(key, versions):
+  """
+  Return the (unquoted) ETag for the request `key` and the data `versions`.
+
+  >>> make_etag('{"query": "x"}', ['streets-1:10:1'])
+  '00bbfac2e2307a7bbbf4c89f'
+  """
+  h = sha1(key.encode('utf-8'))
+  for v in versions:
+    h.update(b'\0' + v.encode('utf-8'))
+  return h.hexdigest()[:24]
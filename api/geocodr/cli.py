@@ -67,6 +67,11 @@ def main():
     help='name of the collection classes '
          '(all collections from --mapping are searched if not set)',
   )
+  parser.add_argument(
+    "--describe",
+    action='store_true',
+    help='print the query fields of each collection and the query for all terms and exit',
+  )
   parser.add_argument("query")
 
   args = parser.parse_args()
@@ -75,6 +80,16 @@ def main():
 
   collections = load_collections(args.mapping)
 
+  if args.describe:
+    for collection in collections:
+      if args.classes and collection.class_ not in args.classes:
+        continue
+      print(collection.describe())
+      for term in solr.strip_special_chars(args.query).split(' '):
+        if term:
+          print(collection.describe(term))
+    return
+
   query_kw = {}
   if args.debug or args.explain:
     query_kw['debugQuery'] = 'on'
@@ -0,0 +1,191 @@
+"""
+The exact module provides an in-memory index of the titles of all
+documents, to answer queries for complete titles without Solr.
+"""
+
+import json
+import logging
+import threading
+import time
+
+from .cache import data_version
+from .search import GermanNGramField
+from .solr import strip_special_chars
+
+
+log = logging.getLogger(__name__)
+
+_german = GermanNGramField(None)
+
+
+def normalize_title(title):
+  """
+  Normalize `title` for exact matches. Special characters, periods and case
+  are ignored and German characters are normalized like in GermanNGramField.
+
+  >>> normalize_title('Rostock, Alfred-Schulze-Straße 12')
+  'rostock alfred schulze strasse 12'
+  >>> normalize_title('rostock alfred schulze str.  12')
+  'rostock alfred schulze str 12'
+  """
+  return _german.normalize_german(strip_special_chars(title.lower().replace('.', ' ')))
+
+
+def doc_title(collection, doc):
+  """
+  Return the title of the Solr `doc`, see Collection.to_title.
+  """
+  prop = {}
+  if collection.jsonblob_field:
+    prop = json.loads(doc[collection.jsonblob_field])
+  for f in collection.fields:
+    prop[f] = doc.get(f)
+  return collection.to_title(prop)
+
+
+def doc_fields(collection):
+  """
+  Return all fields of a Solr doc that are required for
+  Collection.to_features.
+  """
+  fields = {'id', 'score', collection.geometry_field}
+  if collection.jsonblob_field:
+    fields.add(collection.jsonblob_field)
+  fields.update(collection.fields)
+  fields.update(collection.sort_fields)
+  return fields
+
+
+class ExactIndex(object):
+  """
+  ExactIndex maps the normalized titles of all documents to the documents,
+  for all collections with `exact_index` enabled. Collections with more
+  than `max_docs` documents are not indexed.
+
+  The index of a collection is rebuilt in a background thread if the data
+  version (alias, number of documents and newest document) changed. The
+  versions are checked after `ttl` seconds.
+  """
+
+  # Collection attribute that enables the index
+  collection_attr = 'exact_index'
+  description = 'exact index'
+
+  def __init__(self, solr, collections, max_docs=200000, ttl=60.0, rows=1000):
+    self.solr = solr
+    self.collections = [c for c in collections if getattr(c, self.collection_attr)]
+    self.max_docs = max_docs
+    self.ttl = ttl
+    self.rows = rows
+    # collection name -> normalized title -> docs
+    self.titles = {}
+    self.versions = {}
+    self.checked = None
+    self._lock = threading.Lock()
+
+  def iter_docs(self, collection, fl):
+    """
+    Yield all documents of `collection` with the fields `fl`.
+    """
+    cursor = '*'
+    while True:
+      resp = self.solr.query(
+        collection=collection.name,
+        q='*:*',
+        sort='id asc',
+        fl=fl,
+        rows=self.rows,
+        cursorMark=cursor,
+      )
+      for doc in resp['response']['docs']:
+        yield doc
+
+      next_cursor = resp.get('nextCursorMark')
+      if not next_cursor or next_cursor == cursor:
+        return
+      cursor = next_cursor
+
+  def build(self, collection):
+    """
+    Fetch all documents of `collection` from Solr and return the titles.
+    Returns None if the collection has too many documents.
+    """
+    fields = doc_fields(collection)
+    titles = {}
+    for num, doc in enumerate(self.iter_docs(collection, collection.field_list), 1):
+      if num > self.max_docs:
+        log.warning("Collection '%s' has more than %d documents, not building %s",
+                    collection.name, self.max_docs, self.description)
+        return None
+      doc = dict((k, v) for k, v in doc.items() if k in fields)
+      doc['score'] = 1.0
+      titles.setdefault(normalize_title(doc_title(collection, doc)), []).append(doc)
+    return titles
+
+  def refresh(self):
+    """
+    Rebuild the index of all collections with a new data version.
+    """
+    try:
+      aliases = self.solr.aliases()
+    except Exception:
+      log.exception('fetching Solr aliases')
+      aliases = {}
+    for c in self.collections:
+      try:
+        version = data_version(self.solr, c.name, aliases)
+        if version == self.versions.get(c.name):
+          continue
+        start = time.time()
+        titles = self.build(c)
+      except Exception:
+        log.exception("building %s of collection '%s'", self.description, c.name)
+        continue
+      if titles is None:
+        self.titles.pop(c.name, None)
+      else:
+        self.titles[c.name] = titles
+        log.info("Built %s of collection '%s' with %d titles in %.1fs",
+                 self.description, c.name, len(titles), time.time() - start)
+      self.versions[c.name] = version
+    self.checked = time.monotonic()
+
+  def refresh_if_stale(self):
+    """
+    Start a refresh in the background after `ttl` seconds. Lookups use the
+    previous index until the refresh is done.
+    """
+    if self.checked is not None and time.monotonic() - self.checked <= self.ttl:
+      return
+    # only one thread refreshes
+    if not self._lock.acquire(blocking=False):
+      return
+
+    def refresh():
+      try:
+        self.refresh()
+      finally:
+        self._lock.release()
+
+    threading.Thread(target=refresh, name='geocodr-' + self.collection_attr, daemon=True).start()
+
+  def lookup(self, collections, query):
+    """
+    Return (collection, docs) for all documents of `collections` with the
+    title `query`. Returns None if one of the collections is not indexed,
+    as the exact matches would be incomplete.
+    """
+    self.refresh_if_stale()
+    title = normalize_title(query)
+    hits = []
+    for c in collections:
+      titles = self.titles.get(c.name)
+      if titles is None:
+        return None
+      docs = titles.get(title)
+      if docs:
+        hits.append((c, docs))
+    return hits
+
+  def stats(self):
+    return dict((name, len(titles)) for name, titles in self.titles.items())
@@ -8,11 +8,25 @@ class FeatureCollection(object):
     self.features = []
     self.total_features = 0
     self.offset = 0
+    # collections without results (e.g. after a timeout) and collections
+    # with incomplete results
+    self.skipped_collections = []
+    self.incomplete_collections = []
 
   def add_features(self, features):
     self.features.extend(features)
     self.total_features += len(features)
 
+  def add_skipped(self, collection):
+    self.skipped_collections.append(collection)
+
+  def add_incomplete(self, collection):
+    self.incomplete_collections.append(collection)
+
+  @property
+  def is_partial(self):
+    return bool(self.skipped_collections or self.incomplete_collections)
+
   def sort(self, limit=0, offset=0, distance=False):
     """
     Sort all features in-place by _score_ and _sort_tiebreaker_ property.
@@ -46,12 +60,17 @@ class FeatureCollection(object):
           del prop[k]
 
   def as_mapping(self):
+    prop = {
+      'features_total': self.total_features,
+      'features_returned': len(self.features),
+      'features_offset': self.offset,
+    }
+    if self.is_partial:
+      prop['partial'] = True
+      prop['skipped_collections'] = sorted(self.skipped_collections)
+      prop['incomplete_collections'] = sorted(self.incomplete_collections)
     return {
       'type': 'FeatureCollection',
       'features': self.features,
-      'properties': {
-        'features_total': self.total_features,
-        'features_returned': len(self.features),
-        'features_offset': self.offset,
-      },
+      'properties': prop,
     }
@@ -1,14 +1,151 @@
 import csv
+import datetime
+import logging
+import math
+import os
+import threading
+import time
 
+from hashlib import sha1
 from urllib.parse import urlparse
 
+from .admission import BULK, INTERACTIVE
 from .request import RequestError
 
 
+log = logging.getLogger(__name__)
+
+
+class LimitExceeded(Exception):
+  def __init__(self, reason, retry_after):
+    Exception.__init__(self, reason)
+    self.reason = reason
+    self.retry_after = retry_after
+
+
+class KeyConfig(object):
+  """
+  Permitted domains, optional limits and the admission lane of a single
+  API key.
+  """
+
+  def __init__(self, domains=None, rate=None, burst=None, daily_quota=None, name=None,
+               priority=INTERACTIVE):
+    self.domains = domains
+    self.rate = rate
+    self.burst = burst if burst is not None else rate
+    if rate is not None:
+      # a bucket with less than one token would reject all requests
+      self.burst = max(self.burst, 1)
+    self.daily_quota = daily_quota
+    self.name = name
+    self.priority = priority
+
+
+class KeyUsage(object):
+  """
+  Token bucket, daily quota counter and metrics of a single API key.
+  """
+  __slots__ = ('tokens', 'updated', 'day', 'used', 'requests', 'rate_limited',
+               'quota_exceeded')
+
+  def __init__(self, tokens):
+    self.tokens = tokens
+    self.updated = time.monotonic()
+    self.day = datetime.date.today()
+    self.used = 0
+    self.requests = 0
+    self.rate_limited = 0
+    self.quota_exceeded = 0
+
+
+def key_label(key, conf):
+  """
+  Label of the key for metrics. Uses the name of the key or a hash, so
+  that the key itself is never exposed.
+
+  >>> key_label('secret', KeyConfig(name='example'))
+  'example'
+  >>> key_label('secret', KeyConfig())
+  'e5e9fa1b'
+  """
+  if conf.name:
+    return conf.name
+  return sha1(key.encode('utf-8')).hexdigest()[:8]
+
+
+def seconds_until_tomorrow():
+  now = datetime.datetime.now()
+  tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1),
+                                       datetime.time())
+  return int((tomorrow - now).total_seconds()) + 1
+
+
+def parse_priority(row):
+  """
+  Admission lane of the `priority` column, interactive by default.
+
+  >>> parse_priority({'priority': ' bulk'})
+  'bulk'
+  >>> parse_priority({})
+  'interactive'
+  """
+  value = (row.get('priority') or '').strip() or INTERACTIVE
+  if value not in (INTERACTIVE, BULK):
+    raise ValueError("invalid priority '{}' for key '{}'".format(value, row['key']))
+  return value
+
+
+def parse_number(row, column, type_=float):
+  value = (row.get(column) or '').strip()
+  if not value:
+    return None
+  return type_(value)
+
+
+def worker_share(value, workers, type_=float):
+  """
+  Share of a limit for each of `workers` processes.
+
+  >>> worker_share(10.0, 4)
+  2.5
+  >>> worker_share(10, 4, int)
+  3
+  >>> worker_share(None, 4) is None
+  True
+  """
+  if value is None or workers <= 1:
+    return value
+  if type_ is int:
+    return int(math.ceil(value / workers))
+  return value / workers
+
+
 class APIKeys(object):
-  def __init__(self, fname):
+  """
+  APIKeys checks API keys and their domains from a CSV file. Keys can have
+  optional limits in the `rate` (requests per second), `burst` and
+  `daily_quota` columns. Limits are enforced for each process, each of
+  the `workers` processes enforces its share of the configured limits. The
+  optional `priority` column assigns the key to the `interactive` (default)
+  or `bulk` admission lane.
+
+  The CSV file is reloaded if it was modified, but at most every
+  `check_interval` seconds.
+  """
+
+  # number of locks for the usage of all keys
+  lock_stripes = 16
+
+  def __init__(self, fname, check_interval=1.0, workers=1):
     self.fname = fname
+    self.workers = workers
+    self.check_interval = check_interval
+    self._mtime = os.stat(fname).st_mtime
+    self._checked = time.monotonic()
     self.keys = self._load()
+    self.usage = {}
+    self._locks = [threading.Lock() for _ in range(self.lock_stripes)]
 
   def _load(self):
     keys = {}
@@ -21,18 +158,52 @@ class APIKeys(object):
         domains = row['domains'].strip().split(';')
         if domains == ['']:
           domains = None  # wildcard
-        keys[key] = domains
+        keys[key] = KeyConfig(
+          domains=domains,
+          rate=worker_share(parse_number(row, 'rate'), self.workers),
+          burst=worker_share(parse_number(row, 'burst'), self.workers),
+          daily_quota=worker_share(parse_number(row, 'daily_quota', int), self.workers, int),
+          name=(row.get('name') or '').strip() or None,
+          priority=parse_priority(row),
+        )
     return keys
 
+  def reload_if_modified(self):
+    now = time.monotonic()
+    if now - self._checked < self.check_interval:
+      return
+    self._checked = now
+    try:
+      mtime = os.stat(self.fname).st_mtime
+      if mtime == self._mtime:
+        return
+      self.keys = self._load()
+      self._mtime = mtime
+      log.info('reloaded API keys from %s', self.fname)
+    except Exception:
+      log.exception('reloading API keys from %s', self.fname)
+
+  def priority(self, key):
+    """
+    Admission lane of `key`. Unknown keys are rejected later by
+    `is_permitted`.
+    """
+    conf = self.keys.get(key)
+    if conf is None:
+      return INTERACTIVE
+    return conf.priority
+
   def is_permitted(self, request):
     if 'key' not in request.args:
       raise RequestError("Missing 'key' parameter")
     key = request.args['key']
 
+    self.reload_if_modified()
+
     if key not in self.keys:
       return False
 
-    domains = self.keys[key]
+    domains = self.keys[key].domains
     if not domains:
       # empty domains for "wildcard" permission
       return True
@@ -58,3 +229,58 @@ class APIKeys(object):
       return True
 
     return False
+
+  def consume(self, request):
+    """
+    Count the request for the rate limit and daily quota of its key.
+    Raises LimitExceeded if the key has no tokens or quota left.
+    """
+    key = request.args['key']
+    conf = self.keys.get(key)
+    if conf is None:
+      return
+
+    with self._locks[hash(key) % self.lock_stripes]:
+      usage = self.usage.get(key)
+      if usage is None:
+        usage = self.usage[key] = KeyUsage(conf.burst or 0)
+      usage.requests += 1
+
+      if conf.daily_quota is not None:
+        today = datetime.date.today()
+        if usage.day != today:
+          usage.day = today
+          usage.used = 0
+        if usage.used >= conf.daily_quota:
+          usage.quota_exceeded += 1
+          raise LimitExceeded('Daily quota exceeded.', seconds_until_tomorrow())
+
+      if conf.rate:
+        now = time.monotonic()
+        usage.tokens = min(usage.tokens + (now - usage.updated) * conf.rate, conf.burst)
+        usage.updated = now
+        if usage.tokens < 1:
+          usage.rate_limited += 1
+          retry_after = max(int((1 - usage.tokens) / conf.rate + 0.999), 1)
+          raise LimitExceeded('Rate limit exceeded.', retry_after)
+        usage.tokens -= 1
+
+      usage.used += 1
+
+  def metrics(self):
+    """
+    Return the request counters for all used keys, labeled by key name.
+    """
+    metrics = {}
+    for key, usage in list(self.usage.items()):
+      conf = self.keys.get(key)
+      if conf is None:
+        continue
+      metrics[key_label(key, conf)] = {
+        'requests': usage.requests,
+        'rate_limited': usage.rate_limited,
+        'quota_exceeded': usage.quota_exceeded,
+        'quota_used': usage.used,
+        'daily_quota': conf.daily_quota,
+      }
+    return metrics
@@ -180,3 +180,30 @@ def parse_flst(token, gemarkung_prefix=None):
 
   # check long format
   return check(token, flst_re)
+
+
+def flst_key(f):
+  """
+  Return the normalized key (Gemarkung, Flur, Zähler and Nenner) of the
+  parsed parcel identification `f`. Incomplete identifications return the
+  key prefix. Returns None without Gemarkung number, or if a part is
+  missing in between.
+
+  >>> flst_key(parse_flst("123456-56-1/2"))
+  '123456056000010002'
+  >>> flst_key(parse_flst("123456 flur 56"))
+  '123456056'
+  >>> flst_key(parse_flst("Krummendorf 1 157")) is None
+  True
+  >>> flst_key(parse_flst("1234,157/1", gemarkung_prefix='13')) is None
+  True
+  """
+  if f is None or not f.gemarkung:
+    return None
+  key = f.gemarkung
+  parts = [f.flur, f.zaehler, f.nenner]
+  while parts and parts[0]:
+    key += parts.pop(0)
+  if any(parts):
+    return None
+  return key
@@ -7,10 +7,11 @@ import inspect
 from .search import Collection
 
 
-def load_collections(fname):
+def load_collections(fname, term_cache_size=10000):
   """
   Open a geocodr mapping file and return all geocodr.search.Collection
-  subclasses.
+  subclasses. Each collection caches the queries of up to
+  `term_cache_size` terms (0 to disable).
   """
   collections = []
   with open(fname, 'r') as f:
@@ -34,4 +35,8 @@ def load_collections(fname):
         src_proj = coll.src_proj
       collections.append(coll)
 
+  if term_cache_size:
+    for coll in collections:
+      coll.enable_term_cache(term_cache_size)
+
   return collections
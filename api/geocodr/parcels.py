@@ -0,0 +1,79 @@
+"""
+The parcels module provides the in-memory parcel key index for
+ParcelCollections.
+"""
+
+import logging
+import os
+import time
+
+from array import array
+from bisect import bisect_left
+
+from .search import ParcelCollection
+
+
+log = logging.getLogger(__name__)
+
+KEY_LENGTH = 18
+
+
+class FlstIndex(object):
+  """
+  FlstIndex maps the 18 digit parcel keys (see lib.flst.flst_key) to the
+  document IDs. The keys are stored as sorted integers, so that complete
+  keys and key prefixes are both resolved with a binary search.
+
+  >>> idx = FlstIndex([('132232001001230001', 'a'), ('132232001001240000', 'b')])
+  >>> idx.lookup('132232001001230001')
+  ['a']
+  >>> idx.lookup('1322320010012')
+  ['a', 'b']
+  >>> idx.lookup('132233')
+  []
+  """
+
+  def __init__(self, entries):
+    entries = sorted((int(key), id) for key, id in entries)
+    self.keys = array('Q', (key for key, _ in entries))
+    self.ids = [id for _, id in entries]
+
+  @classmethod
+  def load(cls, fname):
+    """
+    Load the index file from geocodr-flst-index (key and ID per line).
+    """
+    with open(fname, 'r') as f:
+      return cls(line.rstrip('\n').split('\t', 1) for line in f if line.strip())
+
+  def __len__(self):
+    return len(self.keys)
+
+  def lookup(self, key, max_results=1000):
+    """
+    Return the IDs of all parcels that start with the (partial) `key`.
+    """
+    scale = 10 ** (KEY_LENGTH - len(key))
+    lo = bisect_left(self.keys, int(key) * scale)
+    hi = bisect_left(self.keys, (int(key) + 1) * scale)
+    return self.ids[lo:min(hi, lo + max_results)]
+
+
+def load_parcel_index(index_dir, collections):
+  """
+  Load the FlstIndex of all ParcelCollections from `index_dir`. Returns a
+  dict with the collection name and the index.
+  """
+  index = {}
+  for c in collections:
+    if not isinstance(c, ParcelCollection):
+      continue
+    fname = os.path.join(index_dir, c.name + '.flst')
+    if not os.path.exists(fname):
+      log.warning("Missing parcel index '%s' for collection '%s'", fname, c.name)
+      continue
+    start = time.time()
+    index[c.name] = FlstIndex.load(fname)
+    log.info("Loaded parcel index of collection '%s' with %d keys in %.1fs",
+             c.name, len(index[c.name]), time.time() - start)
+  return index
@@ -0,0 +1,127 @@
+"""
+The prefork module runs multiple worker processes that share one
+listening socket.
+"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+def bind_socket(host, port, backlog=1024):
+  """
+  Create a listening socket that is inherited by all worker processes.
+  """
+  family, type_, proto, _, addr = socket.getaddrinfo(
+    host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+  sock = socket.socket(family, type_, proto)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  sock.bind(addr)
+  sock.listen(backlog)
+  sock.set_inheritable(True)
+  return sock
+
+
+class Supervisor(object):
+  """
+  Supervisor forks `workers` processes that call `serve`. Workers that
+  exit are restarted after `restart_delay` seconds. SIGTERM and SIGINT
+  stop all workers, and workers that are still running after
+  `graceful_timeout` seconds are killed.
+
+  Everything that is loaded before `run` is shared copy-on-write with the
+  workers. `after_fork` is called in each worker before `serve`, e.g. to
+  create new connection pools.
+  """
+
+  def __init__(self, serve, workers, after_fork=None, restart_delay=1.0,
+               graceful_timeout=10.0):
+    self.serve = serve
+    self.workers = workers
+    self.after_fork = after_fork
+    self.restart_delay = restart_delay
+    self.graceful_timeout = graceful_timeout
+    self.children = set()
+    self.running = False
+
+  def spawn(self):
+    pid = os.fork()
+    if pid:
+      self.children.add(pid)
+      log.info('started worker %d', pid)
+      return pid
+
+    # worker process
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+      if self.after_fork:
+        self.after_fork()
+      self.serve()
+    except KeyboardInterrupt:
+      pass
+    except Exception:
+      log.exception('worker %d failed', os.getpid())
+      code = 1
+    finally:
+      os._exit(code)
+
+  def stop(self, signum=None, frame=None):
+    self.running = False
+    self.kill(signal.SIGTERM)
+
+  def kill(self, sig):
+    for pid in list(self.children):
+      try:
+        os.kill(pid, sig)
+      except OSError as ex:
+        if ex.errno != errno.ESRCH:
+          raise
+
+  def reap(self, block=True):
+    """
+    Wait for exited workers. Returns the pid of an exited worker or None.
+    """
+    try:
+      pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+    except ChildProcessError:
+      self.children.clear()
+      return None
+    if not pid:
+      return None
+    self.children.discard(pid)
+    if self.running:
+      log.warning('worker %d exited with status %d', pid, status)
+    return pid
+
+  def run(self):
+    self.running = True
+    signal.signal(signal.SIGTERM, self.stop)
+    signal.signal(signal.SIGINT, self.stop)
+
+    for _ in range(self.workers):
+      self.spawn()
+
+    while self.running:
+      if self.reap() and self.running:
+        # delay restarts to prevent busy loops of failing workers
+        time.sleep(self.restart_delay)
+        if self.running:
+          self.spawn()
+
+    deadline = time.time() + self.graceful_timeout
+    while self.children and time.time() < deadline:
+      if not self.reap(block=False):
+        time.sleep(0.1)
+    if self.children:
+      log.warning('killing %d workers', len(self.children))
+      self.kill(signal.SIGKILL)
+      while self.children:
+        self.reap()
@@ -13,6 +13,10 @@ from .search import SpatialFilter
 from .solr import strip_special_chars
 
 
+# maximum number of parcels for bulk requests
+MAX_PARCELS = 1000
+
+
 class RequestError(Exception):
   def __init__(self, reason):
     self.reason = reason
@@ -22,9 +26,12 @@ class RequestError(Exception):
 
 
 class DefaultRequestParams(object):
-  def __init__(self, data_proj=proj.epsg(25833), reverse_radius=50):
+  def __init__(self, data_proj=proj.epsg(25833), reverse_radius=50, time_budget=10000,
+               max_time_budget=30000):
     self.data_proj = data_proj
     self.reverse_radius = reverse_radius
+    self.time_budget = time_budget
+    self.max_time_budget = max_time_budget
 
 
 class GeocodrParams(object):
@@ -40,13 +47,33 @@ class GeocodrParams(object):
 
   @cached_property
   def query(self):
+    if self.components or self.parcels:
+      # structured and bulk parcel requests do not require a free-text query
+      query = strip_special_chars(self.params.get('query', None) or '')
+      return query or None
     return strip_special_chars(self.params.get('query'))
 
+  @cached_property
+  def components(self):
+    """
+    Structured query components (e.g. street, postcode) as dict. Empty
+    components are ignored.
+    """
+    components = {}
+    for name, value in self.params.components().items():
+      if not isinstance(value, str):
+        raise RequestError("Invalid value for component '{}'.".format(name))
+      value = strip_special_chars(value)
+      if value:
+        components[name] = value
+    return components
+
   @cached_property
   def type(self):
     t = self.params.get('type')
-    if t not in ('search', 'reverse'):
-      raise RequestError("Invalid request type. Supported: search or reverse. Got: '{}'".format(t))
+    if t not in ('search', 'reverse', 'suggest'):
+      raise RequestError(
+        "Invalid request type. Supported: search, reverse or suggest. Got: '{}'".format(t))
     return t
 
   @cached_property
@@ -68,12 +95,56 @@ class GeocodrParams(object):
 
   @cached_property
   def limit(self):
-    return max(int(self.params.get('limit', default=100)), 1)
+    # bulk requests return all requested parcels by default
+    default = max(len(self.parcels), 100)
+    return max(int(self.params.get('limit', default=default)), 1)
 
   @cached_property
   def offset(self):
     return max(int(self.params.get('offset', default=0)), 0)
 
+  @cached_property
+  def time_budget(self):
+    """
+    Time budget for this request in ms. Clients can request a different
+    budget up to max_time_budget.
+    """
+    budget = int(self.params.get('timeout', default=self.defaults.time_budget))
+    return min(max(budget, 1), self.defaults.max_time_budget)
+
+  @cached_property
+  def priority(self):
+    priority = self.params.get('priority', default='interactive')
+    if priority not in ('interactive', 'bulk'):
+      raise RequestError(
+        "Invalid priority value. Supported: interactive or bulk. Got: '{}'".format(priority))
+    return priority
+
+  @cached_property
+  def parcels(self):
+    """
+    List of parcel identifications for bulk requests. GET requests separate
+    the parcels with semicolons.
+    """
+    parcels = self.params.get('parcels', default=None)
+    if parcels is None:
+      return []
+    if isinstance(parcels, str):
+      parcels = parcels.split(';')
+    if not isinstance(parcels, list) or not all(isinstance(p, str) for p in parcels):
+      raise RequestError("Parameter 'parcels' needs to be a list of strings.")
+    parcels = [p.strip() for p in parcels if p.strip()]
+    if len(parcels) > MAX_PARCELS:
+      raise RequestError('Too many parcels. Maximum is {}.'.format(MAX_PARCELS))
+    return parcels
+
+  @cached_property
+  def session(self):
+    """
+    Optional token of the client session for consecutive typeahead queries.
+    """
+    return self.params.get('session', default=None)
+
   @cached_property
   def classes(self):
     return self.params.get('class').split(',')
@@ -159,6 +230,12 @@ class JSONParams(object):
     else:
       return self.doc.get(key, default)
 
+  def components(self):
+    components = self.doc.get('components', {})
+    if not isinstance(components, dict):
+      raise RequestError("Parameter 'components' needs to be an object.")
+    return components
+
 
 class GETParams(object):
   restricted_params = {'user', 'password'}
@@ -180,6 +257,12 @@ class GETParams(object):
     else:
       return self.args.get(key, default)
 
+  def components(self):
+    return dict(
+      (k[len('components.'):], v) for k, v in self.args.items()
+      if k.startswith('components.')
+    )
+
 
 class GeocodrRequest(Request):
   # accept up to 4MB of transmitted data.
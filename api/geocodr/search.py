@@ -8,6 +8,8 @@ import shapely.geometry
 import shapely.wkt
 
 from . import proj
+from .cache import LRUCache
+from .lib.flst import flst_key, parse_flst
 from .lib.geom import point_on_geom
 
 
@@ -41,6 +43,37 @@ class Collection(object):
   # min length of accepted query string
   min_query_length = 3
 
+  # qfields that need to return a query for at least one term. The
+  # collection is not queried otherwise (e.g. a house number field).
+  required_qfields = ()
+
+  # qfields for each component of structured requests (e.g. 'street' or
+  # 'postcode'). Terms of a component are only searched in these fields.
+  # Collections without a requested component are not queried.
+  components = {}
+
+  # stored field with the collection name of each document. Collections of
+  # the same class with the same source_field, sort and field_list are
+  # queried with a single request if multi collection queries are enabled.
+  # All these collections need the same schema.
+  source_field = None
+
+  # keep the titles of all documents in memory to answer exact queries
+  # without Solr (requires the --exact-index option).
+  exact_index = False
+
+  # keep the titles of all documents in memory for type=suggest requests
+  # (requires the --suggest-index option).
+  suggest_index = False
+
+  # keep the words of all titles in memory to correct misspelled queries
+  # without results (requires the --spell-index option).
+  spell_index = False
+
+  # TermCache with the queries of recently searched terms, see
+  # enable_term_cache()
+  term_cache = None
+
   class_title_attrib = '_class_title_'
   collection_title_attrib = '_collection_title_'
   distance_attrib = '_distance_'
@@ -128,19 +161,89 @@ class Collection(object):
     implementation detects that the value should only be searched in one
     field, e.g. a housnumber or zipcode).
     """
-    parts = []
-    for f in self.qfields:
-      part = f.query(term)
-      if not part:
+    return fields_query(self.qfields, term)
+
+  def component_queries_for_term(self, component, term):
+    """
+    Build queries for `term` of the structured `component`. The term is
+    only searched in the qfields of the component.
+    """
+    return fields_query(self.components[component], term)
+
+  def skip_reason(self, query, components=None):
+    """
+    Return why this collection can not return any result for `query` and
+    the structured `components`, or None if it needs to be queried.
+    Collections are skipped if the query is too short, if a term returns no
+    query for any qfield, if a component is missing, or if a
+    `required_qfields` returns no query for all terms.
+    """
+    terms = []
+    if query is not None:
+      if len(query.strip()) < self.min_query_length:
+        return 'query shorter than {} characters'.format(self.min_query_length)
+      terms = [t for t in query.split(' ') if t]
+      for term in terms:
+        if not self.cached_queries_for_term(term):
+          return "no query for term '{}'".format(term)
+
+    component_terms = {}
+    for name, value in sorted((components or {}).items()):
+      if name not in self.components:
+        return "no component '{}'".format(name)
+      component_terms[name] = [t for t in value.split(' ') if t]
+      for term in component_terms[name]:
+        if not self.cached_component_queries_for_term(name, term):
+          return "no query for {} term '{}'".format(name, term)
+
+    for f in self.required_qfields:
+      if any(f.query(term) for term in terms):
         continue
-      parts.append(part)
+      if any(f in self.components[name] and any(f.query(term) for term in ts)
+             for name, ts in component_terms.items()):
+        continue
+      return 'no query for required field {}'.format(f.describe())
+    return None
 
-    # Only use exclusive parts (fields wrapped with Only) if at least one
-    # part is marked as exclusive.
-    if any(is_exclusive(part) for part in parts):
-      parts = [p for p in parts if is_exclusive(p)]
+  def enable_term_cache(self, maxsize=10000):
+    """
+    Memoize the queries of up to `maxsize` terms for `query` and
+    `skip_reason`.
+    """
+    self.term_cache = TermCache(self, maxsize)
+    return self.term_cache
+
+  def cached_queries_for_term(self, term):
+    if self.term_cache is None:
+      return self.queries_for_term(term)
+    return self.term_cache.queries_for_term(term)
 
-    return ' OR '.join(parts)
+  def cached_component_queries_for_term(self, component, term):
+    if self.term_cache is None:
+      return self.component_queries_for_term(component, term)
+    return self.term_cache.component_queries_for_term(component, term)
+
+  def describe(self, term=None):
+    """
+    Return a description of all query fields, and the query for `term`.
+    """
+    lines = ['{} ({}):'.format(self.name, self.class_)]
+    if term is not None:
+      lines = ['{} ({}), term {!r}:'.format(self.name, self.class_, term)]
+    for f in self.qfields:
+      if term is None:
+        lines.append('  ' + f.describe())
+      else:
+        lines.append('  {} => {}'.format(f.describe(), f.query(term)))
+    for name, fields in sorted(self.components.items()):
+      lines.append('  component {}: {}'.format(name, ', '.join(f.describe() for f in fields)))
+    for f in self.required_qfields:
+      lines.append('  required: ' + f.describe())
+    if self.term_cache is None or not self.term_cache.memoize:
+      lines.append('  (terms are not memoized)')
+    if term is not None:
+      lines.append('  query: ' + self.queries_for_term(term))
+    return '\n'.join(lines)
 
   def query(self, query):
     qparts = []
@@ -149,10 +252,106 @@ class Collection(object):
         continue
       qparts.append(
         '_query_:"{{!maxscore tie=0}}({})"'.format(
-          self.queries_for_term(term))
+          self.cached_queries_for_term(term))
       )
     return '{}'.format(' AND '.join(qparts))
 
+  def query_components(self, components):
+    """
+    Build the query for the structured `components` (name -> value). Each
+    term needs to match in the qfields of its component.
+    """
+    qparts = []
+    for name, value in sorted(components.items()):
+      for term in value.split(' '):
+        if not term:
+          continue
+        qparts.append(
+          '_query_:"{{!maxscore tie=0}}({})"'.format(
+            self.cached_component_queries_for_term(name, term))
+        )
+    return ' AND '.join(qparts)
+
+
+class ParcelCollection(Collection):
+  """
+  ParcelCollection searches parcels (Flurstücke) by their identification.
+  Queries with a Gemarkung number are resolved with the parcel key index
+  (<name>.flst in --index-dir, see geocodr-flst-index) and the documents
+  are fetched by their IDs. All other queries (e.g. with a Gemarkung name)
+  are searched in the `qfields`.
+  """
+
+  # state-wide prefix to convert 4 digit Gemarkung numbers to 6 digits
+  gemarkung_prefix = None
+
+  def flst_key(self, query):
+    """
+    Return the (partial) parcel key for `query`, or None if the query is no
+    parcel identification with a Gemarkung number.
+    """
+    return flst_key(parse_flst(query, self.gemarkung_prefix))
+
+
+class TermCache(object):
+  """
+  TermCache memoizes the queries of a single Collection for the last
+  `maxsize` terms, as building the queries (normalization, n-grams, etc.)
+  is the same for each request. Each collection has its own cache, so
+  that requests for different collections do not share a lock.
+
+  Terms are not memoized if the Collection overrides `queries_for_term`, as
+  it might not return the same query for the same term.
+  """
+
+  def __init__(self, collection, maxsize=10000):
+    self.collection = collection
+    self.memoize = type(collection).queries_for_term is Collection.queries_for_term
+    self.cache = LRUCache(maxsize)
+
+  def queries_for_term(self, term):
+    if not self.memoize:
+      return self.collection.queries_for_term(term)
+    q = self.cache.get(term)
+    if q is None:
+      q = self.collection.queries_for_term(term)
+      self.cache.set(term, q)
+    return q
+
+  def component_queries_for_term(self, component, term):
+    key = (component, term)
+    q = self.cache.get(key)
+    if q is None:
+      q = self.collection.component_queries_for_term(component, term)
+      self.cache.set(key, q)
+    return q
+
+  def __len__(self):
+    return len(self.cache)
+
+  def stats(self):
+    return self.cache.stats()
+
+
+def fields_query(fields, term):
+  """
+  Return the query for `term` in all `fields` (OR). Only exclusive queries
+  are used if one or more fields return an exclusive query.
+  """
+  parts = []
+  for f in fields:
+    part = f.query(term)
+    if not part:
+      continue
+    parts.append(part)
+
+  # Only use exclusive parts (fields wrapped with Only) if at least one
+  # part is marked as exclusive.
+  if any(is_exclusive(part) for part in parts):
+    parts = [p for p in parts if is_exclusive(p)]
+
+  return ' OR '.join(parts)
+
 
 class Class(object):
   collections = []
@@ -164,6 +363,20 @@ class Field(object):
   def query(self, term):
     raise NotImplementedError()
 
+  def describe(self):
+    """
+    Return a human readable description of the field for debugging.
+    """
+    desc = type(self).__name__
+    if hasattr(self, 'field'):
+      desc += '({})'.format(self.field)
+    return desc + self._describe_boost()
+
+  def _describe_boost(self):
+    if self.boost != 1.0:
+      return '^{}'.format(self.boost)
+    return ''
+
   def __xor__(self, boost):
     self.boost = boost
     return self
@@ -175,6 +388,10 @@ class NGramField(Field):
     self.min_gram = min_gram
     self.max_gram = max_gram
 
+  def describe(self):
+    return '{}({}, grams={}-{}){}'.format(
+      type(self).__name__, self.field, self.min_gram, self.max_gram, self._describe_boost())
+
   def tokenize(self, curr_input):
     grams = []
     for n in range(self.min_gram, self.max_gram + 1):
@@ -254,11 +471,38 @@ class PrefixField(Field):
     return q
 
 
+class FlstField(Field):
+  """
+  FlstField searches parcel identifications in a field with the normalized
+  18 digit key (Gemarkung, Flur, Zähler and Nenner). Incomplete
+  identifications are searched as prefix. Terms without Gemarkung number
+  return no query.
+  """
+
+  def __init__(self, field, gemarkung_prefix=None):
+    self.field = field
+    self.gemarkung_prefix = gemarkung_prefix
+
+  def query(self, term):
+    key = flst_key(parse_flst(term, self.gemarkung_prefix))
+    if not key:
+      return
+    q = '{}:{}'.format(self.field, key)
+    if len(key) < 18:
+      q += '*'
+    if self.boost != 1.0:
+      q += '^{:.2}'.format(self.boost)
+    return q
+
+
 class Only(Field):
   def __init__(self, regexp, qfield):
     self.regexp = re.compile(regexp)
     self.qfield = qfield
 
+  def describe(self):
+    return 'Only(/{}/) -> {}'.format(self.regexp.pattern, self.qfield.describe())
+
   def query(self, term):
     if self.regexp.match(term):
       q = self.qfield.query(term)
@@ -278,6 +522,10 @@ class PatternReplace(Field):
     self.repl = repl
     self.qfield = qfield
 
+  def describe(self):
+    return 'PatternReplace(/{}/ -> {!r}) -> {}'.format(
+      self.regexp.pattern, self.repl, self.qfield.describe())
+
   def query(self, term):
     term = self.regexp.sub(self.repl, term)
     return self.qfield.query(term)
@@ -298,6 +546,74 @@ def is_exclusive(query):
   return isinstance(query, Exclusive)
 
 
+re_local_param = re.compile(r"\b(v|mm)='([^']*)'")
+re_param_ref = re.compile(r'\b(v|mm)=\$(\w+)')
+
+
+def parameterize(query):
+  """
+  Move all quoted `v` and `mm` local params from `query` into separate
+  parameters that are referenced with $name. Identical values share the
+  same parameter.
+
+  >>> q, params = parameterize("{!edismax v='ab' mm='2<-1'} OR {!edismax v='cd' mm='2<-1'}")
+  >>> q
+  '{!edismax v=$v0 mm=$mm0} OR {!edismax v=$v1 mm=$mm0}'
+  >>> sorted(params.items())
+  [('mm0', '2<-1'), ('v0', 'ab'), ('v1', 'cd')]
+  """
+  params = {}
+  names = {}
+
+  def ref(m):
+    key = (m.group(1), m.group(2))
+    if key not in names:
+      names[key] = '{}{}'.format(m.group(1), sum(1 for k in names if k[0] == key[0]))
+      params[names[key]] = m.group(2)
+    return '{}=${}'.format(m.group(1), names[key])
+
+  return re_local_param.sub(ref, query), params
+
+
+def dereference(query, params):
+  """
+  Replace all $name references in `query` with the quoted parameter value.
+  This is the reverse of `parameterize`.
+
+  >>> dereference('{!edismax v=$v0 mm=$mm0}', {'v0': 'ab', 'mm0': '2<-1'})
+  "{!edismax v='ab' mm='2<-1'}"
+  """
+  return re_param_ref.sub(lambda m: "{}='{}'".format(m.group(1), params[m.group(2)]), query)
+
+
+def json_request(params):
+  """
+  Convert Solr query parameters into a body for the Solr JSON Request API.
+  All term values and mm specifications of the query are passed as
+  parameters and filter queries are passed as `filter`, so that Solr can
+  cache them independently of the query.
+
+  >>> body = json_request({'q': "f:x OR {!edismax v='ab'}", 'rows': 10, 'fq': 'g:y'})
+  >>> body['query'], body['limit'], body['filter'], body['params']
+  ('f:x OR {!edismax v=$v0}', 10, ['g:y'], {'v0': 'ab'})
+  """
+  params = dict(params)
+  query, query_params = parameterize(params.pop('q'))
+  body = {'query': query}
+  if 'rows' in params:
+    body['limit'] = params.pop('rows')
+  if 'sort' in params:
+    body['sort'] = params.pop('sort')
+  if 'fl' in params:
+    body['fields'] = params.pop('fl')
+  if 'fq' in params:
+    fq = params.pop('fq')
+    body['filter'] = fq if isinstance(fq, list) else [fq]
+  query_params.update(params)
+  body['params'] = query_params
+  return body
+
+
 class SpatialFilter(object):
   def __init__(self, bbox=None, pt=None, d=10):
     if bbox and pt:
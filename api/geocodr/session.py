@@ -0,0 +1,111 @@
+"""
+The session module keeps the results of the last search of each client
+session, to answer consecutive typeahead queries without Solr.
+"""
+
+import time
+
+from .cache import LRUCache
+from .exact import normalize_title
+
+
+def refine_terms(prev_query, query):
+  """
+  Return the terms of `query` that need to be checked if `query` extends
+  `prev_query`, or None if it does not extend `prev_query`.
+
+  >>> refine_terms('rostock alfr', 'rostock alfred')
+  ['alfred']
+  >>> refine_terms('rostock alfred', 'rostock alfred sch')
+  ['alfred', 'sch']
+  >>> refine_terms('rostock alfred', 'rostock') is None
+  True
+  """
+  prev_terms = normalize_title(prev_query).split(' ')
+  terms = normalize_title(query).split(' ')
+  if len(terms) < len(prev_terms):
+    return None
+  n = len(prev_terms) - 1
+  if terms[:n] != prev_terms[:n] or not terms[n].startswith(prev_terms[n]):
+    return None
+  return terms[n:]
+
+
+def refine_features(features, terms):
+  """
+  Return copies of all `features` with a title that contains all `terms`.
+  Features where each term is at the start of a word keep their score, all
+  other features score lower.
+  """
+  result = []
+  for feature in features:
+    title = ' ' + normalize_title(feature['properties']['_title_'])
+    if not all(t in title for t in terms):
+      continue
+    feature = copy_feature(feature)
+    if not all(' ' + t in title for t in terms):
+      feature['properties']['_score_'] *= 0.5
+    result.append(feature)
+  return result
+
+
+def copy_feature(feature):
+  """
+  Copy `feature`, so that the properties can be modified (e.g. with
+  FeatureCollection.filter_internal_properties).
+  """
+  feature = dict(feature)
+  feature['properties'] = dict(feature['properties'])
+  return feature
+
+
+class SessionCache(object):
+  """
+  SessionCache keeps the features of the last search of each session for
+  `ttl` seconds. A search that extends the previous query of the session
+  (e.g. `alfre` after `alfr`) is answered by filtering the previous
+  features, if the previous search returned all results of all collections.
+
+  `key` identifies all other request parameters (class, projection, etc.)
+  and `names` the queried collections. Both need to match the previous
+  search. Searches with more than `max_candidates` features are not kept.
+  """
+
+  def __init__(self, maxsize=10000, ttl=30.0, max_candidates=1000):
+    self.cache = LRUCache(maxsize)
+    self.ttl = ttl
+    self.max_candidates = max_candidates
+    self.refined = 0
+
+  def set(self, session, key, query, names, features):
+    if len(features) > self.max_candidates:
+      self.cache.set(session, None)
+      return
+    features = [copy_feature(f) for f in features]
+    self.cache.set(session, (time.monotonic(), key, query, names, features))
+
+  def refine(self, session, key, query, names):
+    """
+    Return the features for `query` from the previous search of `session`,
+    or None if the features need to be fetched from Solr.
+    """
+    entry = self.cache.get(session)
+    if entry is None:
+      return None
+    created, prev_key, prev_query, prev_names, features = entry
+    if time.monotonic() - created > self.ttl or prev_key != key or prev_names != names:
+      return None
+    terms = refine_terms(prev_query, query)
+    if terms is None:
+      return None
+    result = refine_features(features, terms)
+    if not result:
+      # the previous features might not contain fuzzy matches
+      return None
+    self.refined += 1
+    return result
+
+  def stats(self):
+    stats = self.cache.stats()
+    stats['refined'] = self.refined
+    return stats
@@ -2,14 +2,28 @@
 solr module provides an API for communication with Solr
 """
 
+import asyncio
 import re
 import requests
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import (
+  FIRST_COMPLETED,
+  ThreadPoolExecutor,
+  wait,
+)
 
 
 class SolrUnauthenticatedError(Exception):
   pass
 
 
+class SolrTimeoutError(Exception):
+  pass
+
+
 class SolrException(Exception):
   def __init__(self, resp):
     try:
@@ -29,33 +43,394 @@ class SolrException(Exception):
     self.resp = resp
 
 
+class SolrNode(object):
+  """
+  SolrNode tracks the in-flight requests, recent latencies and failures of a
+  single Solr node. The node is skipped (circuit open) for `reset_timeout`
+  seconds after `failure_threshold` consecutive failures. A single request
+  is permitted after that time to check if the node recovered.
+  """
+
+  def __init__(self, url, latency_window=200, failure_threshold=5, reset_timeout=30.0):
+    self.url = url.rstrip('/')
+    self.in_flight = 0
+    self.latencies = deque(maxlen=latency_window)
+    self.failures = 0
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.open_until = 0.0
+
+  def is_open(self, now):
+    return self.failures >= self.failure_threshold and now < self.open_until
+
+  def latency_percentile(self, p, min_samples=20):
+    """
+    Return the `p` percentile of the recent latencies, or None if there are
+    not enough samples.
+    """
+    if len(self.latencies) < min_samples:
+      return None
+    latencies = sorted(self.latencies)
+    return latencies[min(int(len(latencies) * p / 100.0), len(latencies) - 1)]
+
+  def record(self, ok, latency, now):
+    if ok:
+      self.failures = 0
+      self.latencies.append(latency)
+    else:
+      self.failures += 1
+      if self.failures >= self.failure_threshold:
+        self.open_until = now + self.reset_timeout
+
+
 class Solr(object):
   """
-  Solr provides a connection pool for queries to a Solr server.
+  Solr provides a connection pool for queries to one or more Solr nodes.
+
+  `url` is a single URL or a comma separated list of URLs. Requests are sent
+  to the available node with the fewest in-flight requests. A duplicate
+  (hedged) request is sent to another node if a request takes longer than
+  the `hedge_percentile` latency of its node. Nodes are skipped for a while
+  after repeated failures.
+
+  At most `max_hedges` hedged requests are in flight. Hedges have their own
+  thread pool, so that they never wait behind other requests.
   """
 
-  def __init__(self, url):
-    self.url = url
+  def __init__(self, url, connect_timeout=3.05, read_timeout=30.0, hedge_percentile=95,
+               hedge_min_delay=0.01, failure_threshold=5, reset_timeout=30.0, max_hedges=10):
+    if isinstance(url, str):
+      url = url.split(',')
+    self.nodes = [
+      SolrNode(u.strip(), failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+      for u in url if u.strip()
+    ]
+    if not self.nodes:
+      raise ValueError('no Solr URL')
+    self.url = self.nodes[0].url
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.hedge_percentile = hedge_percentile
+    self.hedge_min_delay = hedge_min_delay
+    self.max_hedges = max_hedges
+    self.hedges_in_flight = 0
+    self.hedges_skipped = 0
+    self._lock = threading.Lock()
+    self._executor = None
+    self._hedge_executor = None
+    self.reset()
+
+  def reset(self):
+    """
+    Create a new connection pool, e.g. after the process was forked.
+    """
     self._s = requests.Session()
-    a = requests.adapters.HTTPAdapter(max_retries=3, pool_maxsize=100)
+    # retry with other nodes instead of the same node, if possible
+    retries = 3 if len(self.nodes) == 1 else 0
+    a = requests.adapters.HTTPAdapter(max_retries=retries, pool_maxsize=100)
     self._s.mount('http://', a)
     self._s.mount('https://', a)
+    self._executor = None
+    self._hedge_executor = None
+
+  @property
+  def executor(self):
+    # created on first use, as threads do not survive a fork
+    with self._lock:
+      if self._executor is None:
+        self._executor = ThreadPoolExecutor(max_workers=100)
+      return self._executor
 
-  def query(self, collection, q, user_auth=None, **kw):
+  @property
+  def hedge_executor(self):
+    with self._lock:
+      if self._hedge_executor is None:
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max(self.max_hedges, 1))
+      return self._hedge_executor
+
+  def acquire_hedge(self):
+    """
+    Reserve a hedged request. Returns False if `max_hedges` are in flight.
+    """
+    with self._lock:
+      if self.hedges_in_flight >= self.max_hedges:
+        self.hedges_skipped += 1
+        return False
+      self.hedges_in_flight += 1
+      return True
+
+  def release_hedge(self):
+    with self._lock:
+      self.hedges_in_flight -= 1
+
+  def _hedge_get(self, node, collection, params, user_auth, timeout, body=None):
+    try:
+      return self._get(node, collection, params, user_auth, timeout, body)
+    finally:
+      self.release_hedge()
+
+  def pick_node(self, exclude=()):
+    """
+    Return the available node with the fewest in-flight requests. Returns
+    the node with the earliest retry time if all nodes failed, or None if
+    all nodes are excluded.
+    """
+    now = time.time()
+    with self._lock:
+      candidates = [n for n in self.nodes if n not in exclude]
+      if not candidates:
+        return None
+      available = [n for n in candidates if not n.is_open(now)]
+      if available:
+        node = min(available, key=lambda n: n.in_flight)
+      else:
+        node = min(candidates, key=lambda n: n.open_until)
+      if node.failures >= node.failure_threshold:
+        # half-open: permit this single request and wait for the result
+        node.open_until = now + node.reset_timeout
+      node.in_flight += 1
+      return node
+
+  def _get(self, node, collection, params, user_auth, timeout, body=None):
+    start = time.time()
+    ok = False
+    try:
+      if body is None:
+        resp = self._s.get(
+          '{}/{}/select'.format(node.url, collection),
+          params=params,
+          auth=user_auth,
+          timeout=(self.connect_timeout, timeout or self.read_timeout),
+        )
+      else:
+        resp = self._s.post(
+          '{}/{}/query'.format(node.url, collection),
+          params=params,
+          json=body,
+          auth=user_auth,
+          timeout=(self.connect_timeout, timeout or self.read_timeout),
+        )
+      ok = resp.status_code < 500
+      return resp
+    finally:
+      now = time.time()
+      with self._lock:
+        node.in_flight -= 1
+        node.record(ok, now - start, now)
+
+  def _hedged_get(self, node, collection, params, user_auth, timeout, body=None):
+    delay = None
+    if self.hedge_percentile and self.max_hedges > 0 and len(self.nodes) > 1:
+      delay = node.latency_percentile(self.hedge_percentile)
+    if delay is None:
+      # no hedge possible, query in the calling thread
+      return self._get(node, collection, params, user_auth, timeout, body)
+
+    f = self.executor.submit(self._get, node, collection, params, user_auth, timeout, body)
+    nodes = [node]
+    futures = [f]
+    done, _ = wait(futures, timeout=max(delay, self.hedge_min_delay))
+    # a request that is still queued did not reach its node yet, so the
+    # delay says nothing about the latency of the node
+    if not done and f.running() and self.acquire_hedge():
+      hedge_node = self.pick_node(exclude=nodes)
+      if hedge_node:
+        nodes.append(hedge_node)
+        futures.append(self.hedge_executor.submit(
+          self._hedge_get, hedge_node, collection, params, user_auth, timeout, body))
+      else:
+        self.release_hedge()
+
+    # return the first successful response, or the last error
+    pending = futures
+    while True:
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for f in done:
+        if f.exception() is None and f.result().status_code < 500:
+          return f.result()
+      if not pending:
+        return f.result()
+
+  def query(self, collection, q, user_auth=None, timeout=None, **kw):
     """
     Send query `q` for `collection` to Solr. Returns the JSON response as a dict.
     Additional `kw` parameters are sent as further GET parameters.
-    Raises `SolrException` on error.
+    `timeout` overrides the default read timeout in seconds.
+    Raises `SolrException` on error and `SolrTimeoutError` on timeouts.
     """
     kw['q'] = q
-    resp = self._s.get(
-      '{}/{}/select'.format(self.url, collection), params=kw, auth=user_auth)
+    return self._query(collection, kw, None, user_auth, timeout)
+
+  def query_json(self, collection, body, user_auth=None, timeout=None):
+    """
+    Send the JSON Request API `body` for `collection` to Solr. See `query`.
+    """
+    return self._query(collection, {}, body, user_auth, timeout)
+
+  def _query(self, collection, params, body, user_auth, timeout):
+    node = self.pick_node()
+    try:
+      try:
+        resp = self._hedged_get(node, collection, params, user_auth, timeout, body)
+      except requests.ConnectionError:
+        # try once more with another node
+        node = self.pick_node(exclude=[node])
+        if node is None:
+          raise
+        resp = self._hedged_get(node, collection, params, user_auth, timeout, body)
+    except requests.Timeout as ex:
+      raise SolrTimeoutError(str(ex))
+
     if resp.status_code == 401:
       raise SolrUnauthenticatedError()
     if not resp.ok:
       raise SolrException(resp)
     return resp.json()
 
+  def aliases(self):
+    """
+    Return a dict with all collection aliases and their collections.
+    """
+    node = self.pick_node()
+    try:
+      resp = self._s.get(
+        '{}/admin/collections'.format(node.url),
+        params={'action': 'LISTALIASES', 'wt': 'json'},
+        timeout=(self.connect_timeout, self.read_timeout),
+      )
+    finally:
+      with self._lock:
+        node.in_flight -= 1
+    if not resp.ok:
+      raise SolrException(resp)
+    return resp.json().get('aliases', {})
+
+
+class AsyncSolr(Solr):
+  """
+  AsyncSolr is the asyncio variant of Solr for the ASGI application. It
+  selects, hedges and fails over between nodes like Solr, but requires the
+  optional httpx package.
+  """
+
+  def reset(self):
+    self._client = None
+
+  @property
+  def client(self):
+    # created on first use, as the client is bound to the running event loop
+    if self._client is None:
+      import httpx
+      self._client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+      )
+    return self._client
+
+  async def close(self):
+    if self._client is not None:
+      await self._client.aclose()
+      self._client = None
+
+  async def _get(self, node, collection, params, user_auth, timeout, body=None):
+    import httpx
+    timeout = httpx.Timeout(timeout or self.read_timeout, connect=self.connect_timeout)
+    if body is None:
+      return await self.client.get(
+        '{}/{}/select'.format(node.url, collection),
+        params=params,
+        auth=user_auth,
+        timeout=timeout,
+      )
+    return await self.client.post(
+      '{}/{}/query'.format(node.url, collection),
+      params=params,
+      json=body,
+      auth=user_auth,
+      timeout=timeout,
+    )
+
+  def _start_get(self, node, collection, params, user_auth, timeout, body=None):
+    start = time.time()
+    task = asyncio.ensure_future(
+      self._get(node, collection, params, user_auth, timeout, body))
+
+    def done(task):
+      now = time.time()
+      with self._lock:
+        node.in_flight -= 1
+        if task.cancelled():
+          # cancelled hedge requests are neither a success nor a failure
+          return
+        ok = task.exception() is None and task.result().status_code < 500
+        node.record(ok, now - start, now)
+
+    task.add_done_callback(done)
+    return task
+
+  async def _hedged_get(self, node, collection, params, user_auth, timeout, body=None):
+    tasks = [self._start_get(node, collection, params, user_auth, timeout, body)]
+    try:
+      delay = None
+      if self.hedge_percentile and self.max_hedges > 0 and len(self.nodes) > 1:
+        delay = node.latency_percentile(self.hedge_percentile)
+      if delay is not None:
+        done, _ = await asyncio.wait(tasks, timeout=max(delay, self.hedge_min_delay))
+        if not done and self.acquire_hedge():
+          hedge_node = self.pick_node(exclude=[node])
+          if hedge_node:
+            task = self._start_get(hedge_node, collection, params, user_auth, timeout, body)
+            task.add_done_callback(lambda task: self.release_hedge())
+            tasks.append(task)
+          else:
+            self.release_hedge()
+
+      # return the first successful response, or the last error
+      pending = tasks
+      while True:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+          if t.exception() is None and t.result().status_code < 500:
+            return t.result()
+        if not pending:
+          return t.result()
+    finally:
+      for t in tasks:
+        t.cancel()
+
+  async def query(self, collection, q, user_auth=None, timeout=None, **kw):
+    """
+    Send query `q` for `collection` to Solr. See Solr.query.
+    """
+    kw['q'] = q
+    return await self._query(collection, kw, None, user_auth, timeout)
+
+  async def query_json(self, collection, body, user_auth=None, timeout=None):
+    """
+    Send the JSON Request API `body` for `collection` to Solr. See Solr.query.
+    """
+    return await self._query(collection, {}, body, user_auth, timeout)
+
+  async def _query(self, collection, params, body, user_auth, timeout):
+    import httpx
+    node = self.pick_node()
+    try:
+      try:
+        resp = await self._hedged_get(node, collection, params, user_auth, timeout, body)
+      except httpx.ConnectError:
+        # try once more with another node
+        node = self.pick_node(exclude=[node])
+        if node is None:
+          raise
+        resp = await self._hedged_get(node, collection, params, user_auth, timeout, body)
+    except httpx.TimeoutException as ex:
+      raise SolrTimeoutError(str(ex))
+
+    if resp.status_code == 401:
+      raise SolrUnauthenticatedError()
+    if resp.status_code >= 400:
+      raise SolrException(resp)
+    return resp.json()
+
 
 re_special_chars = re.compile(r'[-+&|!(){}[\]^"~*?:\\/\',]')
 re_whitespace = re.compile(r'\s+')
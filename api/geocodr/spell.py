@@ -0,0 +1,251 @@
+"""
+The spell module provides an in-memory dictionary of all words in the
+titles of all documents, to correct misspelled queries without results.
+"""
+
+import logging
+
+from .exact import ExactIndex, doc_title, normalize_title
+
+
+log = logging.getLogger(__name__)
+
+# shorter words are never corrected
+MIN_WORD_LENGTH = 4
+
+
+class SymSpell(object):
+  """
+  SymSpell finds the most frequent word within `max_distance` edits for a
+  term with the symmetric delete algorithm. All variants of each word with
+  up to `max_distance` deleted characters are indexed. The variants of a
+  term are then looked up to find all candidates, without generating any
+  inserts, replacements or transpositions.
+
+  Only the first `prefix_length` characters of each word are used for the
+  variants to limit the memory usage. No more words are added after
+  `max_words`.
+
+  >>> s = SymSpell()
+  >>> for word in ['alfred', 'schulze', 'strasse', 'strasse', 'strande']:
+  ...   s.add(word)
+  >>> s.lookup('allfred')
+  ('alfred', 1)
+  >>> s.lookup('schultze')
+  ('schulze', 1)
+  >>> s.lookup('strase')
+  ('strasse', 1)
+  >>> s.lookup('alfred')
+  ('alfred', 0)
+  >>> s.lookup('rostock') is None
+  True
+  """
+
+  def __init__(self, max_distance=2, prefix_length=7, max_words=200000):
+    self.max_distance = max_distance
+    self.prefix_length = prefix_length
+    self.max_words = max_words
+    # word -> count
+    self.words = {}
+    # deleted variant -> word or list of words
+    self.deletes = {}
+
+  def __len__(self):
+    return len(self.words)
+
+  def add(self, word, count=1):
+    if word in self.words:
+      self.words[word] += count
+      return
+    if len(self.words) >= self.max_words:
+      return
+    self.words[word] = count
+    for variant in self.variants(word[:self.prefix_length]):
+      words = self.deletes.get(variant)
+      if words is None:
+        # most variants belong to a single word, store it without a list
+        self.deletes[variant] = word
+      elif isinstance(words, list):
+        words.append(word)
+      else:
+        self.deletes[variant] = [words, word]
+
+  def variants(self, word):
+    """
+    Return `word` and all variants with up to `max_distance` deleted
+    characters.
+
+    >>> sorted(SymSpell(max_distance=1).variants('abc'))
+    ['ab', 'abc', 'ac', 'bc']
+    """
+    result = {word}
+    edits = [word]
+    for _ in range(self.max_distance):
+      next_edits = []
+      for w in edits:
+        if len(w) <= 1:
+          continue
+        for i in range(len(w)):
+          variant = w[:i] + w[i + 1:]
+          if variant not in result:
+            result.add(variant)
+            next_edits.append(variant)
+      edits = next_edits
+    return result
+
+  def lookup(self, term):
+    """
+    Return the correction for `term` as (word, distance) or None if no word
+    is within `max_distance` edits. The closest word is returned, the most
+    frequent one for words with the same distance.
+    """
+    if term in self.words:
+      return term, 0
+    prefix = term[:self.prefix_length]
+    best = None
+    checked = set()
+    # variants with fewer deletes first, to stop early after a close match
+    for variant in sorted(self.variants(prefix), key=len, reverse=True):
+      if best is not None and len(prefix) - len(variant) > best[0]:
+        break
+      words = self.deletes.get(variant)
+      if words is None:
+        continue
+      if not isinstance(words, list):
+        words = [words]
+      for word in words:
+        if word in checked:
+          continue
+        checked.add(word)
+        if abs(len(word) - len(term)) > self.max_distance:
+          continue
+        dist = edit_distance(term, word, self.max_distance)
+        if dist is None:
+          continue
+        key = (dist, -self.words[word], word)
+        if best is None or key < best:
+          best = key
+    if best is None:
+      return None
+    return best[2], best[0]
+
+
+def edit_distance(a, b, max_distance):
+  """
+  Return the Damerau-Levenshtein distance (optimal string alignment) of
+  `a` and `b`, or None if it is larger than `max_distance`.
+
+  >>> edit_distance('schultze', 'schulze', 2)
+  1
+  >>> edit_distance('strsase', 'strasse', 2)
+  1
+  >>> edit_distance('rostock', 'restack', 1) is None
+  True
+  """
+  # common prefixes and suffixes do not change the distance
+  start = 0
+  while start < len(a) and start < len(b) and a[start] == b[start]:
+    start += 1
+  end = 0
+  while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+    end += 1
+  a = a[start:len(a) - end]
+  b = b[start:len(b) - end]
+
+  prev_prev = None
+  prev = list(range(len(b) + 1))
+  for i in range(1, len(a) + 1):
+    cur = [i] + [0] * len(b)
+    for j in range(1, len(b) + 1):
+      cost = 0 if a[i - 1] == b[j - 1] else 1
+      d = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+      if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+        d = min(d, prev_prev[j - 2] + 1)
+      cur[j] = d
+    if min(cur) > max_distance:
+      return None
+    prev_prev, prev = prev, cur
+  if prev[-1] > max_distance:
+    return None
+  return prev[-1]
+
+
+def title_words(title):
+  """
+  Return all words of `title` that are candidates for corrections. Short
+  words and words with digits (house numbers, etc.) are ignored.
+
+  >>> title_words('Rostock, Alfred-Schulze-Straße 12a')
+  ['rostock', 'alfred', 'schulze', 'strasse']
+  """
+  return [w for w in normalize_title(title).split(' ')
+          if len(w) >= MIN_WORD_LENGTH and w.isalpha()]
+
+
+class SpellIndex(ExactIndex):
+  """
+  SpellIndex contains a SymSpell dictionary with the words of all titles,
+  for all collections with `spell_index` enabled. Only the fields for the
+  title are loaded from Solr. Each dictionary contains at most `max_words`
+  words. See ExactIndex for the refresh.
+  """
+
+  collection_attr = 'spell_index'
+  description = 'spell index'
+
+  def __init__(self, solr, collections, max_words=200000, **kw):
+    ExactIndex.__init__(self, solr, collections, **kw)
+    self.max_words = max_words
+
+  def build(self, collection):
+    fields = ['id'] + list(collection.fields)
+    if collection.jsonblob_field:
+      fields.append(collection.jsonblob_field)
+
+    words = SymSpell(max_words=self.max_words)
+    for num, doc in enumerate(self.iter_docs(collection, ','.join(fields)), 1):
+      if num > self.max_docs:
+        log.warning("Collection '%s' has more than %d documents, not building %s",
+                    collection.name, self.max_docs, self.description)
+        return None
+      for word in title_words(doc_title(collection, doc)):
+        words.add(word)
+    if len(words) >= self.max_words:
+      log.warning("Collection '%s' has more than %d words, %s is incomplete",
+                  collection.name, self.max_words, self.description)
+    return words
+
+  def correct(self, collections, query):
+    """
+    Return `query` with each unknown word replaced by the closest word of
+    the dictionaries of `collections`, or None if nothing was corrected.
+    Collections without index are ignored.
+    """
+    self.refresh_if_stale()
+    dictionaries = [self.titles[c.name] for c in collections if c.name in self.titles]
+    if not dictionaries:
+      return None
+
+    corrected = False
+    terms = []
+    for term in normalize_title(query).split(' '):
+      if len(term) < MIN_WORD_LENGTH or not term.isalpha():
+        terms.append(term)
+        continue
+      best = None
+      for d in dictionaries:
+        found = d.lookup(term)
+        if found is None:
+          continue
+        word, dist = found
+        key = (dist, -d.words[word], word)
+        if best is None or key < best:
+          best = key
+      if best is None or best[0] == 0:
+        terms.append(term)
+        continue
+      terms.append(best[2])
+      corrected = True
+    if not corrected:
+      return None
+    return ' '.join(terms)
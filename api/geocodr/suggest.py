@@ -0,0 +1,136 @@
+"""
+The suggest module provides an in-memory prefix index of the titles of all
+documents for type=suggest requests (autocomplete).
+"""
+
+import logging
+
+from array import array
+from bisect import bisect_left
+
+from .exact import ExactIndex, doc_title, normalize_title
+
+
+log = logging.getLogger(__name__)
+
+
+class Suggestions(object):
+  """
+  Suggestions contains the titles of a collection. Each normalized title is
+  indexed at the start of each word, so that `alfred sch` also matches
+  `Rostock, Alfred-Schulze-Str.`.
+
+  The keys are stored in a sorted list and truncated to `key_length`
+  characters to limit the memory usage. A lookup is a binary search for the
+  range of keys that start with the prefix.
+
+  >>> s = Suggestions(['Rostock, Alfred-Schulze-Str.', 'Rostock, Am Strande'])
+  >>> s.lookup('stra', 10)
+  [('Rostock, Am Strande', 1.0)]
+  >>> s.lookup('rostock a', 10)
+  [('Rostock, Alfred-Schulze-Str.', 2.0), ('Rostock, Am Strande', 2.0)]
+  """
+
+  def __init__(self, titles, key_length=24):
+    self.key_length = key_length
+    self.titles = sorted(titles)
+    self.normalized = [normalize_title(t) for t in self.titles]
+
+    entries = []
+    for i, norm in enumerate(self.normalized):
+      for pos in word_starts(norm):
+        entries.append((norm[pos:pos + key_length], i, pos))
+    entries.sort()
+    self.keys = [k for k, _, _ in entries]
+    self.title_ids = array('I', (i for _, i, _ in entries))
+    self.positions = array('H', (min(pos, 0xffff) for _, _, pos in entries))
+
+  def __len__(self):
+    return len(self.titles)
+
+  def lookup(self, prefix, max_scan):
+    """
+    Return (title, score) for all titles with a word that starts with
+    `prefix`. Titles that start with `prefix` score higher. At most
+    `max_scan` keys are checked.
+    """
+    prefix = normalize_title(prefix)
+    if not prefix:
+      return []
+    key = prefix[:self.key_length]
+    lo = bisect_left(self.keys, key)
+    hi = min(bisect_left(self.keys, key + '\uffff'), lo + max_scan)
+
+    scores = {}
+    for idx in range(lo, hi):
+      i = self.title_ids[idx]
+      pos = self.positions[idx]
+      if len(prefix) > self.key_length and not self.normalized[i].startswith(prefix, pos):
+        continue
+      score = 2.0 if pos == 0 else 1.0
+      if scores.get(i, 0) < score:
+        scores[i] = score
+    return [(self.titles[i], score) for i, score in sorted(scores.items())]
+
+
+def word_starts(title):
+  """
+  Return the start position of each word in the normalized `title`.
+
+  >>> word_starts('rostock am strande')
+  [0, 8, 11]
+  """
+  return [0] + [i + 1 for i, c in enumerate(title) if c == ' ']
+
+
+class SuggestIndex(ExactIndex):
+  """
+  SuggestIndex contains the Suggestions for all collections with
+  `suggest_index` enabled. Only the fields for the title are loaded from
+  Solr, geometries are not kept. Collections with more than `max_docs`
+  documents are not indexed. See ExactIndex for the refresh.
+  """
+
+  collection_attr = 'suggest_index'
+  description = 'suggest index'
+
+  def build(self, collection):
+    fields = ['id'] + list(collection.fields)
+    if collection.jsonblob_field:
+      fields.append(collection.jsonblob_field)
+
+    titles = set()
+    for num, doc in enumerate(self.iter_docs(collection, ','.join(fields)), 1):
+      if num > self.max_docs:
+        log.warning("Collection '%s' has more than %d documents, not building %s",
+                    collection.name, self.max_docs, self.description)
+        return None
+      titles.add(doc_title(collection, doc))
+    return Suggestions(titles)
+
+  def suggest(self, collections, query, max_scan=1000):
+    """
+    Return features without geometry for all titles of `collections` that
+    match `query`. Collections without index are ignored.
+    """
+    self.refresh_if_stale()
+    features = []
+    for c in collections:
+      suggestions = self.titles.get(c.name)
+      if suggestions is None:
+        continue
+      for title, score in suggestions.lookup(query, max_scan):
+        features.append({
+          'type': 'Feature',
+          'geometry': None,
+          'properties': {
+            '_title_': title,
+            '_score_': score,
+            '_sort_tiebreaker_': (len(title), title),
+            '_collection_': c.name,
+            '_class_': c.class_,
+            c.collection_title_attrib: c.title,
+            c.class_title_attrib: c.class_title,
+          },
+        })
+    return features
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import pytest
+import threading
+import time
+
+from werkzeug.test import Client
+
+from .admission import AdmissionController, Rejected, BULK, INTERACTIVE
+from .api import Geocodr
+from .test_api import MAPPING, FakeSolr
+
+
+def test_reject_full_queue():
+  ac = AdmissionController(max_in_flight=1, max_queue=0, queue_timeout=1.0)
+  ac.acquire()
+  start = time.time()
+  with pytest.raises(Rejected) as exc:
+    ac.acquire()
+  assert time.time() - start < 0.1
+  assert exc.value.retry_after == 1
+  ac.release()
+  ac.acquire()
+  assert ac.stats()['rejected'] == {INTERACTIVE: 1, BULK: 0}
+
+
+def test_queue_timeout():
+  ac = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.05)
+  ac.acquire()
+  start = time.time()
+  with pytest.raises(Rejected):
+    ac.acquire()
+  assert 0.05 <= time.time() - start < 0.5
+
+
+def test_wait_for_release():
+  ac = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=1.0)
+  ac.acquire()
+  t = threading.Timer(0.05, ac.release)
+  t.start()
+  ac.acquire()
+  t.join()
+  assert ac.stats()['in_flight'] == 1
+
+
+def test_bulk_shed_first():
+  ac = AdmissionController(max_in_flight=4, max_queue=4, bulk_share=0.5, queue_timeout=0.01)
+  ac.acquire(BULK)
+  ac.acquire(BULK)
+  # bulk requests can only use half of the slots
+  with pytest.raises(Rejected):
+    ac.acquire(BULK)
+  ac.acquire(INTERACTIVE)
+  ac.acquire(INTERACTIVE)
+  assert ac.stats()['in_flight'] == 4
+
+
+def test_interactive_admitted_first():
+  ac = AdmissionController(max_in_flight=2, max_queue=4, bulk_share=1.0, queue_timeout=1.0)
+  ac.acquire()
+  ac.acquire()
+
+  order = []
+
+  def run(lane):
+    ac.acquire(lane)
+    order.append(lane)
+
+  bulk = threading.Thread(target=run, args=(BULK, ))
+  bulk.start()
+  time.sleep(0.02)
+  interactive = threading.Thread(target=run, args=(INTERACTIVE, ))
+  interactive.start()
+  time.sleep(0.02)
+
+  ac.release()
+  interactive.join()
+  time.sleep(0.02)
+  assert order == [INTERACTIVE]
+  ac.release()
+  bulk.join()
+  assert order == [INTERACTIVE, BULK]
+
+
+def test_fifo_per_lane():
+  ac = AdmissionController(max_in_flight=1, max_queue=4, queue_timeout=1.0)
+  ac.acquire()
+
+  order = []
+
+  def run(name):
+    ac.acquire()
+    order.append(name)
+    ac.release()
+
+  first = threading.Thread(target=run, args=('first', ))
+  first.start()
+  time.sleep(0.02)
+  second = threading.Thread(target=run, args=('second', ))
+  second.start()
+  time.sleep(0.02)
+
+  ac.queue_timeout = 0
+  ac.release()
+  # a new request does not jump ahead of the waiting requests
+  with pytest.raises(Rejected):
+    ac.acquire()
+  first.join()
+  second.join()
+  assert order == ['first', 'second']
+
+
+def test_acquire_async():
+  ac = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.05)
+
+  async def run():
+    await ac.acquire_async()
+    start = time.time()
+    # waits without blocking the event loop
+    with pytest.raises(Rejected):
+      await asyncio.gather(ac.acquire_async(), asyncio.sleep(0.01))
+    assert 0.05 <= time.time() - start < 0.5
+
+    ac.queue_timeout = 1.0
+    asyncio.get_running_loop().call_later(0.02, ac.release)
+    await ac.acquire_async()
+
+  asyncio.run(run())
+  assert ac.stats()['in_flight'] == 1
+  assert ac.stats()['waiting'] == {INTERACTIVE: 0, BULK: 0}
+  assert ac.stats()['rejected'] == {INTERACTIVE: 1, BULK: 0}
+
+
+def test_adaptive_limit():
+  ac = AdmissionController(max_in_flight=10, min_in_flight=2, target_latency=0.1)
+  for _ in range(100):
+    ac.acquire()
+    ac.release(latency=0.5)
+  assert ac.stats()['limit'] == 2
+
+  for _ in range(1000):
+    ac.acquire()
+    ac.release(latency=0.01)
+  assert ac.stats()['limit'] == 10
+
+
+def test_app_overloaded():
+  app = Geocodr({
+    'solr_url': 'http://localhost:8983/solr',
+    'mapping': MAPPING,
+    'max_in_flight': 1,
+    'max_queue': 0,
+  })
+  app.solr = FakeSolr()
+  app.admission.acquire()
+
+  args = {'type': 'search', 'class': 'address', 'query': 'alfred'}
+  resp = Client(app).get('/query', query_string=args)
+  assert resp.status_code == 503
+  assert resp.headers['Retry-After'] == '1'
+  assert json.loads(resp.get_data(as_text=True))['status'] == 503
+  assert app.solr.queries == []
+
+  app.admission.release()
+  resp = Client(app).get('/query', query_string=args)
+  assert resp.status_code == 200
+  assert app.admission.stats()['in_flight'] == 0
+
+
+def test_app_invalid_priority():
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': MAPPING,
+                 'max_in_flight': 1})
+  args = {'type': 'search', 'class': 'address', 'query': 'alfred', 'priority': 'urgent'}
+  resp = Client(app).get('/query', query_string=args)
+  assert resp.status_code == 400
+
+
+@pytest.mark.parametrize("key,priority,lane", [
+  ['website', None, INTERACTIVE],
+  ['website', 'bulk', BULK],
+  ['batch', None, BULK],
+  # the parameter can only lower the priority of the key
+  ['batch', 'interactive', BULK],
+])
+def test_app_key_priority(tmpdir, key, priority, lane):
+  key_file = tmpdir.join("keys.csv")
+  key_file.write('key,domains,priority\nwebsite,,\nbatch,,bulk\n')
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': MAPPING,
+                 'api_keys_csv': key_file.strpath, 'max_in_flight': 1})
+  app.solr = FakeSolr()
+
+  args = {'type': 'search', 'class': 'address', 'query': 'alfred', 'key': key}
+  if priority:
+    args['priority'] = priority
+  resp = Client(app).get('/query', query_string=args)
+  assert resp.status_code == 200
+  assert app.admission.stats()['admitted'][lane] == 1
@@ -0,0 +1,532 @@
+import copy
+import json
+import os
+import pytest
+import time
+
+from werkzeug.test import Client
+
+from .api import Geocodr, Search
+from .exact import ExactIndex, normalize_title
+from .search import dereference
+from .spell import SpellIndex
+from .suggest import SuggestIndex
+
+
+MAPPING = os.path.join(os.path.dirname(__file__), '..', '..', 'example', 'conf',
+                       'geocodr_mapping.py')
+
+
+class FakeSolr(object):
+  """
+  FakeSolr returns a single document for each collection. Collections can
+  be delayed or fail.
+  """
+
+  def __init__(self, delays=None, errors=()):
+    self.delays = delays or {}
+    self.errors = errors
+    self.queries = []
+    self.alias_map = {}
+    self.bodies = []
+
+  def aliases(self):
+    return self.alias_map
+
+  def query_json(self, collection, body, user_auth=None, timeout=None):
+    self.bodies.append((collection, body))
+    return self.query(collection, body['query'], user_auth=user_auth, timeout=timeout)
+
+  def query(self, collection, q, user_auth=None, timeout=None, **kw):
+    self.queries.append((collection, q, kw))
+    time.sleep(self.delays.get(collection, 0))
+    if collection in self.errors:
+      raise ValueError('error for ' + collection)
+    return {
+      'responseHeader': {},
+      'response': {'numFound': 1, 'docs': [{
+        'id': collection + '-1',
+        'score': 1.0,
+        'json': json.dumps({'strasse_name': 'Alfred-Schulze-Str.', 'bezeichnung': 'X'}),
+        'geometrie': 'POINT (12.1 54.1)',
+        'gemeinde_name': 'Rostock',
+        'strasse_name': 'Alfred-Schulze-Str.',
+        'stat_bezirk_name': 'Reutershagen',
+        'bezeichnung': 'Reutershagen',
+      }]},
+    }
+
+
+@pytest.fixture()
+def app():
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': MAPPING})
+  app.solr = FakeSolr()
+  return app
+
+
+def search(app, **kw):
+  args = {'type': 'search', 'class': 'address', 'query': 'alfred'}
+  args.update(kw)
+  resp = Client(app).get('/query', query_string=args)
+  return resp.status_code, json.loads(resp.get_data(as_text=True))
+
+
+def search_resp(app, headers=None, **kw):
+  args = {'type': 'search', 'class': 'address', 'query': 'alfred'}
+  args.update(kw)
+  return Client(app).get('/query', query_string=args, headers=headers)
+
+
+def test_search(app):
+  code, doc = search(app)
+  assert code == 200
+  assert doc['properties']['features_total'] == 2
+  assert 'partial' not in doc['properties']
+  for _, _, kw in app.solr.queries:
+    assert 0 < kw['timeAllowed'] <= 10000
+
+
+def test_timeout_partial(app):
+  app.solr.delays = {'streets': 0.5}
+  start = time.time()
+  code, doc = search(app, timeout=100)
+  assert time.time() - start < 0.4
+  assert code == 200
+  assert doc['properties']['features_total'] == 1
+  assert doc['properties']['partial'] is True
+  assert doc['properties']['skipped_collections'] == ['streets']
+
+
+def test_budget_exhausted_partial(app, monkeypatch):
+  solr_params = Search.solr_params
+
+  def exhausted(search, group):
+    if group[0].name == 'streets':
+      search = copy.copy(search)
+      search.deadline = 0
+    return solr_params(search, group)
+
+  monkeypatch.setattr(Search, 'solr_params', exhausted)
+  code, doc = search(app)
+  assert code == 200
+  assert doc['properties']['partial'] is True
+  assert doc['properties']['skipped_collections'] == ['streets']
+
+
+def test_error_partial(app):
+  app.solr.errors = ('boroughs', )
+  code, doc = search(app)
+  assert code == 200
+  assert doc['properties']['skipped_collections'] == ['boroughs']
+
+  app.solr.errors = ('boroughs', 'streets')
+  code, doc = search(app)
+  assert code == 500
+
+
+def test_time_budget_cap(app):
+  search(app, timeout=999999)
+  for _, _, kw in app.solr.queries:
+    assert kw['timeAllowed'] <= 30000
+
+
+def test_api_key_limit(tmpdir):
+  key_file = tmpdir.join("keys.csv")
+  key_file.write('key,domains,rate,burst\nabc,,1,1\n')
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': MAPPING,
+                 'api_keys_csv': key_file.strpath, 'enable_metrics': True})
+  app.solr = FakeSolr()
+
+  code, _ = search(app, key='abc')
+  assert code == 200
+  code, doc = search(app, key='abc')
+  assert code == 429
+
+  resp = Client(app).get('/metrics')
+  metrics = json.loads(resp.get_data(as_text=True))
+  assert list(metrics['api_keys'].values())[0]['rate_limited'] == 1
+
+
+def test_api_key_workers(tmpdir):
+  key_file = tmpdir.join("keys.csv")
+  key_file.write('key,domains,rate,burst\nabc,,4,4\n')
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': MAPPING,
+                 'api_keys_csv': key_file.strpath, 'workers': 2})
+  app.solr = FakeSolr()
+
+  code, _ = search(app, key='abc')
+  assert code == 200
+  code, _ = search(app, key='abc')
+  assert code == 200
+  code, _ = search(app, key='abc')
+  assert code == 429
+
+
+def test_etag():
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': MAPPING,
+                 'enable_etags': True, 'data_version_ttl': 0, 'max_age_search': 60})
+  app.solr = app.data_versions.solr = FakeSolr()
+  app.solr.alias_map = {'streets': 'streets-1', 'boroughs': 'boroughs-1'}
+
+  resp = search_resp(app)
+  assert resp.status_code == 200
+  assert resp.headers['Cache-Control'] == 'public, max-age=60'
+  etag = resp.headers['ETag']
+
+  num_queries = len(app.solr.queries)
+  resp = search_resp(app, headers={'If-None-Match': etag})
+  assert resp.status_code == 304
+  assert resp.headers['ETag'] == etag
+  # only data version queries
+  assert all(q == '*:*' for _, q, _ in app.solr.queries[num_queries:])
+
+  resp = search_resp(app, headers={'If-None-Match': etag}, query='other')
+  assert resp.status_code == 200
+  assert resp.headers['ETag'] != etag
+
+  # new data after alias switch
+  app.solr.alias_map = {'streets': 'streets-2', 'boroughs': 'boroughs-1'}
+  resp = search_resp(app, headers={'If-None-Match': etag})
+  assert resp.status_code == 200
+  assert resp.headers['ETag'] != etag
+
+
+def test_etag_partial():
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': MAPPING,
+                 'enable_etags': True, 'max_age_search': 60})
+  app.solr = app.data_versions.solr = FakeSolr(errors=('streets', ))
+  resp = search_resp(app)
+  assert resp.status_code == 200
+  assert resp.headers['Cache-Control'] == 'no-cache'
+  assert 'ETag' not in resp.headers
+
+
+def test_json_backend(app):
+  expected = app.collections[1].query('alfred schulze')
+
+  app.query_backend = 'json'
+  code, doc = search(app, query='alfred schulze', peri_coord='12.1,54.1', peri_radius=100,
+                     peri_epsg=4326)
+  assert code == 200
+  assert doc['properties']['features_total'] == 2
+
+  bodies = dict(app.solr.bodies)
+  body = bodies[app.collections[1].name]
+  assert dereference(body['query'], body['params']) == expected
+  assert len(body['query']) < len(expected)
+  assert body['filter'] == ['{!geofilt sfield=geometrie}']
+  assert body['limit'] == 1000
+  assert 0 < body['params']['timeAllowed'] <= 10000
+
+
+GROUPED_MAPPING = '''
+from geocodr.search import Collection, NGramField, SimpleField
+
+class POI(Collection):
+  class_ = 'poi'
+  source_field = 'collection_name'
+  geometry_field = 'geometrie'
+  fields = ('name', )
+  qfields = (NGramField('name_ngram'), SimpleField('name') ^ 2.0)
+
+class Park(POI):
+  name = 'parks'
+
+class School(POI):
+  name = 'schools'
+  min_query_length = 6
+'''
+
+
+class GroupedFakeSolr(FakeSolr):
+  def query(self, collection, q, user_auth=None, timeout=None, **kw):
+    self.queries.append((collection, q, kw))
+    docs = []
+    for name in collection.split(','):
+      docs.append({
+        'id': name + '-1', 'score': 1.0, 'collection_name': name, 'name': name,
+        'json': '{}', 'geometrie': 'POINT (12.1 54.1)',
+      })
+    return {'responseHeader': {}, 'response': {'numFound': len(docs), 'docs': docs}}
+
+
+def test_multi_collection(tmpdir):
+  mapping = tmpdir.join('mapping.py')
+  mapping.write(GROUPED_MAPPING)
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': mapping.strpath,
+                 'multi_collection': True})
+  app.solr = GroupedFakeSolr()
+  park, school = sorted(app.collections, key=lambda c: c.name)
+
+  code, doc = search(app, **{'class': 'poi', 'query': 'stadtpark', 'debug': 'true'})
+  assert code == 200
+  assert len(app.solr.queries) == 1
+  collection, q, kw = app.solr.queries[0]
+  assert sorted(collection.split(',')) == ['parks', 'schools']
+  assert '(filter(collection_name:parks) AND ({}))'.format(park.query('stadtpark')) in q
+  assert '(filter(collection_name:schools) AND ({}))'.format(school.query('stadtpark')) in q
+  assert kw['rows'] == 2000
+  assert sorted(f['properties']['_collection_'] for f in doc['features']) == [
+    'parks', 'schools']
+
+  # schools require a longer query
+  app.solr.queries = []
+  code, doc = search(app, **{'class': 'poi', 'query': 'park'})
+  _, q, _ = app.solr.queries[0]
+  assert 'schools' not in q
+
+
+def test_planner_skipped(tmpdir):
+  mapping = tmpdir.join('mapping.py')
+  mapping.write(GROUPED_MAPPING)
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': mapping.strpath})
+  app.solr = GroupedFakeSolr()
+
+  code, doc = search(app, **{'class': 'poi', 'query': 'park', 'debug': 'true'})
+  assert code == 200
+  assert [c for c, _, _ in app.solr.queries] == ['parks']
+  assert doc['properties']['planner_skipped'] == {
+    'schools': 'query shorter than 6 characters'}
+
+  code, doc = search(app, **{'class': 'poi', 'query': 'park'})
+  assert 'planner_skipped' not in doc['properties']
+
+
+def test_exact_index(app):
+  for c in app.collections:
+    c.exact_index = True
+  try:
+    app.exact_index = ExactIndex(app.solr, app.collections)
+    app.exact_index.refresh()
+  finally:
+    for c in app.collections:
+      del c.exact_index
+  assert app.exact_index.stats()['streets'] == 1
+  title = 'Rostock, Reutershagen, Alfred-Schulze-Str.'
+  assert normalize_title(title) in app.exact_index.titles['streets']
+
+  app.solr.queries = []
+  code, doc = search(app, query='Rostock Reutershagen Alfred-Schulze-Str', debug='true')
+  assert code == 200
+  assert app.solr.queries == []
+  assert doc['properties']['exact_match'] is True
+  assert [f['properties']['_title_'] for f in doc['features']] == [title]
+
+  code, doc = search(app, query='alfred schulze')
+  assert 'exact_match' not in doc['properties']
+  assert app.solr.queries
+
+
+def test_suggest(app):
+  code, doc = search(app, type='suggest')
+  assert code == 400
+
+  for c in app.collections:
+    c.suggest_index = True
+  try:
+    app.suggest_index = SuggestIndex(app.solr, app.collections)
+    app.suggest_index.refresh()
+  finally:
+    for c in app.collections:
+      del c.suggest_index
+
+  app.solr.queries = []
+  code, doc = search(app, type='suggest', query='alfred sch')
+  assert code == 200
+  assert app.solr.queries == []
+  assert doc['features'][0] == {
+    'type': 'Feature',
+    'geometry': None,
+    'properties': {
+      '_title_': 'Rostock, Reutershagen, Alfred-Schulze-Str.',
+      'objektgruppe': 'Streets',
+      'suchklasse': 'Addresses',
+    },
+  }
+
+  code, doc = search(app, type='suggest', query='alfred x')
+  assert doc['features'] == []
+
+
+def test_session_refine():
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': MAPPING,
+                 'session_cache_size': 10})
+  app.solr = FakeSolr()
+
+  code, doc = search(app, query='alfr', session='s1')
+  assert code == 200
+  num_queries = len(app.solr.queries)
+  assert num_queries
+
+  code, refined = search(app, query='alfred', session='s1', debug='true')
+  assert len(app.solr.queries) == num_queries
+  assert refined['properties']['session_refined'] is True
+  # the title of the borough does not contain the query
+  assert len(doc['features']) == 2
+  assert [f['properties']['_collection_'] for f in refined['features']] == ['streets']
+
+  # other sessions, parameters or queries are not refined
+  search(app, query='alfred', session='s2')
+  assert len(app.solr.queries) == num_queries * 2
+  search(app, query='alfred', session='s1', out_epsg='4326')
+  assert len(app.solr.queries) == num_queries * 3
+  search(app, query='alfons', session='s1')
+  assert len(app.solr.queries) == num_queries * 4
+
+
+class MisspelledFakeSolr(FakeSolr):
+  """
+  MisspelledFakeSolr returns no documents for queries with `allfred`.
+  """
+
+  def query(self, collection, q, **kw):
+    resp = FakeSolr.query(self, collection, q, **kw)
+    if 'allfred' in q.lower():
+      resp['response'] = {'numFound': 0, 'docs': []}
+    return resp
+
+
+def test_spell_correction(app):
+  app.solr = MisspelledFakeSolr()
+  code, doc = search(app, query='Allfred-Schultze')
+  assert doc['features'] == []
+
+  for c in app.collections:
+    c.spell_index = True
+  try:
+    app.spell_index = SpellIndex(app.solr, app.collections)
+    app.spell_index.refresh()
+  finally:
+    for c in app.collections:
+      del c.spell_index
+
+  code, doc = search(app, query='Allfred-Schultze')
+  assert code == 200
+  assert doc['properties']['corrected_query'] == 'alfred schulze'
+  assert len(doc['features']) == 2
+
+  # queries with results are not corrected
+  app.solr.queries = []
+  code, doc = search(app, query='alfred schultze')
+  assert 'corrected_query' not in doc['properties']
+  assert len(app.solr.queries) == 2
+
+
+def test_components(app):
+  code, doc = search(app, **{
+    'query': None, 'components.street': 'alfred', 'components.municipality': 'rostock',
+    'debug': 'true',
+  })
+  assert code == 200
+  assert [c for c, _, _ in app.solr.queries] == ['streets']
+  _, q, _ = app.solr.queries[0]
+  assert 'strasse_name:alfred' in q
+  assert 'gemeinde_name:rostock' in q
+  assert 'strasse_name:rostock' not in q
+  assert 'stat_bezirk_name' not in q
+  assert doc['properties']['planner_skipped'] == {'boroughs': "no component 'street'"}
+
+  app.solr.queries = []
+  resp = Client(app).post('/query', data=json.dumps({
+    'type': 'search', 'class': 'address', 'components': {'district': 'reutershagen'},
+  }), content_type='application/json')
+  assert resp.status_code == 200
+  assert sorted(c for c, _, _ in app.solr.queries) == ['boroughs', 'streets']
+
+
+def test_components_empty_query(app):
+  code, doc = search(app, **{'query': '', 'components.street': 'alfred', 'debug': 'true'})
+  assert code == 200
+  assert [c for c, _, _ in app.solr.queries] == ['streets']
+  assert len(doc['features']) == 1
+  assert doc['properties']['planner_skipped'] == {'boroughs': "no component 'street'"}
+
+
+PARCEL_MAPPING = '''
+from geocodr.search import FlstField, NGramField, ParcelCollection
+
+class Parcels(ParcelCollection):
+  class_ = 'parcel'
+  name = 'parcels'
+  geometry_field = 'geometrie'
+  gemarkung_prefix = '13'
+  fields = ('gemarkung_name', )
+  qfields = (NGramField('gemarkung_name_ngram'), FlstField('flst', gemarkung_prefix='13'))
+'''
+
+
+class ParcelFakeSolr(FakeSolr):
+  def query(self, collection, q, user_auth=None, timeout=None, **kw):
+    self.queries.append((collection, q, kw))
+    ids = ['p1']
+    if q.startswith('_query_:"{!terms f=id}'):
+      ids = q[len('_query_:"{!terms f=id}'):-1].split(',')
+    docs = [{
+      'id': id, 'score': 1.0, 'gemarkung_name': 'Krummendorf', 'json': '{}',
+      'geometrie': 'POINT (12.1 54.1)',
+    } for id in ids]
+    return {'responseHeader': {}, 'response': {'numFound': len(docs), 'docs': docs}}
+
+
+def test_parcels(tmpdir):
+  mapping = tmpdir.join('mapping.py')
+  mapping.write(PARCEL_MAPPING)
+  tmpdir.join('parcels.flst').write(
+    '132232001001230001\tp1\n132232001001240000\tp2\n132233001000010000\tp3\n')
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': mapping.strpath,
+                 'index_dir': tmpdir.strpath})
+  app.solr = ParcelFakeSolr()
+
+  code, doc = search(app, **{'class': 'parcel', 'query': '132232-1-123/1'})
+  assert code == 200
+  assert app.solr.bodies[0][1]['query'] == '_query_:"{!terms f=id}p1"'
+  assert [f['properties']['_title_'] for f in doc['features']] == ['Krummendorf']
+
+  code, doc = search(app, **{'class': 'parcel', 'query': '2232 flur 1'})
+  assert app.solr.bodies[1][1]['query'] == '_query_:"{!terms f=id}p1,p2"'
+
+  code, doc = search(app, **{'class': 'parcel', 'query': '132239-1', 'debug': 'true'})
+  assert doc['properties']['planner_skipped'] == {'parcels': 'no parcel for query'}
+  assert len(app.solr.bodies) == 2
+
+  # gemarkung names are searched in Solr
+  code, doc = search(app, **{'class': 'parcel', 'query': 'Krummendorf'})
+  assert 'gemarkung_name_ngram' in app.solr.queries[-1][1]
+  assert len(app.solr.bodies) == 2
+
+  resp = Client(app).post('/query', data=json.dumps({
+    'type': 'search', 'class': 'parcel',
+    'parcels': ['132232-1-123/1', '132233-1-1', '132239-1-1', 'x'],
+  }), content_type='application/json')
+  doc = json.loads(resp.get_data(as_text=True))
+  assert resp.status_code == 200
+  assert app.solr.bodies[-1][1]['query'] == '_query_:"{!terms f=id}p1,p3"'
+  assert sorted(f['properties']['parcel_query'] for f in doc['features']) == [
+    '132232-1-123/1', '132233-1-1']
+  assert doc['properties']['parcels_not_found'] == ['132239-1-1', 'x']
+  assert 'parcels_truncated' not in doc['properties']
+
+
+def test_parcels_truncated(tmpdir):
+  mapping = tmpdir.join('mapping.py')
+  mapping.write(PARCEL_MAPPING)
+  # more parcels in flur 1 than rows
+  tmpdir.join('parcels.flst').write(''.join(
+    '132232001{:05d}0000\tp{}\n'.format(i, i) for i in range(1, 1102)
+  ) + '132233001000010000\tq1\n')
+  app = Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': mapping.strpath,
+                 'index_dir': tmpdir.strpath})
+  app.solr = ParcelFakeSolr()
+
+  code, doc = search(app, **{'class': 'parcel', 'parcels': '132232-1;132233-1-1;132239-1-1'})
+  assert code == 200
+  assert doc['properties']['parcels_not_found'] == ['132239-1-1']
+  assert doc['properties']['parcels_truncated'] is True
+  assert len(doc['features']) == 100
+
+  # the limit of bulk requests defaults to the number of parcels
+  parcels = ['132232-1-{}'.format(i) for i in range(1, 151)]
+  code, doc = search(app, **{'class': 'parcel', 'parcels': ';'.join(parcels)})
+  assert len(doc['features']) == 150
+  assert doc['properties']['parcels_not_found'] == []
+  assert 'parcels_truncated' not in doc['properties']
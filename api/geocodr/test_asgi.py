@@ -0,0 +1,90 @@
+import asyncio
+import json
+import pytest
+
+from urllib.parse import urlencode
+
+from .api import Geocodr
+from .asgi import GeocodrASGI
+from .test_api import MAPPING, FakeSolr
+
+
+class FakeAsyncSolr(FakeSolr):
+  async def query(self, collection, q, user_auth=None, timeout=None, **kw):
+    self.queries.append((collection, q, kw))
+    await asyncio.sleep(self.delays.get(collection, 0))
+    if collection in self.errors:
+      raise ValueError('error for ' + collection)
+    return FakeSolr().query(collection, q)
+
+  async def close(self):
+    pass
+
+
+@pytest.fixture()
+def app():
+  return GeocodrASGI(
+    Geocodr({'solr_url': 'http://localhost:8983/solr', 'mapping': MAPPING}),
+    FakeAsyncSolr(),
+  )
+
+
+def call(app, path, query=None, body=b'', headers=()):
+  messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+  sent = []
+
+  async def receive():
+    return messages.pop(0)
+
+  async def send(message):
+    sent.append(message)
+
+  scope = {
+    'type': 'http',
+    'method': 'POST' if body else 'GET',
+    'path': path,
+    'query_string': urlencode(query or {}).encode('ascii'),
+    'headers': list(headers),
+  }
+  asyncio.run(app(scope, receive, send))
+  assert sent[0]['type'] == 'http.response.start'
+  return sent[0]['status'], dict(sent[0]['headers']), sent[1]['body']
+
+
+def search(app, **kw):
+  args = {'type': 'search', 'class': 'address', 'query': 'alfred'}
+  args.update(kw)
+  status, _, body = call(app, '/query', args)
+  return status, json.loads(body.decode('utf-8'))
+
+
+def test_search(app):
+  code, doc = search(app)
+  assert code == 200
+  assert doc['properties']['features_total'] == 2
+  assert 'partial' not in doc['properties']
+
+
+def test_json_post(app):
+  body = json.dumps({'type': 'search', 'class': 'address', 'query': 'alfred'})
+  status, headers, data = call(app, '/query', body=body.encode('utf-8'),
+                               headers=[(b'content-type', b'application/json')])
+  assert status == 200
+  assert headers[b'content-type'] == b'application/json; charset=utf-8'
+  assert json.loads(data.decode('utf-8'))['properties']['features_total'] == 2
+
+
+def test_timeout_partial(app):
+  app.solr.delays = {'streets': 0.5}
+  code, doc = search(app, timeout=100)
+  assert code == 200
+  assert doc['properties']['skipped_collections'] == ['streets']
+
+
+def test_errors(app):
+  app.solr.errors = ('boroughs', 'streets')
+  code, doc = search(app)
+  assert code == 500
+
+  code, doc = search(app, type='invalid')
+  assert code == 400
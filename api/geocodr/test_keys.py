@@ -1,9 +1,12 @@
+import datetime
+import os
 import pytest
+import time
 
 from werkzeug.test import EnvironBuilder
 from werkzeug.wrappers import Request
 
-from .keys import APIKeys
+from .keys import APIKeys, LimitExceeded
 
 
 @pytest.fixture()
@@ -48,3 +51,96 @@ def test_api_key(key_file, key, referrer, permitted):
   builder = EnvironBuilder(method='GET', query_string={'key': key}, headers=headers)
   req = Request(builder.get_environ())
   assert a.is_permitted(req) == permitted
+
+
+def key_request(key):
+  builder = EnvironBuilder(method='GET', query_string={'key': key})
+  return Request(builder.get_environ())
+
+
+@pytest.fixture()
+def limit_file(tmpdir):
+  limit_file = tmpdir.join("keys.csv")
+  limit_file.write(
+    'key,domains,rate,burst,daily_quota,name\n'
+    'unlimited,,,,,\n'
+    'limited,,10,2,,limited-app\n'
+    'quota,,,,3,\n'
+    'slow,,0.5,,,\n'
+  )
+  yield limit_file.strpath
+
+
+def test_rate_limit(limit_file):
+  a = APIKeys(limit_file)
+  req = key_request('limited')
+  a.consume(req)
+  a.consume(req)
+  with pytest.raises(LimitExceeded) as exc:
+    a.consume(req)
+  assert exc.value.retry_after == 1
+
+  # tokens are refilled at 10 per second
+  a.usage['limited'].updated -= 0.1
+  a.consume(req)
+
+  for _ in range(100):
+    a.consume(key_request('unlimited'))
+
+  m = a.metrics()
+  assert m['limited-app']['requests'] == 4
+  assert m['limited-app']['rate_limited'] == 1
+  assert 'limited' not in m
+  assert 'unlimited' not in m
+  assert len(m) == 2
+
+
+def test_fractional_rate_limit(limit_file):
+  a = APIKeys(limit_file)
+  req = key_request('slow')
+  a.consume(req)
+  with pytest.raises(LimitExceeded) as exc:
+    a.consume(req)
+  assert exc.value.retry_after == 2
+
+  # a single token is refilled after 2 seconds
+  a.usage['slow'].updated -= 2
+  a.consume(req)
+
+
+def test_worker_share(limit_file):
+  a = APIKeys(limit_file, workers=4)
+  assert a.keys['limited'].rate == 2.5
+  # each worker can send at least one request
+  assert a.keys['limited'].burst == 1
+  assert a.keys['quota'].daily_quota == 1
+  assert a.keys['slow'].rate == 0.125
+
+  req = key_request('limited')
+  a.consume(req)
+  with pytest.raises(LimitExceeded):
+    a.consume(req)
+
+
+def test_daily_quota(limit_file):
+  a = APIKeys(limit_file)
+  req = key_request('quota')
+  for _ in range(3):
+    a.consume(req)
+  with pytest.raises(LimitExceeded) as exc:
+    a.consume(req)
+  assert 0 < exc.value.retry_after <= 24 * 3600 + 1
+
+  # quota is reset on the next day
+  a.usage['quota'].day -= datetime.timedelta(days=1)
+  a.consume(req)
+
+
+def test_reload(limit_file):
+  a = APIKeys(limit_file, check_interval=0)
+  assert not a.is_permitted(key_request('new'))
+
+  with open(limit_file, 'a') as f:
+    f.write('new,,,,,\n')
+  os.utime(limit_file, (time.time() + 10, time.time() + 10))
+  assert a.is_permitted(key_request('new'))
@@ -0,0 +1,52 @@
+import os
+import signal
+import threading
+import time
+
+from .prefork import Supervisor
+
+
+def wait_for_files(dirname, num, timeout=5.0):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    files = os.listdir(dirname)
+    if len(files) >= num:
+      return sorted(files)
+    time.sleep(0.02)
+  raise AssertionError('missing files in {}'.format(dirname))
+
+
+def test_supervisor_restart(tmpdir):
+  pids = tmpdir.mkdir('pids').strpath
+
+  def serve():
+    open(os.path.join(pids, str(os.getpid())), 'w').close()
+    time.sleep(30)
+
+  sup = Supervisor(serve=serve, workers=2, restart_delay=0, graceful_timeout=1.0)
+
+  def control():
+    first = wait_for_files(pids, 2)
+    os.kill(int(first[0]), signal.SIGKILL)
+    wait_for_files(pids, 3)
+    sup.stop()
+
+  t = threading.Thread(target=control)
+  t.start()
+  handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+  try:
+    sup.run()
+  finally:
+    signal.signal(signal.SIGTERM, handlers[0])
+    signal.signal(signal.SIGINT, handlers[1])
+  t.join()
+
+  assert len(os.listdir(pids)) == 3
+  assert not sup.children
+  for pid in os.listdir(pids):
+    try:
+      os.kill(int(pid), 0)
+    except ProcessLookupError:
+      pass
+    else:
+      raise AssertionError('worker {} is still running'.format(pid))
@@ -1,11 +1,13 @@
 import pytest
 
 from .search import (
+  Collection,
   SimpleField,
   NGramField,
   GermanNGramField,
   PrefixField,
   Only,
+  FlstField,
   is_exclusive,
 )
 
@@ -81,3 +83,79 @@ def test_only(input, check, output):
     assert is_exclusive(q)
   else:
     assert not is_exclusive(q)
+
+
+class TermCollection(Collection):
+  name = 'terms'
+  qfields = (
+    GermanNGramField('name_ngram') ^ 2.0,
+    SimpleField('name'),
+    Only(r'^\d+$', SimpleField('number')),
+  )
+
+
+class CustomCollection(TermCollection):
+  name = 'custom'
+
+  def queries_for_term(self, term):
+    return SimpleField('custom').query(term)
+
+
+def test_compiled_query():
+  expected = TermCollection().query('Straße 12')
+
+  coll = TermCollection()
+  cache = coll.enable_term_cache(10)
+  assert coll.query('Straße 12') == expected
+  assert coll.query('Straße 12') == expected
+  assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 2}
+  assert 'Only(/^\\d+$/) -> SimpleField(number)' in coll.describe()
+
+  # each collection has its own cache
+  other = NumberCollection()
+  other.enable_term_cache(10)
+  other.query('Straße 12')
+  assert cache.stats()['size'] == 2
+
+
+def test_compiled_query_override():
+  coll = CustomCollection()
+  cache = coll.enable_term_cache(10)
+  assert coll.query('abc') == '_query_:"{!maxscore tie=0}(custom:abc)"'
+  assert len(cache) == 0
+
+
+def test_term_cache_size():
+  coll = TermCollection()
+  cache = coll.enable_term_cache(3)
+  coll.query('a b c d e f')
+  assert len(cache) == 3
+
+
+class NumberCollection(Collection):
+  name = 'numbers'
+  qfields = (
+    PrefixField('street', 4),
+    Only(r'^\d+$', SimpleField('number')),
+  )
+  required_qfields = (qfields[1], )
+
+
+def test_skip_reason():
+  coll = NumberCollection()
+  coll.enable_term_cache(10)
+  assert coll.skip_reason('Straße 12') is None
+  assert coll.skip_reason('St 12') == "no query for term 'St'"
+  assert coll.skip_reason('Straße') == (
+    'no query for required field Only(/^\\d+$/) -> SimpleField(number)')
+  assert TermCollection().skip_reason('abc') is None
+
+
+@pytest.mark.parametrize('input,output', [
+  ['132232-1-123/1', 'flst:132232001001230001'],
+  ['132232-1', 'flst:132232001*'],
+  ['krummendorf', None],
+  ['157/1', None],
+])
+def test_flst(input, output):
+  assert FlstField('flst', gemarkung_prefix='13').query(input) == output
@@ -1,6 +1,9 @@
+import asyncio
 import pytest
+import requests
+import time
 
-from .solr import strip_special_chars
+from .solr import AsyncSolr, Solr, strip_special_chars
 
 
 @pytest.mark.parametrize('input,output', [
@@ -13,3 +16,109 @@ from .solr import strip_special_chars
 ])
 def test_strip_special_chars(input, output):
   assert strip_special_chars(input) == output
+
+
+class FakeResponse(object):
+  def __init__(self, status_code=200, doc=None):
+    self.status_code = status_code
+    self.ok = status_code < 400
+    self.doc = doc or {}
+
+  def json(self):
+    return self.doc
+
+
+class FakeSession(object):
+  """
+  FakeSession returns responses for each node after the configured delay.
+  """
+
+  def __init__(self, delays=None, errors=()):
+    self.delays = delays or {}
+    self.errors = errors
+    self.urls = []
+
+  def get(self, url, params=None, auth=None, timeout=None):
+    self.urls.append(url)
+    node = url.split('/')[2]
+    time.sleep(self.delays.get(node, 0))
+    if node in self.errors:
+      raise requests.ConnectionError(node)
+    return FakeResponse(doc={'node': node})
+
+
+def test_pick_node_in_flight():
+  s = Solr('http://a/solr,http://b/solr')
+  a = s.pick_node()
+  b = s.pick_node()
+  assert a.url == 'http://a/solr'
+  assert b.url == 'http://b/solr'
+  a.in_flight = 0
+  assert s.pick_node().url == 'http://a/solr'
+
+
+def test_circuit_breaker():
+  s = Solr('http://a/solr,http://b/solr', failure_threshold=2, reset_timeout=60)
+  s._s = FakeSession(errors=('a',))
+  for _ in range(4):
+    assert s.query('c', '*')['node'] == 'b'
+  # a is skipped after two failures
+  assert s.nodes[0].is_open(time.time())
+  assert s._s.urls.count('http://a/solr/c/select') == 2
+
+
+def test_hedged_request():
+  s = Solr('http://a/solr,http://b/solr', hedge_percentile=50, hedge_min_delay=0.01)
+  s._s = FakeSession()
+  s.nodes[0].latencies.extend([0.001] * 50)
+  s._s.delays = {'a': 0.5}
+  start = time.time()
+  assert s.query('c', '*')['node'] == 'b'
+  assert time.time() - start < 0.4
+  assert s.hedges_in_flight == 0
+
+
+def test_hedge_limit():
+  s = Solr('http://a/solr,http://b/solr', hedge_percentile=50, hedge_min_delay=0.01,
+           max_hedges=1)
+  s._s = FakeSession()
+  s.nodes[0].latencies.extend([0.001] * 50)
+  s._s.delays = {'a': 0.1}
+  s.hedges_in_flight = 1
+  assert s.query('c', '*')['node'] == 'a'
+  assert s.hedges_skipped == 1
+
+
+@pytest.mark.parametrize('url,hedge_percentile', [
+  ('http://a/solr', 50),
+  ('http://a/solr,http://b/solr', 0),
+])
+def test_no_hedge_without_executor(url, hedge_percentile):
+  s = Solr(url, hedge_percentile=hedge_percentile)
+  s._s = FakeSession()
+  s.nodes[0].latencies.extend([0.001] * 50)
+  assert s.query('c', '*')['node'] == 'a'
+  assert s._executor is None
+
+
+def test_async_hedged_request():
+  s = AsyncSolr('http://a/solr,http://b/solr', hedge_percentile=50, hedge_min_delay=0.01)
+  s.nodes[0].latencies.extend([0.001] * 50)
+  delays = {'a': 0.5}
+
+  async def get(node, collection, params, user_auth, timeout, body=None):
+    name = node.url.split('/')[2]
+    await asyncio.sleep(delays.get(name, 0))
+    return FakeResponse(doc={'node': name})
+
+  s._get = get
+
+  async def query():
+    node = s.pick_node()
+    return await s._hedged_get(node, 'c', {'q': '*'}, None, None)
+
+  start = time.time()
+  assert asyncio.run(query()).json()['node'] == 'b'
+  assert time.time() - start < 0.4
+  assert [n.in_flight for n in s.nodes] == [0, 0]
+  assert s.hedges_in_flight == 0
@@ -11,6 +11,7 @@ setup(
     'console_scripts': [
       'geocodr=geocodr.cli:main',
       'geocodr-api=geocodr.api:main',
+      'geocodr-bench=geocodr.bench:main',
     ],
   },
   install_requires=[
@@ -20,4 +21,7 @@ setup(
     'waitress',
     'Werkzeug',
   ],
+  extras_require={
+    'asgi': ['httpx'],
+  },
 )
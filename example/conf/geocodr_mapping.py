@@ -48,6 +48,12 @@ class Street(Collection):
     NGramField('stat_bezirk_name_ngram') ^ 1.0,
     SimpleField('stat_bezirk_name') ^ 3.0,
   )
+  # fields for structured requests
+  components = {
+    'street': qfields[0:2],
+    'municipality': qfields[2:4],
+    'district': qfields[4:6],
+  }
   sort = 'score DESC, gemeinde_name ASC, stat_bezirk_name ASC, strasse_name ASC'
   collection_rank = 2
 
@@ -71,6 +77,10 @@ class Borough(Collection):
     NGramField('gemeinde_name_ngram') ^ 1.5,
     SimpleField('gemeinde_name') ^ 2.5,
   )
+  components = {
+    'district': qfields[0:2],
+    'municipality': qfields[2:4],
+  }
   sort = 'score DESC, gemeinde_name ASC, bezeichnung ASC'
   collection_rank = 1
 
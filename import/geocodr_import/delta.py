@@ -0,0 +1,112 @@
+"""
+The delta module compares CSV imports with the manifest of a previous import.
+"""
+
+import csv
+import hashlib
+import io
+import os
+
+
+def parse_record(record):
+  """
+  Return the values of a single CSV `record`.
+
+  >>> parse_record(b'1,"a\\nb",c\\n')
+  ['1', 'a\\nb', 'c']
+  """
+  return next(csv.reader(io.StringIO(record.decode('utf-8'))))
+
+
+def record_hash(record):
+  """
+  Return a hash of the content of a CSV `record`, ignoring the line ending.
+  """
+  return hashlib.sha1(record.rstrip(b'\r\n')).hexdigest()
+
+
+class Manifest(object):
+  """
+  Manifest stores the ID and content hash of each row of an import.
+  It is stored as a local CSV file next to the import data, so that changes
+  can be detected without scanning Solr.
+  """
+
+  def __init__(self, hashes=None):
+    self.hashes = hashes if hashes is not None else {}
+
+  def __len__(self):
+    return len(self.hashes)
+
+  @classmethod
+  def load(cls, fname):
+    hashes = {}
+    with open(fname, 'r', newline='') as f:
+      for row in csv.DictReader(f):
+        hashes[row['id']] = row['hash']
+    return cls(hashes)
+
+  def save(self, fname):
+    """
+    Write manifest to `fname`. The file is replaced atomically.
+    """
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w', newline='') as f:
+      writer = csv.writer(f)
+      writer.writerow(['id', 'hash'])
+      for row in self.hashes.items():
+        writer.writerow(row)
+    os.replace(tmp_fname, fname)
+
+
+def id_index(header, id_field='id'):
+  """
+  Return the column index of `id_field` in the CSV `header` record.
+  """
+  fields = parse_record(header)
+  if id_field not in fields:
+    raise ValueError('CSV header has no {} column'.format(id_field))
+  return fields.index(id_field)
+
+
+def record_manifest(records, idx, manifest):
+  """
+  Pass through all `records` and add their ID (from column `idx`) and
+  content hash to `manifest`.
+  """
+  for record in records:
+    manifest.hashes[parse_record(record)[idx]] = record_hash(record)
+    yield record
+
+
+class Delta(object):
+  """
+  Delta compares records with the `previous` Manifest. `changed_records`
+  only passes through records that were added or changed and records all
+  records in the `current` Manifest. `removed_ids` is available after all
+  records were consumed.
+  """
+
+  def __init__(self, previous, idx):
+    self.previous = previous
+    self.current = Manifest()
+    self.idx = idx
+    self.added = 0
+    self.changed = 0
+
+  def changed_records(self, records):
+    for record in records:
+      curr_id = parse_record(record)[self.idx]
+      h = record_hash(record)
+      self.current.hashes[curr_id] = h
+      prev_h = self.previous.hashes.get(curr_id)
+      if prev_h == h:
+        continue
+      if prev_h is None:
+        self.added += 1
+      else:
+        self.changed += 1
+      yield record
+
+  def removed_ids(self):
+    return [i for i in self.previous.hashes if i not in self.current.hashes]
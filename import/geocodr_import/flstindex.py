@@ -0,0 +1,88 @@
+"""
+The flstindex module writes the parcel key index of a collection for
+geocodr-api --index-dir.
+"""
+
+import argparse
+import csv
+import logging
+import re
+import time
+
+
+log = logging.getLogger(__name__)
+
+re_non_digits = re.compile(r'\D')
+
+
+def normalize_key(value):
+  """
+  Return the 18 digit parcel key (Gemarkung, Flur, Zähler and Nenner) of
+  the parcel identification `value`, or None if the value is invalid.
+  Parcels without Nenner get the Nenner 0000.
+
+  >>> normalize_key('132232001001230001__')
+  '132232001001230001'
+  >>> normalize_key('13223200100123____')
+  '132232001001230000'
+  >>> normalize_key('1322') is None
+  True
+  """
+  key = re_non_digits.sub('', value or '')
+  if len(key) == 14:
+    key += '0000'
+  if len(key) != 18:
+    return None
+  return key
+
+
+def write_index(fh, out, key_column, id_column='id'):
+  """
+  Read all rows from the CSV file `fh` and write the sorted index with the
+  parcel key and the ID of each row to `out`. Returns the number of written
+  and skipped rows.
+  """
+  entries = []
+  skipped = 0
+  for row in csv.DictReader(fh):
+    key = normalize_key(row.get(key_column))
+    if key is None:
+      skipped += 1
+      continue
+    entries.append((key, row[id_column]))
+
+  entries.sort()
+  for key, id in entries:
+    out.write('{}\t{}\n'.format(key, id))
+  return len(entries), skipped
+
+
+def main():
+  logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+  )
+
+  parser = argparse.ArgumentParser(
+    description='Write the parcel key index of a collection CSV file for geocodr-api.',
+    epilog='Example: geocodr-flst-index --key-column flurstueckskennzeichen '
+           'parcels.csv index/parcels.flst',
+  )
+  parser.add_argument("csv", help='CSV file of the collection (e.g. from geocodr-tocsv)')
+  parser.add_argument("index", help='index file to write (<collection>.flst)')
+  parser.add_argument("--key-column", required=True,
+                      help='column with the parcel identification')
+  parser.add_argument("--id-column", default='id', help='column with the unique ID')
+
+  args = parser.parse_args()
+
+  start = time.time()
+  with open(args.csv, 'r', newline='') as fi, open(args.index, 'w') as fo:
+    written, skipped = write_index(fi, fo, args.key_column, args.id_column)
+  if skipped:
+    log.warning('skipped %d rows without valid parcel identification', skipped)
+  log.info('wrote %d parcel keys in %.2fs', written, time.time() - start)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,78 @@
+"""
+The plan module describes which collections are imported from which CSV files.
+"""
+
+import json
+
+from os import path
+
+
+class ImportSpec(object):
+  """
+  ImportSpec describes the import of a single collection.
+  """
+
+  def __init__(self, collection, csv, config_name=None, num_shards=2, replication_factor=2,
+               manifest=None):
+    self.collection = collection
+    self.csv = csv
+    self.config_name = config_name or collection
+    self.num_shards = num_shards
+    self.replication_factor = replication_factor
+    self.manifest = manifest
+
+  def __repr__(self):
+    return '<ImportSpec {} from {}>'.format(self.collection, self.csv)
+
+
+def load_plan(fname, num_shards=2, replication_factor=2):
+  """
+  Load all ImportSpecs from a JSON plan file. Relative file names are
+  relative to the plan file. Example::
+
+    {
+      "collections": [
+        {"collection": "streets", "csv": "csv/streets.csv", "num_shards": 1},
+        {"collection": "boroughs", "csv": "csv/boroughs.csv",
+         "config_name": "boroughs", "manifest": "boroughs.manifest"}
+      ]
+    }
+  """
+  with open(fname, 'r') as f:
+    doc = json.load(f)
+
+  base_dir = path.dirname(path.abspath(fname))
+
+  specs = []
+  for c in doc['collections']:
+    manifest = c.get('manifest')
+    if manifest:
+      manifest = path.join(base_dir, manifest)
+    specs.append(ImportSpec(
+      collection=c['collection'],
+      csv=path.join(base_dir, c['csv']),
+      config_name=c.get('config_name'),
+      num_shards=c.get('num_shards', num_shards),
+      replication_factor=c.get('replication_factor', replication_factor),
+      manifest=manifest,
+    ))
+  return specs
+
+
+def plan_from_mapping(mapping, csv_dir, num_shards=2, replication_factor=2):
+  """
+  Return ImportSpecs for all collections of a geocodr mapping file. The CSV
+  file for each collection is named after the collection and located in
+  `csv_dir`. Requires geocodr.
+  """
+  from geocodr.mapping import load_collections
+
+  specs = []
+  for coll in load_collections(mapping):
+    specs.append(ImportSpec(
+      collection=coll.name,
+      csv=path.join(csv_dir, coll.name + '.csv'),
+      num_shards=num_shards,
+      replication_factor=replication_factor,
+    ))
+  return specs
@@ -1,16 +1,304 @@
 import argparse
 import logging
+import os
+import sys
 import textwrap
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+from .delta import (
+  Delta,
+  Manifest,
+  id_index,
+  record_manifest,
+)
+from .plan import (
+  ImportSpec,
+  load_plan,
+  plan_from_mapping,
+)
 from .solr import (
   SolrCloud,
   ignore_solr_error,
 )
+from .upload import (
+  iter_csv_records,
+  iter_record_chunks,
+  upload_chunks,
+)
+from .warmup import (
+  Warmup,
+  load_queries,
+)
 
 
 log = logging.getLogger('geocodr_import.post')
 
+# Number of IDs for each delete request of a --delta import.
+DELETE_BATCH_SIZE = 1000
+
+
+class VerificationError(Exception):
+  pass
+
+
+def post_csv(cs, collection, fname, args, manifest=None):
+  """
+  Post all rows from CSV file `fname` into `collection` (without commit).
+  Records the ID and content hash of each row in `manifest`, if set.
+  Returns the number of posted rows.
+  """
+  with open(fname, 'rb') as f:
+    records = iter_csv_records(f)
+    header = next(records, None)
+    if header is None:
+      log.warning('%s is empty', fname)
+      return 0
+    if manifest is not None:
+      records = record_manifest(records, id_index(header, args.id_field), manifest)
+    throughput = upload_chunks(
+      cs, collection,
+      iter_record_chunks(header, records, int(args.chunk_size * 1024 * 1024)),
+      workers=args.workers,
+      retries=args.retries,
+      transport=args.transport,
+      compresslevel=args.gzip_level,
+    )
+    return throughput.rows
+
+
+def import_delta(cs, spec, args):
+  """
+  Post only added and changed rows of `spec.csv` into the live collection
+  and delete removed rows. Changes are detected by comparing the rows with
+  the `spec.manifest` of the previous import.
+  """
+  collection = spec.collection
+  if not os.path.exists(spec.manifest):
+    raise VerificationError(
+      'manifest {} does not exist, make a full import with --manifest first'.format(
+        spec.manifest))
+  if collection not in cs.list_aliases().json()['aliases']:
+    raise VerificationError('alias {} does not exist, make a full import first'.format(
+      collection))
+
+  previous = Manifest.load(spec.manifest)
+
+  log.info('posting changed data from %s', spec.csv)
+  with open(spec.csv, 'rb') as f:
+    records = iter_csv_records(f)
+    header = next(records, None)
+    if header is None:
+      raise VerificationError('{} is empty'.format(spec.csv))
+    delta = Delta(previous, id_index(header, args.id_field))
+    upload_chunks(
+      cs, collection,
+      iter_record_chunks(
+        header, delta.changed_records(records), int(args.chunk_size * 1024 * 1024)),
+      workers=args.workers,
+      retries=args.retries,
+      transport=args.transport,
+      compresslevel=args.gzip_level,
+    )
+
+  removed = delta.removed_ids()
+  for i in range(0, len(removed), DELETE_BATCH_SIZE):
+    cs.delete_ids(collection, removed[i:i + DELETE_BATCH_SIZE])
+
+  log.info('%s: %d rows added, %d changed and %d removed (%d rows total)',
+           collection, delta.added, delta.changed, len(removed), len(delta.current))
+
+  if delta.added or delta.changed or removed:
+    log.info('committing %s', collection)
+    cs.commit(collection)
+
+  delta.current.save(spec.manifest)
+
+
+def wait_for_replicas(cs, collection, timeout, interval=2.0):
+  """
+  Wait until all replicas of `collection` are active. Raises
+  VerificationError after `timeout` seconds.
+  """
+  deadline = time.time() + timeout
+  while True:
+    inactive = cs.inactive_replicas(collection)
+    if not inactive:
+      return
+    if time.time() > deadline:
+      raise VerificationError('replicas of {} are not active: {}'.format(
+        collection, ', '.join(inactive)))
+    log.info('waiting for %d replicas of %s', len(inactive), collection)
+    time.sleep(interval)
+
+
+def build_collection(cs, spec, new_collection, args, manifest=None, warmup=None,
+                     current_collection=None):
+  """
+  Create `new_collection` and import all rows of `spec.csv`. Verifies that
+  all rows are searchable after the commit, optionally merges the index
+  segments, waits for all replicas and runs the `warmup`, if set.
+  """
+  with ignore_solr_error():
+    log.info('deleting old collection %s', new_collection)
+    cs.delete_collection(new_collection)
+
+  log.info('creating new collection %s', new_collection)
+  cs.create_collection(
+    new_collection,
+    config_name=spec.config_name,
+    num_shards=spec.num_shards,
+    replication_factor=spec.replication_factor,
+  )
+
+  log.info('posting new data from %s', spec.csv)
+  rows = post_csv(cs, new_collection, spec.csv, args, manifest=manifest)
+
+  log.info('committing %s', new_collection)
+  cs.commit(new_collection)
+
+  num_found = cs.count(new_collection)
+  if num_found != rows:
+    raise VerificationError('{} contains {} documents, but {} rows were posted'.format(
+      new_collection, num_found, rows))
+
+  if args.optimize_segments:
+    log.info('merging %s into %d segments', new_collection, args.optimize_segments)
+    cs.optimize(new_collection, max_segments=args.optimize_segments)
+
+  if args.wait_replicas:
+    wait_for_replicas(cs, new_collection, args.wait_replicas)
+
+  if warmup:
+    warmup.run(cs, spec.collection, new_collection, current_collection)
+
+
+def link_aliases(cs, links, previous, zk_client=None):
+  """
+  Point the aliases to the new collections (`links` are (alias, collection)
+  pairs). With a ZooKeeper `zk_client`, all aliases are changed with a
+  single write. Otherwise each alias is changed with CREATEALIAS, as Solr
+  only supports one alias for each call, and all changed aliases are
+  restored to their `previous` collection if one of the calls fails.
+
+  >>> class FakeSolrCloud(object):
+  ...   def __init__(self, aliases, fail):
+  ...     self.aliases = aliases
+  ...     self.fail = fail
+  ...   def alias(self, collection, alias):
+  ...     if collection == self.fail:
+  ...       raise ValueError('failed ' + collection)
+  ...     self.aliases[alias] = collection
+  ...   def delete_alias(self, alias):
+  ...     del self.aliases[alias]
+  >>> cs = FakeSolrCloud({'a': 'a-1', 'b': 'b-1'}, fail='b-2')
+  >>> link_aliases(cs, [('a', 'a-2'), ('c', 'c-1'), ('b', 'b-2')], {'a': 'a-1', 'b': 'b-1'})
+  Traceback (most recent call last):
+  ...
+  ValueError: failed b-2
+  >>> sorted(cs.aliases.items())
+  [('a', 'a-1'), ('b', 'b-1')]
+  """
+  if zk_client is not None:
+    from .zk import switch_aliases
+    switch_aliases(zk_client, dict(links))
+    return
+
+  switched = []
+  try:
+    for alias, collection in links:
+      cs.alias(collection, alias)
+      switched.append(alias)
+  except Exception:
+    for alias in reversed(switched):
+      try:
+        if previous.get(alias):
+          log.warning('restoring alias %s to %s', alias, previous[alias])
+          cs.alias(previous[alias], alias)
+        else:
+          log.warning('removing new alias %s', alias)
+          cs.delete_alias(alias)
+      except Exception:
+        log.exception('restoring alias %s failed', alias)
+    raise
+
+
+def import_collections(cs, specs, args, warmup=None):
+  """
+  Build new collections for all `specs` with up to `args.parallel` imports
+  at the same time. The aliases are only switched after all collections
+  were successfully imported (and warmed up). Returns False if any import
+  failed.
+  """
+  existing = cs.list_collections().json()['collections']
+  for spec in specs:
+    if spec.collection in existing:
+      log.error('target collection %s exists.', spec.collection)
+      return False
+
+  aliases = cs.list_aliases().json()['aliases']
+
+  new_collections = {}
+  for spec in specs:
+    # check if we should insert into collection-1 or collection-2
+    current_collection = aliases.get(spec.collection)
+    if current_collection and current_collection.endswith('-1'):
+      new_collections[spec.collection] = spec.collection + '-2'
+    else:
+      new_collections[spec.collection] = spec.collection + '-1'
+
+  manifests = {}
+  for spec in specs:
+    if spec.manifest:
+      manifests[spec.collection] = Manifest()
+
+  failed = False
+  with ThreadPoolExecutor(max_workers=args.parallel) as e:
+    futures = []
+    for spec in specs:
+      futures.append((spec, e.submit(
+        build_collection, cs, spec, new_collections[spec.collection], args,
+        manifest=manifests.get(spec.collection),
+        warmup=warmup,
+        current_collection=aliases.get(spec.collection),
+      )))
+
+    for spec, f in futures:
+      try:
+        f.result()
+      except Exception:
+        log.exception('import of %s failed', spec.collection)
+        failed = True
+
+  if failed:
+    log.error('not linking any alias, as not all collections were imported')
+    return False
+
+  links = [(spec.collection, new_collections[spec.collection]) for spec in specs]
+  for alias, collection in links:
+    log.info('linking %s to %s', collection, alias)
+  client = None
+  if args.zk_hosts:
+    from kazoo.client import KazooClient
+    client = KazooClient(hosts=args.zk_hosts)
+    client.start()
+  try:
+    link_aliases(cs, links, aliases, zk_client=client)
+  except Exception:
+    log.exception('linking aliases failed')
+    return False
+  finally:
+    if client is not None:
+      client.stop()
+
+  for spec in specs:
+    if spec.manifest:
+      log.info('writing manifest %s', spec.manifest)
+      manifests[spec.collection].save(spec.manifest)
+
+  return True
+
 
 def main():
   curr_help = """
@@ -32,8 +320,27 @@ def main():
         - Remove any existing collection with the selected name.
         - Create the new collection by using the configset with the same
             name as --collection.
-        - Post --csv file into new collection.
+        - Post --csv file in chunks of --chunk-size MB from --workers parallel
+            workers into new collection. Failed chunks are retried up to
+            --retries times.
+        - Commit new collection once all chunks are posted and verify the
+            number of documents.
+        - Merge the index into --optimize-segments segments, if set.
+        - Wait until all replicas of the new collection are active, if
+            --wait-replicas is set.
+        - Replay --warmup-queries against the new collection, if set. The
+            alias is not modified if the new collection is still slower than
+            the current collection after --warmup-retries.
         - Create/modify alias named after --collection to the new collection.
+        - Write --manifest with the ID and content hash of each row, if set.
+
+    Multiple collections can be imported with --plan or --mapping instead of
+    --collection and --csv. Up to --parallel collections are built at the same
+    time. Aliases are only modified after all collections are imported.
+
+    Delta imports (--delta) skip all steps above. They compare --csv with the
+    --manifest of the previous import and only post added and changed rows
+    into the existing collection. Removed rows are deleted by their ID.
         """
   logging.basicConfig(
     level=logging.INFO,
@@ -47,61 +354,145 @@ def main():
     formatter_class=argparse.RawDescriptionHelpFormatter,
   )
   parser.add_argument("--url", default="http://localhost:8983/solr")
-  parser.add_argument("--csv", required=True, help='csv data file to import')
-  parser.add_argument("--collection", required=True,
+  parser.add_argument("--csv", help='csv data file to import')
+  parser.add_argument("--collection",
                       help='name of the collection to import')
   parser.add_argument("--config-name",
                       help='name of the config set (stored in ZooKeeper). '
                            'Defaults to the name of your collection.')
 
-  parser.add_argument("--solr-num-shards", default=2,
+  parser.add_argument("--plan",
+                      help='JSON file with collections, CSV files and config sets to import')
+  parser.add_argument("--mapping",
+                      help='import all collections of this geocodr mapping file '
+                           '(CSV files from --csv-dir), if --collection is not set. '
+                           'Required for --warmup-queries.')
+  parser.add_argument("--csv-dir", default='.',
+                      help='directory with a <collection>.csv file for each collection '
+                           'of --mapping')
+  parser.add_argument("--parallel", type=int, default=2,
+                      help='number of collections to import at the same time')
+
+  parser.add_argument("--solr-num-shards", type=int, default=2,
                       help='number of shards for new collection')
-  parser.add_argument("--solr-replication-factor", default=2,
+  parser.add_argument("--solr-replication-factor", type=int, default=2,
                       help='replication factor for new collection')
 
-  args = parser.parse_args()
-  cs = SolrCloud(args.url)
+  parser.add_argument("--chunk-size", type=float, default=32,
+                      help='size of each posted CSV chunk in MB')
+  parser.add_argument("--workers", type=int, default=4,
+                      help='number of parallel workers posting chunks')
+  parser.add_argument("--retries", type=int, default=3,
+                      help='number of retries for each failed chunk')
+  parser.add_argument("--solr-timeout", type=float, default=300,
+                      help='seconds to wait for the response of each update or commit request '
+                           'before it fails (and is retried)')
+  parser.add_argument("--transport", choices=['csv', 'json'], default='csv',
+                      help='post chunks as CSV or convert them to gzip compressed '
+                           'JSON documents')
+  parser.add_argument("--gzip-level", type=int, default=6,
+                      help='gzip compression level for --transport json')
 
-  collection = args.collection
-  if args.config_name:
-    config_name = args.config_name
-  else:
-    config_name = collection
+  parser.add_argument("--optimize-segments", type=int,
+                      help='merge the index of the new collection into this number of '
+                           'segments (recommended for read-only collections)')
+  parser.add_argument("--wait-replicas", type=float, nargs='?', const=300, metavar='TIMEOUT',
+                      help='wait up to TIMEOUT seconds (default 300) until all replicas of the '
+                           'new collection are active, before the alias is modified')
 
-  start = time.time()
+  parser.add_argument("--manifest",
+                      help='file with ID and content hash of each imported row. '
+                           'Required for --delta.')
+  parser.add_argument("--delta", action='store_true',
+                      help='only import changes since the import of --manifest '
+                           'into the existing collection')
+  parser.add_argument("--id-field", default='id',
+                      help='name of the ID column in --csv')
 
-  if collection in cs.list_collections().json()['collections']:
-    log.error('target collection %s exists.', collection)
-    return
+  parser.add_argument("--zk-hosts",
+                      help='optional: ZooKeeper hosts of SolrCloud to switch all aliases '
+                           'with a single write to /aliases.json')
+  parser.add_argument("--warmup-queries",
+                      help='file with search queries (one per line) to warm up new '
+                           'collections before the alias is modified')
+  parser.add_argument("--warmup-rounds", type=int, default=1,
+                      help='number of times all warm-up queries are sent before measuring')
+  parser.add_argument("--warmup-max-slowdown", type=float, default=1.2,
+                      help='maximum p95 latency of the new collection, relative to the '
+                           'current collection')
+  parser.add_argument("--warmup-tolerance", type=float, default=10,
+                      help='additional p95 latency of the new collection that is always '
+                           'accepted (in ms)')
+  parser.add_argument("--warmup-retries", type=int, default=3,
+                      help='number of times a slower collection is warmed up and measured again')
+  parser.add_argument("--warmup-retry-wait", type=float, default=30,
+                      help='seconds to wait before warming up a slower collection again')
 
-  # check if we should insert into collection-1 or collection-2
-  resp = cs.list_aliases()
-  current_collection = resp.json()['aliases'].get(collection)
-  if current_collection and current_collection.endswith('-1'):
-    new_collection = collection + '-2'
-  else:
-    new_collection = collection + '-1'
+  args = parser.parse_args()
+  cs = SolrCloud(args.url, timeout=args.solr_timeout)
 
-  with ignore_solr_error():
-    log.info('deleting old collection %s', new_collection)
-    cs.delete_collection(new_collection)
+  if args.plan:
+    specs = load_plan(
+      args.plan,
+      num_shards=args.solr_num_shards,
+      replication_factor=args.solr_replication_factor,
+    )
+  elif args.collection and args.csv:
+    specs = [ImportSpec(
+      collection=args.collection,
+      csv=args.csv,
+      config_name=args.config_name,
+      num_shards=args.solr_num_shards,
+      replication_factor=args.solr_replication_factor,
+      manifest=args.manifest,
+    )]
+  elif args.mapping:
+    specs = plan_from_mapping(
+      args.mapping, args.csv_dir,
+      num_shards=args.solr_num_shards,
+      replication_factor=args.solr_replication_factor,
+    )
+  else:
+    parser.error('--collection and --csv, --plan or --mapping required')
 
-  log.info('creating new collection %s', new_collection)
-  cs.create_collection(
-    new_collection,
-    config_name=config_name,
-    num_shards=args.solr_num_shards,
-    replication_factor=args.solr_replication_factor,
-  )
+  warmup = None
+  if args.warmup_queries:
+    if not args.mapping:
+      parser.error('--warmup-queries requires --mapping')
+    from geocodr.mapping import load_collections
+    warmup = Warmup(
+      load_collections(args.mapping),
+      load_queries(args.warmup_queries),
+      rounds=args.warmup_rounds,
+      max_slowdown=args.warmup_max_slowdown,
+      tolerance=args.warmup_tolerance / 1000.0,
+      retries=args.warmup_retries,
+      retry_wait=args.warmup_retry_wait,
+    )
 
-  log.info('posting new data from %s', args.csv)
-  with open(args.csv, 'rb') as f:
-    cs.update_csv(new_collection, f)
+  start = time.time()
 
-  log.info('linking %s to %s', new_collection, collection)
-  cs.alias(new_collection, collection)
+  ok = True
+  if args.delta:
+    for spec in specs:
+      if not spec.manifest:
+        parser.error('--delta requires --manifest (or manifest for {} in --plan)'.format(
+          spec.collection))
+    with ThreadPoolExecutor(max_workers=args.parallel) as e:
+      futures = [(spec, e.submit(import_delta, cs, spec, args)) for spec in specs]
+      for spec, f in futures:
+        try:
+          f.result()
+        except Exception:
+          log.exception('delta import of %s failed', spec.collection)
+          ok = False
+  else:
+    ok = import_collections(cs, specs, args, warmup=warmup)
 
   log.info('import took %.2fs', time.time() - start)
+  if not ok:
+    # let cron jobs and CI detect failed or rejected imports
+    sys.exit(1)
 
 
 if __name__ == '__main__':
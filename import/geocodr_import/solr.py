@@ -54,9 +54,20 @@ def raise_on_non_200(f):
 
 
 class SolrCloud(object):
-  def __init__(self, solr_url):
+  """
+  Client for the SolrCloud collections and update API. Update and commit
+  requests fail after `connect_timeout` seconds without connection or
+  `timeout` seconds without response, so that they can be retried.
+  """
+
+  def __init__(self, solr_url, timeout=300.0, connect_timeout=10.0):
     self.solr_url = solr_url
+    self.timeout = (connect_timeout, timeout)
+    self.connect_timeout = connect_timeout
     self._s = requests.Session()
+    a = requests.adapters.HTTPAdapter(pool_maxsize=32)
+    self._s.mount('http://', a)
+    self._s.mount('https://', a)
 
   @raise_on_non_200
   def create_collection(self, collection, config_name=None, num_shards=2, replication_factor=2):
@@ -107,10 +118,101 @@ class SolrCloud(object):
     )
 
   @raise_on_non_200
-  def update_csv(self, collection, fh):
+  def delete_alias(self, alias):
+    return self._s.get(
+      self.solr_url + '/admin/collections',
+      params={'action': 'DELETEALIAS', 'name': alias},
+    )
+
+  @raise_on_non_200
+  def select(self, collection, **params):
+    return self._s.get('{}/{}/select'.format(self.solr_url, collection), params=params)
+
+  def count(self, collection):
+    return self.select(collection, q='*:*', rows=0).json()['response']['numFound']
+
+  @raise_on_non_200
+  def update_csv(self, collection, fh, commit=True):
+    params = {}
+    if commit:
+      params['commit'] = 'true'
     return self._s.post(
       '{}/{}/update'.format(self.solr_url, collection),
       headers={'Content-type': 'text/csv'},
-      params={'commit': 'true'},
-      data=fh
+      params=params,
+      data=fh,
+      timeout=self.timeout,
+    )
+
+  @raise_on_non_200
+  def update_json(self, collection, data, gzipped=False, commit=True):
+    params = {}
+    if commit:
+      params['commit'] = 'true'
+    headers = {'Content-type': 'application/json'}
+    if gzipped:
+      headers['Content-Encoding'] = 'gzip'
+    return self._s.post(
+      '{}/{}/update'.format(self.solr_url, collection),
+      headers=headers,
+      params=params,
+      data=data,
+      timeout=self.timeout,
+    )
+
+  @raise_on_non_200
+  def delete_ids(self, collection, ids, commit=False):
+    params = {}
+    if commit:
+      params['commit'] = 'true'
+    return self._s.post(
+      '{}/{}/update'.format(self.solr_url, collection),
+      params=params,
+      json={'delete': list(ids)},
+      timeout=self.timeout,
     )
+
+  @raise_on_non_200
+  def commit(self, collection):
+    return self._s.get(
+      '{}/{}/update'.format(self.solr_url, collection),
+      params={'commit': 'true', 'waitSearcher': 'true'},
+      timeout=self.timeout,
+    )
+
+  @raise_on_non_200
+  def optimize(self, collection, max_segments=1):
+    return self._s.get(
+      '{}/{}/update'.format(self.solr_url, collection),
+      params={'optimize': 'true', 'maxSegments': max_segments, 'waitSearcher': 'true'},
+      # merging large collections can take longer than any update
+      timeout=(self.connect_timeout, None),
+    )
+
+  @raise_on_non_200
+  def cluster_status(self, collection=None):
+    params = {'action': 'CLUSTERSTATUS'}
+    if collection:
+      params['collection'] = collection
+    return self._s.get(self.solr_url + '/admin/collections', params=params)
+
+  @raise_on_non_200
+  def reload_collection(self, collection):
+    return self._s.get(self.solr_url + '/admin/collections', params={
+      'action': 'RELOAD',
+      'name': collection,
+    })
+
+  def inactive_replicas(self, collection):
+    """
+    Return the names of all replicas of `collection` that are not active or
+    that are on a node that is not live.
+    """
+    cluster = self.cluster_status(collection).json()['cluster']
+    live_nodes = set(cluster.get('live_nodes', []))
+    inactive = []
+    for shard in cluster['collections'][collection]['shards'].values():
+      for name, replica in shard['replicas'].items():
+        if replica.get('state') != 'active' or replica.get('node_name') not in live_nodes:
+          inactive.append(name)
+    return inactive
@@ -0,0 +1,311 @@
+"""
+The tocsv module converts GeoJSON files into CSV files for geocodr-post.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import textwrap
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+log = logging.getLogger(__name__)
+
+features_re = re.compile(r'"features"\s*:\s*\[')
+
+
+def iter_features(fh, read_size=1024 * 1024):
+  """
+  Iterate over all features of the GeoJSON FeatureCollection in the text
+  file `fh`. The file is parsed incrementally, only the current feature is
+  kept in memory.
+
+  >>> import io
+  >>> fc = '{"type": "FeatureCollection", "features": [{"id": 1}, {"id": 2}]}'
+  >>> list(iter_features(io.StringIO(fc), read_size=5))
+  [{'id': 1}, {'id': 2}]
+  """
+  decoder = json.JSONDecoder()
+  buf = ''
+  eof = False
+
+  def read():
+    data = fh.read(read_size)
+    return data, not data
+
+  # find start of features array
+  while True:
+    m = features_re.search(buf)
+    if m:
+      buf = buf[m.end():]
+      break
+    if eof:
+      raise ValueError('no features found')
+    data, eof = read()
+    # keep the end, as the features key might be split between two reads
+    buf = buf[-64:] + data
+
+  pos = 0
+  while True:
+    while pos < len(buf) and buf[pos] in ' \t\r\n,':
+      pos += 1
+    if pos == len(buf):
+      if eof:
+        raise ValueError('unexpected end of file')
+      data, eof = read()
+      buf = buf[pos:] + data
+      pos = 0
+      continue
+    if buf[pos] == ']':
+      return
+    try:
+      feature, end = decoder.raw_decode(buf, pos)
+    except ValueError:
+      # incomplete feature
+      if eof:
+        raise
+      data, eof = read()
+      buf = buf[pos:] + data
+      pos = 0
+      continue
+    yield feature
+    pos = end
+
+
+class Converter(object):
+  """
+  Converter creates CSV rows from GeoJSON features. It assigns the
+  `join_property` of the features in the GeoJSON `join_file` that contain
+  a feature to the `join_column`. The join features are loaded into an
+  STRtree index with `load_join`, before the first feature is converted.
+
+  >>> Converter('uuid', [('name', 'strasse')], join_file='bezirke.json',
+  ...           join_property='bezeichnung', join_column='bezirk').fieldnames()
+  ['id', 'json', 'geometrie', 'strasse', 'bezirk']
+  """
+
+  def __init__(self, id_property, properties, geometry_column='geometrie', json_column='json',
+               simplify=0.00001, precision=6, join_file=None, join_property=None,
+               join_column=None, join_buffer=0.0):
+    self.id_property = id_property
+    self.properties = properties
+    self.geometry_column = geometry_column
+    self.json_column = json_column
+    self.simplify = simplify
+    self.precision = precision
+    self.join_file = join_file
+    self.join_property = join_property
+    self.join_column = join_column
+    self.join_buffer = join_buffer
+
+    self.join_tree = None
+    self.join_values = []
+
+  def load_join(self):
+    """
+    Load the features of `join_file` into the STRtree index.
+    """
+    from shapely import STRtree
+    from shapely.geometry import shape
+
+    geoms = []
+    self.join_values = []
+    with open(self.join_file, 'r') as f:
+      for feature in iter_features(f):
+        geom = shape(feature['geometry'])
+        if self.join_buffer:
+          geom = geom.buffer(self.join_buffer, 2)
+        geoms.append(geom)
+        self.join_values.append(feature['properties'].get(self.join_property))
+    self.join_tree = STRtree(geoms)
+
+  def fieldnames(self):
+    fields = ['id', self.json_column, self.geometry_column]
+    fields.extend(column for _, column in self.properties)
+    if self.join_file:
+      fields.append(self.join_column)
+    return fields
+
+  def convert(self, feature):
+    from shapely.geometry import shape
+    from shapely.wkt import dumps
+
+    prop = feature['properties']
+    geom = shape(feature['geometry'])
+    row = {
+      'id': prop[self.id_property],
+      self.json_column: json.dumps(prop),
+      self.geometry_column: dumps(geom.simplify(self.simplify),
+                                  rounding_precision=self.precision),
+    }
+    for name, column in self.properties:
+      row[column] = prop.get(name)
+
+    if self.join_file:
+      if self.join_tree is None:
+        self.load_join()
+      row[self.join_column] = None
+      matches = self.join_tree.query(geom, predicate='within')
+      if len(matches):
+        # use the last match, for compatibility with the previous nested loop
+        row[self.join_column] = self.join_values[max(matches)]
+    return row
+
+
+_converter = None
+
+
+def _init_worker(kw):
+  # each worker loads the join features once, instead of receiving them
+  # pickled from the main process
+  global _converter
+  _converter = Converter(**kw)
+  if _converter.join_file:
+    _converter.load_join()
+
+
+def _convert_batch(features):
+  return [_converter.convert(f) for f in features]
+
+
+def iter_batches(iterable, size):
+  batch = []
+  for item in iterable:
+    batch.append(item)
+    if len(batch) >= size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def convert(fh, out, converter_kw, workers=None, batch_size=500):
+  """
+  Convert all features from the GeoJSON file `fh` and write them as CSV to
+  `out`. Features are converted in batches of `batch_size` by a pool of
+  `workers` processes. Only a few batches are in flight at any time, and the
+  rows are written in the order of the input.
+  Returns the number of written rows.
+  """
+  workers = workers or os.cpu_count() or 1
+  fieldnames = Converter(**converter_kw).fieldnames()
+  writer = csv.DictWriter(out, fieldnames=fieldnames)
+  writer.writeheader()
+
+  rows = 0
+  pending = deque()
+  with ProcessPoolExecutor(
+      max_workers=workers, initializer=_init_worker, initargs=(converter_kw,)) as e:
+    for batch in iter_batches(iter_features(fh), batch_size):
+      pending.append(e.submit(_convert_batch, batch))
+      if len(pending) > workers * 2:
+        rows += write_rows(writer, pending.popleft().result())
+    while pending:
+      rows += write_rows(writer, pending.popleft().result())
+  return rows
+
+
+def write_rows(writer, rows):
+  writer.writerows(rows)
+  return len(rows)
+
+
+def parse_property(value):
+  """
+  Parse `name` or `name:column` option.
+
+  >>> parse_property('strasse_name')
+  ('strasse_name', 'strasse_name')
+  >>> parse_property('bezeichnung:stat_bezirk_name')
+  ('bezeichnung', 'stat_bezirk_name')
+  """
+  name, _, column = value.partition(':')
+  return name, column or name
+
+
+def main():
+  curr_help = """
+    This tool converts a GeoJSON FeatureCollection into a CSV file for
+    geocodr-post.
+
+    The CSV contains an `id` column (from --id-property), a JSON column with
+    all properties, the simplified geometry as WKT and a column for each
+    --property.
+
+    Features can be joined with the polygons of a second GeoJSON file
+    (--join). The --join-property of the polygon that contains the feature
+    is added as --join-column (e.g. to add the borough name to each street).
+
+    Example:
+        geocodr-tocsv --id-property uuid \\
+            --property gemeinde_name --property strasse_name \\
+            --join statistische_bezirke.json --join-property bezeichnung \\
+            --join-column stat_bezirk_name --join-buffer 0.0001 \\
+            strassen.json streets.csv
+        """
+  logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+  )
+
+  parser = argparse.ArgumentParser(
+    epilog=textwrap.dedent(curr_help),
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+  )
+  parser.add_argument("geojson", help='GeoJSON file to convert')
+  parser.add_argument("csv", help='CSV file to write')
+  parser.add_argument("--id-property", required=True,
+                      help='feature property with the unique ID')
+  parser.add_argument("--property", dest='properties', action='append', default=[],
+                      type=parse_property,
+                      help='feature property to add as column (name or name:column)')
+  parser.add_argument("--geometry-column", default='geometrie',
+                      help='name of the geometry column')
+  parser.add_argument("--json-column", default='json',
+                      help='name of the column with all properties as JSON')
+  parser.add_argument("--simplify", type=float, default=0.00001,
+                      help='tolerance for geometry simplification')
+  parser.add_argument("--precision", type=int, default=6,
+                      help='number of decimal places for WKT coordinates')
+  parser.add_argument("--join", help='GeoJSON file with polygons to join')
+  parser.add_argument("--join-property", help='property of the --join features to add')
+  parser.add_argument("--join-column", help='column name for --join-property')
+  parser.add_argument("--join-buffer", type=float, default=0.0,
+                      help='buffer --join polygons by this distance')
+  parser.add_argument("--workers", type=int,
+                      help='number of worker processes (defaults to number of CPUs)')
+  parser.add_argument("--batch-size", type=int, default=500,
+                      help='number of features for each worker task')
+
+  args = parser.parse_args()
+
+  if args.join and not args.join_property:
+    parser.error('--join requires --join-property')
+
+  converter_kw = {
+    'id_property': args.id_property,
+    'properties': args.properties,
+    'geometry_column': args.geometry_column,
+    'json_column': args.json_column,
+    'simplify': args.simplify,
+    'precision': args.precision,
+    'join_file': args.join,
+    'join_property': args.join_property,
+    'join_column': args.join_column or args.join_property,
+    'join_buffer': args.join_buffer,
+  }
+
+  start = time.time()
+  with open(args.geojson, 'r') as fi, open(args.csv, 'w', newline='') as fo:
+    rows = convert(fi, fo, converter_kw, workers=args.workers, batch_size=args.batch_size)
+  log.info('converted %d features in %.2fs', rows, time.time() - start)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,306 @@
+"""
+The upload module streams CSV files in bounded chunks to Solr.
+"""
+
+import csv
+import gzip
+import io
+import json
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .solr import SolrCloudException
+
+
+log = logging.getLogger(__name__)
+
+
+class Chunk(object):
+  """
+  Chunk is a part of a CSV file that can be posted on its own. `data`
+  always starts with the CSV header.
+  """
+
+  def __init__(self, num, data, rows, csv_size=None):
+    self.num = num
+    self.data = data
+    self.rows = rows
+    # size of the chunk as CSV, data can be encoded differently
+    self.csv_size = len(data) if csv_size is None else csv_size
+
+
+def iter_csv_records(fh):
+  """
+  Iterate over all records of the binary CSV file `fh`, including the
+  header. Each record is a complete CSV row, even if a quoted value contains
+  line breaks. Empty lines are skipped.
+
+  >>> import io
+  >>> list(iter_csv_records(io.BytesIO(b'id,name\\n1,"a\\nb"\\n\\n2,c')))
+  [b'id,name\\n', b'1,"a\\nb"\\n', b'2,c\\n']
+  """
+  parts = []
+  quotes = 0
+  for line in fh:
+    parts.append(line)
+    # escaped quotes are doubled, so an odd count means that we are still
+    # inside a quoted value
+    quotes += line.count(b'"')
+    if quotes % 2:
+      continue
+    record = b''.join(parts)
+    parts = []
+    quotes = 0
+    if not record.strip():
+      continue
+    if not record.endswith(b'\n'):
+      record += b'\n'
+    yield record
+
+  if parts:
+    yield b''.join(parts) + b'\n'
+
+
+def iter_record_chunks(header, records, chunk_size):
+  """
+  Combine `records` into `Chunk`s of up to `chunk_size` bytes (or a single
+  record, if this is larger), each starting with `header`.
+
+  >>> for c in iter_record_chunks(b'id\\n', [b'1\\n', b'2\\n', b'3\\n'], 7):
+  ...   print(c.num, c.rows, c.data)
+  0 2 b'id\\n1\\n2\\n'
+  1 1 b'id\\n3\\n'
+  """
+  num = 0
+  parts = [header]
+  size = len(header)
+  for record in records:
+    if len(parts) > 1 and size + len(record) > chunk_size:
+      yield Chunk(num, b''.join(parts), len(parts) - 1)
+      num += 1
+      parts = [header]
+      size = len(header)
+    parts.append(record)
+    size += len(record)
+
+  if len(parts) > 1:
+    yield Chunk(num, b''.join(parts), len(parts) - 1)
+
+
+def is_retryable(ex):
+  """
+  Return whether a failed request should be retried. Connection errors and
+  server errors are retried, client errors (e.g. invalid data) are not.
+  """
+  if isinstance(ex, SolrCloudException):
+    return ex.resp.status_code >= 500
+  return isinstance(ex, requests.RequestException)
+
+
+class Throughput(object):
+  """
+  Throughput collects the number of uploaded rows and bytes and logs the
+  current rates every `log_interval` seconds.
+  """
+
+  def __init__(self, log_interval=10.0):
+    self.log_interval = log_interval
+    self.rows = 0
+    self.bytes = 0
+    self.start = time.time()
+    self._last_log = self.start
+    self._lock = threading.Lock()
+
+  def add(self, rows, size):
+    with self._lock:
+      self.rows += rows
+      self.bytes += size
+      now = time.time()
+      if now - self._last_log >= self.log_interval:
+        self._last_log = now
+        self.log('uploaded')
+
+  def log(self, msg):
+    duration = max(time.time() - self.start, 1e-6)
+    log.info(
+      '%s %d rows, %.1f MB (%.0f rows/s, %.2f MB/s)',
+      msg, self.rows, self.bytes / 1e6,
+      self.rows / duration, self.bytes / 1e6 / duration,
+    )
+
+
+def encode_json_docs(data, compresslevel=6):
+  """
+  Convert a CSV chunk into a gzip compressed JSON array of Solr documents,
+  one document per line. Empty values are skipped, like the Solr CSV
+  handler does.
+
+  >>> gzip.decompress(encode_json_docs(b'id,name,x\\n1,"a, b",\\n'))
+  b'[\\n{"id": "1", "name": "a, b"}\\n]\\n'
+  """
+  lines = []
+  for row in csv.DictReader(io.StringIO(data.decode('utf-8'))):
+    lines.append(json.dumps(dict((k, v) for k, v in row.items() if v)))
+  doc = '[\n' + ',\n'.join(lines) + '\n]\n'
+  return gzip.compress(doc.encode('utf-8'), compresslevel)
+
+
+class TransportStats(object):
+  """
+  TransportStats collects the CSV size, the actually transmitted size and
+  the CPU time required for encoding.
+  """
+
+  def __init__(self):
+    self.csv_bytes = 0
+    self.wire_bytes = 0
+    self.encode_cpu = 0.0
+    self._lock = threading.Lock()
+
+  def add(self, csv_bytes, wire_bytes, encode_cpu):
+    with self._lock:
+      self.csv_bytes += csv_bytes
+      self.wire_bytes += wire_bytes
+      self.encode_cpu += encode_cpu
+
+
+class CSVTransport(object):
+  """
+  CSVTransport posts chunks as they are.
+  """
+  name = 'csv'
+
+  def __init__(self, cs, collection):
+    self.cs = cs
+    self.collection = collection
+    self.stats = TransportStats()
+
+  def prepare(self, chunk):
+    self.stats.add(chunk.csv_size, len(chunk.data), 0.0)
+    return chunk
+
+  def post(self, chunk):
+    self.cs.update_csv(self.collection, chunk.data, commit=False)
+
+
+class JSONTransport(CSVTransport):
+  """
+  JSONTransport converts chunks into gzip compressed Solr JSON documents.
+  Chunks are converted by the upload workers, so that the encoding of one
+  chunk runs while other chunks are transmitted.
+  """
+  name = 'json'
+
+  def __init__(self, cs, collection, compresslevel=6):
+    CSVTransport.__init__(self, cs, collection)
+    self.compresslevel = compresslevel
+
+  def prepare(self, chunk):
+    start = time.thread_time()
+    data = encode_json_docs(chunk.data, self.compresslevel)
+    self.stats.add(chunk.csv_size, len(data), time.thread_time() - start)
+    return Chunk(chunk.num, data, chunk.rows, csv_size=chunk.csv_size)
+
+  def post(self, chunk):
+    self.cs.update_json(self.collection, chunk.data, gzipped=True, commit=False)
+
+
+class ChunkUploader(object):
+  """
+  ChunkUploader sends chunks with `post` from `workers` parallel threads.
+  Each chunk is converted with `prepare` (if set) and retried up to
+  `retries` times. Only a limited number of chunks is read ahead, so the
+  memory usage is bounded by the chunk size and the number of workers.
+  """
+
+  def __init__(self, post, workers=4, retries=3, retry_wait=2.0, log_interval=10.0,
+               prepare=None):
+    self.post = post
+    self.prepare = prepare
+    self.workers = workers
+    self.retries = retries
+    self.retry_wait = retry_wait
+    self.log_interval = log_interval
+
+  def _send(self, chunk, throughput):
+    if self.prepare:
+      chunk = self.prepare(chunk)
+    attempt = 0
+    while True:
+      try:
+        self.post(chunk)
+      except Exception as ex:
+        if attempt >= self.retries or not is_retryable(ex):
+          raise
+        attempt += 1
+        log.warning('retrying chunk %d (attempt %d of %d): %s',
+                    chunk.num, attempt, self.retries, ex)
+        time.sleep(self.retry_wait * attempt)
+      else:
+        throughput.add(chunk.rows, len(chunk.data))
+        return
+
+  def upload(self, chunks):
+    """
+    Upload all `chunks`. Returns the `Throughput` of the upload.
+    Raises the first error after all running uploads are finished.
+    """
+    throughput = Throughput(log_interval=self.log_interval)
+    errors = []
+    # allow one queued chunk for each worker
+    pending = threading.BoundedSemaphore(self.workers * 2)
+
+    def done(f):
+      pending.release()
+      if f.exception():
+        errors.append(f.exception())
+
+    with ThreadPoolExecutor(max_workers=self.workers) as e:
+      for chunk in chunks:
+        pending.acquire()
+        if errors:
+          pending.release()
+          break
+        e.submit(self._send, chunk, throughput).add_done_callback(done)
+
+    if errors:
+      raise errors[0]
+
+    throughput.log('finished upload of')
+    return throughput
+
+
+def upload_chunks(cs, collection, chunks, workers=4, retries=3, transport='csv',
+                  compresslevel=6):
+  """
+  Upload CSV `chunks` to `collection` without committing. `transport` is
+  either `csv` to post the chunks as they are, or `json` to post them as
+  gzip compressed JSON documents.
+  """
+  if transport == 'json':
+    t = JSONTransport(cs, collection, compresslevel=compresslevel)
+  elif transport == 'csv':
+    t = CSVTransport(cs, collection)
+  else:
+    raise ValueError('unknown transport {}'.format(transport))
+
+  uploader = ChunkUploader(
+    t.post,
+    prepare=t.prepare,
+    workers=workers,
+    retries=retries,
+  )
+  throughput = uploader.upload(chunks)
+
+  if t.stats.csv_bytes:
+    log.info(
+      '%s transport: sent %.1f MB CSV data as %.1f MB (%.0f%%), %.2fs CPU for encoding',
+      t.name, t.stats.csv_bytes / 1e6, t.stats.wire_bytes / 1e6,
+      100.0 * t.stats.wire_bytes / t.stats.csv_bytes, t.stats.encode_cpu,
+    )
+  return throughput
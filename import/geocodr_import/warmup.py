@@ -0,0 +1,131 @@
+"""
+The warmup module replays search queries against new collections before
+their alias is switched.
+"""
+
+import logging
+import math
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class LatencyGateError(Exception):
+  pass
+
+
+def load_queries(fname):
+  """
+  Load warm-up queries from `fname`, one query per line. Empty lines and
+  lines starting with # are ignored.
+  """
+  queries = []
+  with open(fname, 'r') as f:
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      queries.append(line)
+  return queries
+
+
+def percentile(values, p):
+  """
+  Return the `p` percentile of `values` (nearest-rank method).
+
+  >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 95)
+  10
+  >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50)
+  5
+  """
+  values = sorted(values)
+  idx = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+  return values[idx]
+
+
+def query_params(coll, queries):
+  """
+  Return Solr query parameters for all `queries`, build with the same
+  logic as the geocodr API for the geocodr Collection `coll`.
+  """
+  from geocodr.api import MIN_COLLECTION_ROWS
+  from geocodr.solr import strip_special_chars
+
+  params = []
+  for query in queries:
+    query = strip_special_chars(query)
+    if len(query) < coll.min_query_length:
+      continue
+    params.append({
+      'q': coll.query(query),
+      'sort': coll.sort,
+      'fl': coll.field_list,
+      'rows': MIN_COLLECTION_ROWS,
+    })
+  return params
+
+
+def measure(cs, collection, params):
+  """
+  Send all queries and return the latency of each query in seconds.
+  """
+  latencies = []
+  for p in params:
+    start = time.time()
+    cs.select(collection, **p)
+    latencies.append(time.time() - start)
+  return latencies
+
+
+class Warmup(object):
+  """
+  Warmup replays `queries` against new collections. It compares the p95
+  latency with the collection that is currently linked to the alias and
+  refuses to continue if the new collection is more than `max_slowdown`
+  times (plus `tolerance` seconds) slower. Slower collections are warmed
+  and measured again up to `retries` times after `retry_wait` seconds.
+  """
+
+  def __init__(self, collections, queries, rounds=1, max_slowdown=1.2, tolerance=0.01,
+               retries=3, retry_wait=30):
+    self.collections = dict((c.name, c) for c in collections)
+    self.queries = queries
+    self.rounds = rounds
+    self.max_slowdown = max_slowdown
+    self.tolerance = tolerance
+    self.retries = retries
+    self.retry_wait = retry_wait
+
+  def run(self, cs, alias, new_collection, current_collection=None):
+    coll = self.collections.get(alias)
+    if not coll:
+      log.warning('no collection %s in mapping, skipping warm-up', alias)
+      return
+    params = query_params(coll, self.queries)
+    if not params:
+      return
+
+    for attempt in range(self.retries + 1):
+      log.info('warming up %s with %d queries', new_collection, len(params))
+      for _ in range(self.rounds):
+        measure(cs, new_collection, params)
+
+      new_p95 = percentile(measure(cs, new_collection, params), 95)
+      if not current_collection:
+        log.info('%s: p95 %.1fms', new_collection, new_p95 * 1000)
+        return
+
+      curr_p95 = percentile(measure(cs, current_collection, params), 95)
+      log.info('%s: p95 %.1fms, %s: p95 %.1fms', new_collection, new_p95 * 1000,
+               current_collection, curr_p95 * 1000)
+      if new_p95 <= curr_p95 * self.max_slowdown + self.tolerance:
+        return
+
+      if attempt < self.retries:
+        log.warning('%s is slower than %s, retrying in %ds', new_collection,
+                    current_collection, self.retry_wait)
+        time.sleep(self.retry_wait)
+
+    raise LatencyGateError('{} is slower than {} (p95 {:.1f}ms > {:.1f}ms)'.format(
+      new_collection, current_collection, new_p95 * 1000, curr_p95 * 1000))
@@ -1,13 +1,170 @@
 from glob import glob
+from hashlib import sha1
 from kazoo.client import KazooClient
+from kazoo.exceptions import NoNodeError
 from os import path
 
+import json
 import logging
 
 
 log = logging.getLogger(__name__)
 
 
+def config_files(config_dir, configs):
+  """
+  Return (local file, ZooKeeper path) pairs for all files of `configs`.
+  """
+  files = []
+  for config in configs:
+    files.append((
+      path.join(config_dir, config + '-schema.xml'),
+      '/configs/{}/managed-schema'.format(config),
+    ))
+    files.append((
+      path.join(config_dir, 'solrconfig.xml'),
+      '/configs/{}/solrconfig.xml'.format(config),
+    ))
+  return files
+
+
+def content_hash(content):
+  if content is None:
+    return None
+  return sha1(content).hexdigest()
+
+
+def read_local(fname):
+  try:
+    with open(fname, 'rb') as f:
+      return f.read()
+  except FileNotFoundError:
+    return None
+
+
+def get_remote(client, paths):
+  """
+  Fetch the content of all ZooKeeper `paths` concurrently. Returns a dict
+  with the content for each path (None for missing nodes).
+  """
+  results = dict((p, client.get_async(p)) for p in paths)
+  contents = {}
+  for p, r in results.items():
+    try:
+      contents[p], _ = r.get()
+    except NoNodeError:
+      contents[p] = None
+  return contents
+
+
+def push_files(client, files):
+  """
+  Upload all local files to ZooKeeper that differ from the remote content.
+  All reads and writes are sent concurrently. Returns all changed
+  ZooKeeper paths.
+  """
+  remote = get_remote(client, [p for _, p in files])
+
+  pending = []
+  for fname, p in files:
+    content = read_local(fname)
+    if content is None:
+      raise FileNotFoundError(fname)
+    if content_hash(content) == content_hash(remote[p]):
+      log.debug('%s is unchanged', p)
+      continue
+    if remote[p] is None:
+      pending.append((p, client.create_async(p, content, makepath=True)))
+    else:
+      pending.append((p, client.set_async(p, content)))
+
+  changed = []
+  for p, r in pending:
+    r.get()
+    log.info('updated %s', p)
+    changed.append(p)
+  return changed
+
+
+def pull_files(client, files):
+  """
+  Download all ZooKeeper files that differ from the local content. All
+  reads are sent concurrently. Returns all changed local files.
+  """
+  remote = get_remote(client, set(p for _, p in files))
+
+  changed = []
+  for fname, p in files:
+    if remote[p] is None:
+      raise NoNodeError(p)
+    if content_hash(remote[p]) == content_hash(read_local(fname)):
+      log.debug('%s is unchanged', fname)
+      continue
+    with open(fname, 'wb') as f:
+      f.write(remote[p])
+    log.info('updated %s', fname)
+    changed.append(fname)
+  return changed
+
+
+def changed_configs(changed_paths):
+  """
+  Return names of all configs with changed ZooKeeper paths.
+
+  >>> changed_configs(['/configs/a/managed-schema', '/configs/a/solrconfig.xml', '/x'])
+  ['a']
+  """
+  configs = []
+  for p in changed_paths:
+    parts = p.split('/')
+    if len(parts) > 3 and parts[1] == 'configs' and parts[2] not in configs:
+      configs.append(parts[2])
+  return configs
+
+
+def update_aliases(content, aliases):
+  """
+  Return the content of Solr's /aliases.json with all `aliases` (alias ->
+  collection) changed.
+
+  >>> update_aliases(b'{"collection": {"a": "a-1", "b": "b-1"}}', {'a': 'a-2', 'c': 'c-1'})
+  b'{"collection": {"a": "a-2", "b": "b-1", "c": "c-1"}}'
+  >>> update_aliases(b'', {'a': 'a-1'})
+  b'{"collection": {"a": "a-1"}}'
+  """
+  doc = json.loads(content.decode('utf-8')) if content else {}
+  doc.setdefault('collection', {}).update(aliases)
+  return json.dumps(doc).encode('utf-8')
+
+
+def switch_aliases(client, aliases):
+  """
+  Change all `aliases` (alias -> collection) with a single write of
+  /aliases.json. The write fails if the aliases were modified concurrently,
+  so either all or no aliases are changed.
+  """
+  try:
+    content, stat = client.get('/aliases.json')
+  except NoNodeError:
+    client.create('/aliases.json', update_aliases(b'', aliases), makepath=True)
+    return
+  client.set('/aliases.json', update_aliases(content, aliases), version=stat.version)
+
+
+def reload_collections(solr_url, configs):
+  """
+  Reload all collections that use one of the `configs`.
+  """
+  from .solr import SolrCloud
+
+  cs = SolrCloud(solr_url)
+  collections = cs.cluster_status().json()['cluster']['collections']
+  for name, coll in sorted(collections.items()):
+    if coll.get('configName') in configs:
+      log.info('reloading collection %s', name)
+      cs.reload_collection(name)
+
+
 def main():
   import argparse
   import logging
@@ -29,6 +186,9 @@ def main():
                       help='config names')
   parser.add_argument("--security", action='store_true',
                       help='--pull or --push this file to/from security.json and exit')
+  parser.add_argument("--reload-url",
+                      help='optional: Solr URL to reload all collections with changed '
+                           'configs after --push')
 
   args = parser.parse_args()
 
@@ -43,14 +203,11 @@ def main():
       args.configs.append(path.basename(config)[:-len('-schema.xml')])
 
   if args.security:
+    security_files = [(path.join(args.config_dir, 'security.json'), '/security.json')]
     if args.pull:
-      content, md = client.get('/security.json')
-      with open(path.join(args.config_dir, 'security.json'), 'wb') as f:
-        f.write(content)
+      pull_files(client, security_files)
     elif args.push:
-      with open(path.join(args.config_dir, 'security.json'), 'rb') as f:
-        content = f.read()
-      client.set('/security.json', content)
+      push_files(client, security_files)
     else:
       log.error("--security option requires --pull or --push")
       return
@@ -62,33 +219,24 @@ def main():
       config = path.basename(config)[:-len('-schema.xml')]
       print('local\t' + config)
   elif args.pull:
-    for config in args.configs:
-      content, md = client.get('/configs/{}/managed-schema'.format(config))
-      with open(path.join(args.config_dir, config + '-schema.xml'), 'wb') as f:
-        f.write(content)
-      content, md = client.get('/configs/{}/solrconfig.xml'.format(config))
-      with open(path.join(args.config_dir, 'solrconfig.xml'), 'wb') as f:
-        f.write(content)
+    changed = pull_files(client, config_files(args.config_dir, args.configs))
+    log.info('%d files changed', len(changed))
   elif args.push:
-    for config in args.configs:
-      with open(path.join(args.config_dir, config + '-schema.xml'), 'rb') as f:
-        content = f.read()
-      p = '/configs/{}/managed-schema'.format(config)
-      client.ensure_path(p)
-      client.set(p, content)
-
-      with open(path.join(args.config_dir, 'solrconfig.xml'), 'rb') as f:
-        content = f.read()
-      p = '/configs/{}/solrconfig.xml'.format(config)
-      client.ensure_path(p)
-      client.set(p, content)
+    changed = changed_configs(push_files(client, config_files(args.config_dir, args.configs)))
+    if changed:
+      log.info('changed configs: %s', ', '.join(changed))
+    else:
+      log.info('no configs changed')
+    if args.reload_url and changed:
+      reload_collections(args.reload_url, changed)
   elif args.delete:
     for config in args.configs:
       p = '/configs/{}'.format(config)
       client.delete(p, recursive=True)
 
-  client.ensure_path('/configs/new/managed-schema')
-  client.set('/configs/new/managed-schema', b'')
+  if not client.exists('/configs/new/managed-schema'):
+    client.ensure_path('/configs/new/managed-schema')
+    client.set('/configs/new/managed-schema', b'')
 
 
 if __name__ == '__main__':
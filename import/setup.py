@@ -11,10 +11,13 @@ setup(
     'console_scripts': [
       'geocodr-post=geocodr_import.post:main',
       'geocodr-zk=geocodr_import.zk:main',
+      'geocodr-tocsv=geocodr_import.tocsv:main',
+      'geocodr-flst-index=geocodr_import.flstindex:main',
     ],
   },
   install_requires=[
     'kazoo',
     'requests',
+    'Shapely>=2',
   ],
 )